@@ -1,14 +1,51 @@
 from fastapi import FastAPI, HTTPException, Depends, Header
 from pydantic import BaseModel
-from datetime import datetime
-from pymongo import MongoClient
-from jose import JWTError, jwt
+from datetime import datetime, timezone
 from typing import Optional
+import logging
+import os
+import uuid
 
-# MongoDB setup
-client = MongoClient("mongodb://mongodb:27017")
-db = client["mydatabase"]
+from common.auth import InvalidToken, JWTAuth
+from common.cache import LatestValueCache
+from common.db import db, run_db
+from common.indexes import ensure_indexes
+from common.updates import UpdateSubscriber, redis_from_env
+from rules import FIELDS, KINDS, OPERATORS, AlertMonitor
+
+# MongoDB setup (MONGO_URL and pool sizes come from the environment, see common/db.py)
 devices_collection = db["devices"]
+rules_collection = db["alert_rules"]
+alerts_collection = db["alerts"]
+
+# One alert document per (rule, device), enforced by the index
+ensure_indexes(db)
+
+# Latest device documents, kept current by the updates published on ingestion
+redis_client = redis_from_env()
+device_cache = LatestValueCache(
+    lambda device_id: devices_collection.find_one({"device_id": device_id}),
+    max_entries=int(os.getenv("DEVICE_CACHE_SIZE", "10000")),
+    ttl_seconds=float(os.getenv("DEVICE_CACHE_TTL_SECONDS", "30")),
+    redis_client=redis_client,
+)
+
+# Rule evaluation runs on the same update channel as the cache
+monitor = AlertMonitor(
+    db,
+    interval=float(os.getenv("ALERT_EVAL_INTERVAL_SECONDS", "0.2")),
+    refresh_seconds=float(os.getenv("ALERT_RULES_REFRESH_SECONDS", "60")),
+)
+
+def on_device_updates(updates: dict):
+    device_cache.apply_updates(updates)
+    monitor.submit(updates)
+
+if redis_client is not None:
+    monitor.start()
+    UpdateSubscriber(redis_client, on_device_updates, device_cache.clear).start()
+else:
+    logging.warning("REDIS_URL is not set, alert rules will not be evaluated")
 
 # Application setup
 app = FastAPI()
@@ -16,18 +53,30 @@ app = FastAPI()
 # Security configurations
 SECRET_KEY = "your_secret_key_here"
 ALGORITHM = "HS256"
+auth = JWTAuth(SECRET_KEY, ALGORITHM)
+
+# Models
+class AlertRule(BaseModel):
+    field: str
+    kind: str = "threshold"
+    operator: str = ">"
+    threshold: float
+    clear_threshold: Optional[float] = None
+    cooldown_seconds: float = 300
+    device_id: Optional[str] = None
+    device_type: Optional[str] = None
 
 # Helper functions
 
-def decode_jwt_token(token: str):
+def authenticate(authorization: str):
+    # Verified tokens are cached, so repeated requests skip the signature check
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except JWTError:
+        return auth.verify_bearer(authorization)
+    except InvalidToken:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 def get_device(device_id: str):
-    return devices_collection.find_one({"device_id": device_id})
+    return device_cache.get(device_id)
 
 def get_devices_by_user(user_id: str):
     return list(devices_collection.find({"user_id": user_id}))
@@ -42,12 +91,10 @@ async def get_device_value(device_id: str, value_type: str, authorization: str =
     :param value_type: The value to fetch (e.g., value1, value2, etc.).
     :param authorization: The Bearer token for authentication.
     """
-    # Extract the token from the Authorization header
-    token = authorization.split(" ")[1]  # "Bearer <token>"
-    payload = decode_jwt_token(token)
+    payload = authenticate(authorization)
 
     # Ensure the device exists
-    device = get_device(device_id)
+    device = await run_db(get_device, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
 
@@ -62,3 +109,91 @@ async def get_device_value(device_id: str, value_type: str, authorization: str =
     # Return the requested value
     return {value_type: device[value_type],"timestamp":device["data_timestamp"]}
 
+
+@app.post("/rules", response_model=dict)
+async def create_rule(rule: AlertRule, authorization: str = Header(...)):
+    """
+    Endpoint to define an alert rule for one device or for all of the user's devices of a type.
+    :param rule: threshold: value compared with threshold; rate: change per second
+                 compared with threshold; stale: no data for threshold seconds.
+                 Alerts clear at clear_threshold (hysteresis, defaults to threshold)
+                 and are not raised again within cooldown_seconds.
+    :param authorization: The Bearer token for authentication.
+    """
+    payload = authenticate(authorization)
+
+    if rule.field not in FIELDS:
+        raise HTTPException(status_code=400, detail=f"Invalid field '{rule.field}', expected one of {list(FIELDS)}")
+    if rule.kind not in KINDS:
+        raise HTTPException(status_code=400, detail=f"Invalid kind '{rule.kind}', expected one of {list(KINDS)}")
+    if rule.operator not in OPERATORS:
+        raise HTTPException(
+            status_code=400, detail=f"Invalid operator '{rule.operator}', expected one of {list(OPERATORS)}"
+        )
+    if (rule.device_id is None) == (rule.device_type is None):
+        raise HTTPException(status_code=400, detail="Set exactly one of device_id and device_type")
+    if rule.kind == "stale" and rule.threshold <= 0:
+        raise HTTPException(status_code=400, detail="Stale rules need a threshold in seconds greater than 0")
+    if rule.clear_threshold is not None and (
+        rule.clear_threshold > rule.threshold if rule.operator == ">" else rule.clear_threshold < rule.threshold
+    ):
+        raise HTTPException(status_code=400, detail="clear_threshold must be on the safe side of threshold")
+
+    # Device rules need a device the user owns
+    if rule.device_id is not None:
+        device = await run_db(get_device, rule.device_id)
+        if not device:
+            raise HTTPException(status_code=404, detail="Device not found")
+        if device["user_id"] != payload["user_id"]:
+            raise HTTPException(status_code=403, detail="Access denied for this device")
+
+    document = {
+        "rule_id": str(uuid.uuid4()),
+        "user_id": payload["user_id"],
+        **rule.dict(),
+        "created_at": datetime.now(timezone.utc),
+    }
+    await run_db(rules_collection.insert_one, document)
+    monitor.request_reload()
+    document.pop("_id", None)
+    return document
+
+@app.get("/rules", response_model=list)
+async def get_rules(authorization: str = Header(...)):
+    """
+    Endpoint to list the user's alert rules.
+    :param authorization: The Bearer token for authentication.
+    """
+    payload = authenticate(authorization)
+
+    return await run_db(lambda: list(rules_collection.find({"user_id": payload["user_id"]}, {"_id": 0})))
+
+@app.delete("/rules/{rule_id}", response_model=dict)
+async def delete_rule(rule_id: str, authorization: str = Header(...)):
+    """
+    Endpoint to delete an alert rule and its alerts.
+    :param rule_id: The rule to delete.
+    :param authorization: The Bearer token for authentication.
+    """
+    payload = authenticate(authorization)
+
+    result = await run_db(rules_collection.delete_one, {"rule_id": rule_id, "user_id": payload["user_id"]})
+    if not result.deleted_count:
+        raise HTTPException(status_code=404, detail="Rule not found")
+    await run_db(alerts_collection.delete_many, {"rule_id": rule_id})
+    monitor.request_reload()
+    return {"message": "Rule successfully removed"}
+
+@app.get("/alerts", response_model=list)
+async def get_alerts(active_only: bool = True, authorization: str = Header(...)):
+    """
+    Endpoint to list the user's alerts, one per rule and device.
+    :param active_only: Only alerts that are currently raised.
+    :param authorization: The Bearer token for authentication.
+    """
+    payload = authenticate(authorization)
+
+    query = {"user_id": payload["user_id"]}
+    if active_only:
+        query["active"] = True
+    return await run_db(lambda: list(alerts_collection.find(query, {"_id": 0}).sort("raised_at", -1).limit(1000)))
@@ -0,0 +1,375 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from pymongo import UpdateOne
+
+from common.telemetry import as_utc
+
+# Values rules can watch; their position is the column in the reading matrix
+FIELDS = ("value1", "value2", "value3", "battery_percentage")
+KINDS = ("threshold", "rate", "stale")
+OPERATORS = (">", "<")
+
+THRESHOLD, RATE, STALE = range(len(KINDS))
+
+
+class RuleEngine:
+    """
+    Evaluates alert rules against batches of readings with array operations.
+
+    Every (rule, device) pair the rule applies to gets a slot in a set of state
+    arrays (active flag, last value and time, last raise). A batch of readings
+    is expanded into one row per (reading, slot) with precomputed per-device
+    index arrays, and all rows are evaluated together; the only Python loops
+    are over readings (to build the value matrix) and over alerts that actually
+    change state.
+
+    Rule kinds:
+    - threshold: the value compared with threshold
+    - rate: change per second since the previous reading compared with threshold
+    - stale: no reading of the field for more than threshold seconds (check_stale)
+
+    Alerts have hysteresis: a ">" rule raises above threshold but only clears
+    at or below clear_threshold (and the other way round for "<"). Only state
+    changes are reported, so an alert stays raised while the condition holds,
+    and a rule that cleared is not raised again for the same device within
+    cooldown_seconds of its previous raise.
+    """
+
+    def __init__(self):
+        self.rule_ids = []
+        self._rule_user = []
+        self._field = np.empty(0, dtype=np.int8)
+        self._kind = np.empty(0, dtype=np.int8)
+        self._greater = np.empty(0, dtype=bool)
+        self._threshold = np.empty(0)
+        self._clear = np.empty(0)
+        self._cooldown = np.empty(0)
+
+        self._device_slots = {}  # device_id -> (rule indices, slots)
+        self._slot_keys = []  # slot -> (rule_id, device_id)
+        self._slot_rule = np.empty(0, dtype=np.int32)
+        self._stale_slots = np.empty(0, dtype=np.int32)
+        self._active = np.empty(0, dtype=bool)
+        self._last_value = np.empty(0)
+        self._last_time = np.empty(0)
+        self._last_raised = np.empty(0)
+
+        # Running totals
+        self.evaluations = 0
+        self.raised = 0
+        self.cleared = 0
+        self.suppressed = 0
+
+    def __len__(self) -> int:
+        return len(self.rule_ids)
+
+    @property
+    def pairs(self) -> int:
+        return len(self._slot_keys)
+
+    def load(self, rules: list, devices: dict, active_pairs=(), now: float = None):
+        """
+        Replace the rule set, keeping the state of (rule, device) pairs that still exist.
+
+        Parameters:
+        - rules (list): Rule documents (rule_id, user_id, device_id or device_type,
+          field, kind, operator, threshold, clear_threshold, cooldown_seconds)
+        - devices (dict): device_id -> (user_id, device_type)
+        - active_pairs (iterable): (rule_id, device_id) pairs to start out raised
+        - now (float): Epoch seconds; stale rules count from here for new pairs
+        """
+        now = time.time() if now is None else now
+        rule_ids = [rule["rule_id"] for rule in rules]
+        field = np.array([FIELDS.index(rule["field"]) for rule in rules], dtype=np.int8)
+        kind = np.array([KINDS.index(rule["kind"]) for rule in rules], dtype=np.int8)
+        greater = np.array([rule.get("operator", ">") == ">" for rule in rules], dtype=bool)
+        threshold = np.array([rule["threshold"] for rule in rules], dtype=float)
+        clear = np.array([
+            rule["threshold"] if rule.get("clear_threshold") is None else rule["clear_threshold"] for rule in rules
+        ], dtype=float)
+        cooldown = np.array([rule.get("cooldown_seconds", 0) for rule in rules], dtype=float)
+
+        by_device = {}
+        by_type = {}
+        for index, rule in enumerate(rules):
+            if rule.get("device_id"):
+                by_device.setdefault(rule["device_id"], []).append(index)
+            else:
+                by_type.setdefault((rule["user_id"], rule.get("device_type")), []).append(index)
+
+        device_slots = {}
+        slot_keys = []
+        slot_rule = []
+        for device_id, (user_id, device_type) in devices.items():
+            indices = [
+                index for index in by_device.get(device_id, ()) if rules[index]["user_id"] == user_id
+            ] + by_type.get((user_id, device_type), [])
+            if not indices:
+                continue
+            first = len(slot_keys)
+            slot_keys.extend((rule_ids[index], device_id) for index in indices)
+            slot_rule.extend(indices)
+            device_slots[device_id] = (
+                np.array(indices, dtype=np.int32),
+                np.arange(first, first + len(indices), dtype=np.int32),
+            )
+
+        slots = len(slot_keys)
+        active = np.zeros(slots, dtype=bool)
+        last_value = np.full(slots, np.nan)
+        last_time = np.full(slots, np.nan)
+        last_raised = np.full(slots, -np.inf)
+        slot_rule = np.array(slot_rule, dtype=np.int32)
+
+        # Carry state over from the previous rule set
+        previous = {key: slot for slot, key in enumerate(self._slot_keys)}
+        kept = [(slot, previous[key]) for slot, key in enumerate(slot_keys) if key in previous]
+        if kept:
+            new, old = (np.array(column, dtype=np.int32) for column in zip(*kept))
+            active[new] = self._active[old]
+            last_value[new] = self._last_value[old]
+            last_time[new] = self._last_time[old]
+            last_raised[new] = self._last_raised[old]
+        stale = np.nonzero(kind[slot_rule] == STALE)[0].astype(np.int32) if slots else np.empty(0, dtype=np.int32)
+        last_time[stale] = np.where(np.isnan(last_time[stale]), now, last_time[stale])
+        for slot, key in enumerate(slot_keys):
+            if key in active_pairs:
+                active[slot] = True
+
+        self.rule_ids = rule_ids
+        self._rule_user = [rule["user_id"] for rule in rules]
+        self._field, self._kind, self._greater = field, kind, greater
+        self._threshold, self._clear, self._cooldown = threshold, clear, cooldown
+        self._device_slots = device_slots
+        self._slot_keys = slot_keys
+        self._slot_rule = slot_rule
+        self._stale_slots = stale
+        self._active, self._last_value, self._last_time, self._last_raised = active, last_value, last_time, last_raised
+
+    def evaluate(self, readings: list) -> list:
+        """
+        Evaluate a batch of readings, oldest first.
+
+        Parameters:
+        - readings (list): (device_id, epoch seconds, fields) tuples
+
+        Returns:
+        - list: Transitions as (rule_id, user_id, device_id, "raised" or "cleared", value, epoch seconds)
+        """
+        values = np.full((len(readings), len(FIELDS)), np.nan)
+        times = np.empty(len(readings))
+        layers = np.empty(len(readings), dtype=np.int32)
+        seen = {}
+        rule_parts, slot_parts, row_parts = [], [], []
+        for row, (device_id, timestamp, fields) in enumerate(readings):
+            entry = self._device_slots.get(device_id)
+            if entry is None:
+                layers[row] = -1
+                continue
+            for column, field in enumerate(FIELDS):
+                value = fields.get(field)
+                if isinstance(value, (int, float)):
+                    values[row, column] = value
+            times[row] = timestamp
+            # A device that reports twice in one batch is evaluated in a later layer
+            layers[row] = seen.get(device_id, 0)
+            seen[device_id] = layers[row] + 1
+            rule_parts.append(entry[0])
+            slot_parts.append(entry[1])
+            row_parts.append(np.full(len(entry[0]), row, dtype=np.int32))
+        if not rule_parts:
+            return []
+
+        rule = np.concatenate(rule_parts)
+        slot = np.concatenate(slot_parts)
+        row = np.concatenate(row_parts)
+        value = values[row, self._field[rule]]
+        timestamp = times[row]
+        layer = layers[row]
+
+        transitions = []
+        for current in range(int(layer.max()) + 1):
+            mask = layer == current
+            transitions.extend(self._step(rule[mask], slot[mask], value[mask], timestamp[mask]))
+        return transitions
+
+    def check_stale(self, now: float = None) -> list:
+        """
+        Raise stale-data rules whose field has not been reported for too long.
+
+        Returns:
+        - list: Transitions, as returned by evaluate()
+        """
+        now = time.time() if now is None else now
+        slot = self._stale_slots
+        rule = self._slot_rule[slot]
+        overdue = (now - self._last_time[slot] > self._threshold[rule]) & ~self._active[slot]
+        return self._apply(rule, slot, overdue, np.zeros(len(slot), dtype=bool), np.full(len(slot), np.nan),
+                           np.full(len(slot), now))
+
+    def _step(self, rule, slot, value, timestamp):
+        kind = self._kind[rule]
+        greater = self._greater[rule]
+        present = ~np.isnan(value)
+        self.evaluations += int(present.sum())
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            elapsed = timestamp - self._last_time[slot]
+            rate = (value - self._last_value[slot]) / elapsed
+        metric = np.where(kind == RATE, rate, value)
+        checked = present & ((kind == THRESHOLD) | ((kind == RATE) & (elapsed > 0)))
+
+        breached = checked & np.where(greater, metric > self._threshold[rule], metric < self._threshold[rule])
+        recovered = checked & np.where(greater, metric <= self._clear[rule], metric >= self._clear[rule])
+        # Any reading of the field ends a stale-data alert
+        recovered |= present & (kind == STALE)
+
+        transitions = self._apply(rule, slot, breached, recovered, value, timestamp)
+
+        self._last_value[slot[present]] = value[present]
+        self._last_time[slot[present]] = timestamp[present]
+        return transitions
+
+    def _apply(self, rule, slot, breached, recovered, value, timestamp):
+        active = self._active[slot]
+        raise_now = breached & ~active
+        cooled_down = timestamp - self._last_raised[slot] >= self._cooldown[rule]
+        self.suppressed += int((raise_now & ~cooled_down).sum())
+        raise_now &= cooled_down
+        clear_now = recovered & active
+
+        self._active[slot[raise_now]] = True
+        self._last_raised[slot[raise_now]] = timestamp[raise_now]
+        self._active[slot[clear_now]] = False
+        self.raised += int(raise_now.sum())
+        self.cleared += int(clear_now.sum())
+
+        transitions = []
+        for state, mask in (("raised", raise_now), ("cleared", clear_now)):
+            for index in np.nonzero(mask)[0]:
+                rule_id, device_id = self._slot_keys[slot[index]]
+                reading = None if np.isnan(value[index]) else float(value[index])
+                transitions.append(
+                    (rule_id, self._rule_user[rule[index]], device_id, state, reading, float(timestamp[index]))
+                )
+        return transitions
+
+
+class AlertMonitor:
+    """
+    Feeds device updates into a RuleEngine and records alert state changes.
+
+    submit() is called with update messages (device_id -> written fields) from
+    the update channel; a background thread evaluates whatever accumulated every
+    interval seconds, checks stale-data rules, and upserts one document per
+    (rule, device) in the alerts collection. Rules and device metadata are
+    reloaded every refresh_seconds, or right away after request_reload().
+
+    At most max_pending readings wait for evaluation; beyond that the oldest are
+    dropped (and logged).
+    """
+
+    def __init__(self, db, interval: float = 0.2, refresh_seconds: float = 60, max_pending: int = 100000,
+                 stats_interval: float = 60):
+        self.rules_collection = db["alert_rules"]
+        self.alerts_collection = db["alerts"]
+        self.devices_collection = db["devices"]
+        self.interval = interval
+        self.refresh_seconds = refresh_seconds
+        self.max_pending = max_pending
+        self.stats_interval = stats_interval
+        self.engine = RuleEngine()
+
+        self._pending = []
+        self._lock = threading.Lock()
+        self._reload = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="alert-rules", daemon=True)
+        self.dropped = 0
+
+    def start(self):
+        self.load()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def request_reload(self):
+        self._reload.set()
+
+    def submit(self, updates: dict):
+        readings = []
+        for device_id, fields in updates.items():
+            if fields is None:
+                self.request_reload()
+                continue
+            timestamp = fields.get("received_at") or fields.get("health_timestamp")
+            readings.append((device_id, as_utc(timestamp).timestamp() if timestamp else time.time(), fields))
+        with self._lock:
+            self._pending.extend(readings)
+            overflow = len(self._pending) - self.max_pending
+            if overflow > 0:
+                del self._pending[:overflow]
+                self.dropped += overflow
+                logging.warning(f"Alert evaluation is behind, dropped {overflow} readings")
+
+    def load(self):
+        """
+        Reload rules, device metadata and raised alerts from MongoDB.
+        """
+        rules = list(self.rules_collection.find({}, {"_id": 0}))
+        devices = {
+            device["device_id"]: (device.get("user_id"), device.get("device_type"))
+            for device in self.devices_collection.find({}, {"_id": 0, "device_id": 1, "user_id": 1, "device_type": 1})
+        }
+        active = {
+            (alert["rule_id"], alert["device_id"])
+            for alert in self.alerts_collection.find({"active": True}, {"_id": 0, "rule_id": 1, "device_id": 1})
+        }
+        self.engine.load(rules, devices, active)
+        logging.info(f"Loaded {len(rules)} alert rules for {len(devices)} devices")
+
+    def _run(self):
+        next_refresh = time.monotonic() + self.refresh_seconds
+        next_stats = time.monotonic() + self.stats_interval
+        while not self._stopped.wait(self.interval):
+            try:
+                if self._reload.is_set() or time.monotonic() >= next_refresh:
+                    self._reload.clear()
+                    next_refresh = time.monotonic() + self.refresh_seconds
+                    self.load()
+                with self._lock:
+                    readings, self._pending = self._pending, []
+                transitions = self.engine.evaluate(readings) if readings else []
+                transitions.extend(self.engine.check_stale())
+                if transitions:
+                    self._record(transitions)
+            except Exception as e:
+                logging.error(f"Alert evaluation failed: {e}")
+            if time.monotonic() >= next_stats:
+                next_stats += self.stats_interval
+                engine = self.engine
+                logging.info(
+                    f"Alert rules: {len(engine)} rules, {engine.evaluations} evaluations, {engine.raised} raised, "
+                    f"{engine.cleared} cleared, {engine.suppressed} suppressed by cooldown, {self.dropped} dropped"
+                )
+
+    def _record(self, transitions: list):
+        operations = []
+        for rule_id, user_id, device_id, state, value, timestamp in transitions:
+            at = datetime.fromtimestamp(timestamp, timezone.utc)
+            logging.info(f"Alert {state} for device {device_id} (rule {rule_id}, value {value})")
+            if state == "raised":
+                update = {
+                    "$set": {"user_id": user_id, "active": True, "value": value, "raised_at": at},
+                    "$inc": {"raise_count": 1},
+                }
+            else:
+                update = {"$set": {"active": False, "cleared_at": at}}
+            operations.append(UpdateOne({"rule_id": rule_id, "device_id": device_id}, update, upsert=True))
+        self.alerts_collection.bulk_write(operations, ordered=True)
@@ -0,0 +1,111 @@
+"""
+Micro-benchmark: alert rule evaluation throughput.
+
+Loads a synthetic rule set into the alertservice RuleEngine (rules per device
+type plus per-device rules) and feeds it batches of random readings, the way
+the update channel delivers them. Reports rule evaluations per second, i.e.
+(reading, rule) pairs checked, and readings per second, on a single core.
+
+Usage (from the repository root):
+    python -m benchmarks.alert_rules [--devices 10000] [--batch 2000] [--batches 200]
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "alertservice"))
+
+from rules import FIELDS, RuleEngine  # noqa: E402
+
+DEVICE_TYPES = ("Sensor", "Meter", "Tracker", "Gateway")
+
+
+def build_rules(args, devices: dict) -> list:
+    rules = []
+    for device_type in DEVICE_TYPES:
+        for field in FIELDS:
+            rules.append({
+                "rule_id": f"type-{device_type}-{field}-high",
+                "user_id": "bench",
+                "device_type": device_type,
+                "field": field,
+                "kind": "threshold",
+                "operator": ">",
+                "threshold": 95,
+                "clear_threshold": 90,
+                "cooldown_seconds": 60,
+            })
+            rules.append({
+                "rule_id": f"type-{device_type}-{field}-rate",
+                "user_id": "bench",
+                "device_type": device_type,
+                "field": field,
+                "kind": "rate",
+                "operator": ">",
+                "threshold": 40,
+                "clear_threshold": 10,
+            })
+    for index, device_id in enumerate(random.sample(list(devices), args.device_rules)):
+        rules.append({
+            "rule_id": f"device-{index}",
+            "user_id": "bench",
+            "device_id": device_id,
+            "field": random.choice(FIELDS),
+            "kind": random.choice(("threshold", "stale")),
+            "operator": "<",
+            "threshold": 5 if index % 2 else 120,
+            "cooldown_seconds": 60,
+        })
+    return rules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=10_000)
+    parser.add_argument("--device-rules", type=int, default=2_000, help="Rules bound to single devices")
+    parser.add_argument("--batch", type=int, default=2_000, help="Readings per evaluation batch")
+    parser.add_argument("--batches", type=int, default=200)
+    args = parser.parse_args()
+
+    random.seed(1)
+    devices = {f"dev-{i:06d}": ("bench", DEVICE_TYPES[i % len(DEVICE_TYPES)]) for i in range(args.devices)}
+    rules = build_rules(args, devices)
+    engine = RuleEngine()
+    started = time.perf_counter()
+    engine.load(rules, devices, now=0)
+    load_seconds = time.perf_counter() - started
+
+    device_ids = list(devices)
+    batches = []
+    clock = 0.0
+    for _ in range(args.batches):
+        batch = []
+        for _ in range(args.batch):
+            clock += 0.001
+            batch.append((
+                random.choice(device_ids),
+                clock,
+                {"value1": random.uniform(0, 100), "value2": random.uniform(0, 100),
+                 "value3": random.uniform(0, 100), "data_timestamp": int(clock)},
+            ))
+        batches.append(batch)
+
+    transitions = 0
+    started = time.perf_counter()
+    for batch in batches:
+        transitions += len(engine.evaluate(batch))
+        transitions += len(engine.check_stale(now=batch[-1][1]))
+    elapsed = time.perf_counter() - started
+
+    readings = args.batch * args.batches
+    print(f"rules: {len(rules)}, (rule, device) pairs: {engine.pairs}, load: {load_seconds * 1000:.1f} ms")
+    print(f"readings:    {readings} in {elapsed:.3f} s ({readings / elapsed:,.0f}/s)")
+    print(f"evaluations: {engine.evaluations} ({engine.evaluations / elapsed:,.0f}/s)")
+    print(f"transitions: {transitions} (raised {engine.raised}, cleared {engine.cleared}, "
+          f"suppressed {engine.suppressed})")
+
+
+if __name__ == "__main__":
+    main()
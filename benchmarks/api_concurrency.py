@@ -0,0 +1,107 @@
+"""
+Concurrency benchmark for the FastAPI services.
+
+Runs a closed loop of N concurrent clients against one or more endpoints of a
+running service (for example dataprovider from the docker-compose stack) and
+reports requests/sec and latency percentiles for each concurrency level. With
+database calls blocking the event loop, p99 grows with concurrency even though
+the database is idle; with them offloaded it should stay flat until the
+connection pool is saturated.
+
+Usage (from the repository root):
+    python -m benchmarks.api_concurrency --token "$TOKEN" \
+        --url http://localhost:5003/device/<device_id>/value1 \
+        --concurrency 1 10 100 --duration 20 --output results.json
+
+Get a token from usermanagement's /signin first; the device must belong to
+that user.
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from benchmarks.stats import percentiles
+
+
+async def client_loop(client: httpx.AsyncClient, urls: list, offset: int, deadline: float, latencies: list,
+                      errors: dict):
+    position = offset
+    while time.perf_counter() < deadline:
+        url = urls[position % len(urls)]
+        position += 1
+        started = time.perf_counter()
+        try:
+            response = await client.get(url)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        if status == 200:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+
+
+async def run_level(args, concurrency: int) -> dict:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    headers = {"Authorization": f"Bearer {args.token}"}
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=args.timeout) as client:
+        # Warm up connections and caches before measuring
+        warmup_deadline = time.perf_counter() + args.warmup
+        await asyncio.gather(*[
+            client_loop(client, args.url, i, warmup_deadline, [], {}) for i in range(concurrency)
+        ])
+
+        latencies = []
+        errors = {}
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*[
+            client_loop(client, args.url, i, deadline, latencies, errors) for i in range(concurrency)
+        ])
+        elapsed = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_second": len(latencies) / elapsed,
+        "latency_seconds": percentiles(latencies),
+    }
+
+
+async def run(args) -> list:
+    results = []
+    for concurrency in args.concurrency:
+        result = await run_level(args, concurrency)
+        latency = result["latency_seconds"]
+        print(
+            f"concurrency {concurrency:4d}: {result['requests_per_second']:8.1f} req/s, "
+            f"p50 {latency.get('p50', 0) * 1000:7.2f} ms, p99 {latency.get('p99', 0) * 1000:7.2f} ms, "
+            f"errors {sum(result['errors'].values())}"
+        )
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", nargs="+", required=True, help="Endpoint(s) to GET, used round-robin")
+    parser.add_argument("--token", required=True, help="Bearer token sent with every request")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--duration", type=float, default=20, help="Measured seconds per concurrency level")
+    parser.add_argument("--warmup", type=float, default=3, help="Unmeasured seconds before each level")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--output", help="Write results to this file as JSON")
+    args = parser.parse_args()
+
+    results = {"url": args.url, "levels": asyncio.run(run(args))}
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps(results, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+End-to-end load generator for the ingestion stack.
+
+Simulates a fleet of devices against a running mosquitto + MongoDB (for example
+the docker-compose stack) and measures:
+
+- sustained ingest throughput (readings that reached the telemetry history)
+- end-to-end latency, publish to visible on the device document (percentiles)
+- health-state detection latency: how long after its last heartbeat a silent
+  device is marked disconnected
+
+The fleet is provisioned directly in the devices collection before the run and
+removed afterwards (unless --keep). Results are written as JSON.
+
+Usage (from the repository root):
+    python -m benchmarks.fleet_loadgen --devices 10000 --data-rate 5000 --duration 60 \
+        --output results.json
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import paho.mqtt.client as mqtt
+from pymongo import MongoClient
+
+from benchmarks.stats import percentiles
+from common.payload import encode_data, encode_health
+from common.telemetry import BUCKETS_COLLECTION
+
+DRAIN_POLL_SECONDS = 0.5
+
+
+class Fleet:
+    def __init__(self, args):
+        self.args = args
+        self.mongo = MongoClient(args.mongo_url)
+        self.db = self.mongo[args.db]
+        self.devices = self.db["devices"]
+        self.device_ids = [f"{args.prefix}{i:07d}" for i in range(args.devices)]
+        # Latency is sampled on devices that get no other data traffic, so a
+        # newer reading can never be mistaken for the sampled one
+        self.latency_ids = self.device_ids[:args.latency_devices]
+        self.data_ids = self.device_ids[args.latency_devices:]
+        # A few devices stop sending heartbeats mid-run to measure detection latency
+        self.probe_ids = set(random.sample(self.device_ids, min(args.health_probes, len(self.device_ids))))
+        self.probes_stopped = threading.Event()
+        self.last_heartbeat = {}
+        self.published = {"data": 0, "health": 0, "latency": 0}
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+    def provision(self) -> float:
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        self.devices.delete_many({"device_id": {"$regex": f"^{self.args.prefix}"}})
+        for offset in range(0, len(self.device_ids), 10_000):
+            self.devices.insert_many(
+                [
+                    {
+                        "device_id": device_id,
+                        "user_id": "loadgen",
+                        "device_name": "LoadGen",
+                        "device_type": "Simulated",
+                        "status": "connected",
+                        "created_at": now,
+                        "health_timestamp": now,
+                        "value1": 0,
+                        "value2": 0,
+                        "value3": 0,
+                        "battery_percentage": 100,
+                        "data_timestamp": 0,
+                    }
+                    for device_id in self.device_ids[offset:offset + 10_000]
+                ],
+                ordered=False,
+            )
+        return time.perf_counter() - started
+
+    def cleanup(self):
+        query = {"device_id": {"$regex": f"^{self.args.prefix}"}}
+        self.devices.delete_many(query)
+        for name in self.db.list_collection_names():
+            if name.startswith("telemetry_"):
+                self.db[name].delete_many(query)
+
+    def connect(self, index: int) -> mqtt.Client:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=f"{self.args.prefix}pub-{index}")
+        client.max_queued_messages_set(0)
+        client.connect(self.args.mqtt_host, self.args.mqtt_port, 60)
+        client.loop_start()
+        return client
+
+    def payload(self, now_ms: int) -> bytes:
+        values = (random.uniform(0, 100), random.uniform(0, 100), random.uniform(900, 1100))
+        if self.args.binary:
+            return encode_data(now_ms, *values)
+        return json.dumps(
+            {"value1": values[0], "value2": values[1], "value3": values[2], "data_timestamp": now_ms}
+        ).encode("utf-8")
+
+    def publish_data(self, index: int, device_ids: list):
+        """
+        Publish data messages for a slice of the fleet at its share of --data-rate.
+        """
+        client = self.connect(index)
+        rate = self.args.data_rate / self.args.connections
+        tick = 0.01
+        per_tick = rate * tick
+        budget = 0.0
+        position = 0
+        next_tick = time.monotonic()
+        while not self.stop.is_set():
+            budget += per_tick
+            sent = 0
+            while budget >= 1:
+                device_id = device_ids[position % len(device_ids)]
+                position += 1
+                now_ms = int(time.time() * 1000)
+                client.publish(f"devices/{device_id}/data", self.payload(now_ms))
+                budget -= 1
+                sent += 1
+            with self.lock:
+                self.published["data"] += sent
+            next_tick += tick
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+        client.loop_stop()
+        client.disconnect()
+
+    def publish_health(self):
+        """
+        Send one heartbeat per device every --health-interval seconds.
+        """
+        client = self.connect(self.args.connections)
+        while not self.stop.is_set():
+            round_started = time.monotonic()
+            for device_id in self.device_ids:
+                if device_id in self.probe_ids and self.probes_stopped.is_set():
+                    continue
+                if self.args.binary:
+                    payload = encode_health(device_id, "connected", 90)
+                else:
+                    payload = json.dumps(
+                        {"device_id": device_id, "status": "connected", "battery_percentage": 90}
+                    )
+                client.publish("device/health", payload)
+                if device_id in self.probe_ids:
+                    self.last_heartbeat[device_id] = time.time()
+                with self.lock:
+                    self.published["health"] += 1
+                if self.stop.is_set():
+                    break
+            elapsed = time.monotonic() - round_started
+            self.stop.wait(max(0.0, self.args.health_interval - elapsed))
+        client.loop_stop()
+        client.disconnect()
+
+    def sample_latency(self, samples: list):
+        """
+        Publish a marked reading for a random device and time until it is visible.
+        """
+        client = self.connect(self.args.connections + 1)
+        while not self.stop.is_set():
+            device_id = random.choice(self.latency_ids)
+            # Always JSON so data_timestamp keeps millisecond precision
+            published_ms = int(time.time() * 1000)
+            client.publish(f"devices/{device_id}/data", json.dumps({"value1": 0, "data_timestamp": published_ms}))
+            with self.lock:
+                self.published["latency"] += 1
+            deadline = time.time() + self.args.latency_timeout
+            while time.time() < deadline and not self.stop.is_set():
+                device = self.devices.find_one({"device_id": device_id}, {"_id": 0, "data_timestamp": 1})
+                if device and device.get("data_timestamp", 0) >= published_ms:
+                    samples.append(time.time() - published_ms / 1000)
+                    break
+                time.sleep(0.002)
+            self.stop.wait(self.args.latency_interval)
+        client.loop_stop()
+        client.disconnect()
+
+    def ingested_since(self, started: datetime) -> int:
+        pipeline = [
+            {"$match": {
+                "device_id": {"$regex": f"^{self.args.prefix}"},
+                "start": {"$gte": started - timedelta(hours=1)},
+            }},
+            {"$group": {"_id": None, "count": {"$sum": "$count"}}},
+        ]
+        result = list(self.db[BUCKETS_COLLECTION].aggregate(pipeline))
+        return result[0]["count"] if result else 0
+
+    def wait_for_ingest(self, started: datetime, expected: int) -> tuple:
+        """
+        Poll the history until it holds expected readings, stops growing for
+        --drain-idle seconds, or --drain seconds have passed.
+
+        Returns:
+        - tuple: Readings ingested since started and the monotonic time of the last increase
+        """
+        deadline = time.monotonic() + self.args.drain
+        count = self.ingested_since(started)
+        last_increase = time.monotonic()
+        while count < expected and time.monotonic() < deadline:
+            if time.monotonic() - last_increase >= self.args.drain_idle:
+                break
+            time.sleep(DRAIN_POLL_SECONDS)
+            current = self.ingested_since(started)
+            if current > count:
+                count, last_increase = current, time.monotonic()
+        return count, last_increase
+
+    def health_detection(self) -> list:
+        """
+        Stop heartbeats for the probe devices and wait until each is disconnected.
+        """
+        self.probes_stopped.set()
+        pending = set(self.probe_ids)
+        latencies = []
+        deadline = time.time() + self.args.health_timeout
+        while pending and time.time() < deadline:
+            for device in self.devices.find(
+                {"device_id": {"$in": list(pending)}, "status": "disconnected"}, {"_id": 0, "device_id": 1}
+            ):
+                device_id = device["device_id"]
+                pending.discard(device_id)
+                if device_id in self.last_heartbeat:
+                    latencies.append(time.time() - self.last_heartbeat[device_id])
+            time.sleep(0.1)
+        return latencies, len(pending)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mqtt-host", default="localhost")
+    parser.add_argument("--mqtt-port", type=int, default=1884)
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="mydatabase")
+    parser.add_argument("--devices", type=int, default=10_000, help="Simulated fleet size")
+    parser.add_argument("--data-rate", type=float, default=5_000, help="Data messages per second, whole fleet")
+    parser.add_argument("--health-interval", type=float, default=10, help="Seconds between heartbeats per device")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds of sustained load")
+    parser.add_argument("--connections", type=int, default=4, help="MQTT connections used for data")
+    parser.add_argument("--binary", action="store_true", help="Publish compact binary frames instead of JSON")
+    parser.add_argument("--settle", type=float, default=10, help="Seconds to wait for services to see new devices")
+    parser.add_argument("--drain", type=float, default=15, help="Longest wait for ingestion to catch up")
+    parser.add_argument("--drain-idle", type=float, default=3, help="Ingestion counts as done after this long without progress")
+    parser.add_argument("--latency-devices", type=int, default=50, help="Devices reserved for latency sampling")
+    parser.add_argument("--latency-interval", type=float, default=0.05)
+    parser.add_argument("--latency-timeout", type=float, default=10)
+    parser.add_argument("--health-probes", type=int, default=20)
+    parser.add_argument("--health-timeout", type=float, default=180)
+    parser.add_argument("--prefix", default="loadgen-")
+    parser.add_argument("--keep", action="store_true", help="Keep the simulated devices after the run")
+    parser.add_argument("--output", help="Write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    fleet = Fleet(args)
+    provision_seconds = fleet.provision()
+    time.sleep(args.settle)
+
+    started_at = datetime.now(timezone.utc)
+    baseline = fleet.ingested_since(started_at)
+    data_ids = fleet.data_ids
+    latency_samples = []
+    threads = [
+        threading.Thread(target=fleet.publish_data, args=(i, data_ids[i::args.connections]), daemon=True)
+        for i in range(args.connections)
+    ]
+    threads.append(threading.Thread(target=fleet.publish_health, daemon=True))
+    threads.append(threading.Thread(target=fleet.sample_latency, args=(latency_samples,), daemon=True))
+
+    run_started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    fleet.stop.set()
+    for thread in threads:
+        thread.join()
+    publish_seconds = time.monotonic() - run_started
+
+    # Let ingestion drain; the rate runs until the last reading landed, not until we stopped waiting
+    published_data = fleet.published["data"] + fleet.published["latency"]
+    total, last_increase = fleet.wait_for_ingest(started_at, baseline + published_data)
+    ingested = total - baseline
+    ingest_seconds = max(last_increase - run_started, publish_seconds)
+    drain_lag_seconds = ingest_seconds - publish_seconds
+
+    # Health detection runs after the load so it measures the detector, not a backlog
+    fleet.stop.clear()
+    health_thread = threading.Thread(target=fleet.publish_health, daemon=True)
+    health_thread.start()
+    time.sleep(args.health_interval * 2)
+    health_latencies, undetected = fleet.health_detection()
+    fleet.stop.set()
+    health_thread.join()
+
+    results = {
+        "started_at": started_at.isoformat(),
+        "config": {
+            "devices": args.devices,
+            "data_rate": args.data_rate,
+            "health_interval": args.health_interval,
+            "duration": args.duration,
+            "connections": args.connections,
+            "payload": "binary" if args.binary else "json",
+        },
+        "provision_seconds": provision_seconds,
+        "published": dict(fleet.published),
+        "publish_rate": published_data / publish_seconds,
+        "ingested": ingested,
+        "ingest_rate": ingested / ingest_seconds,
+        "drain_lag_seconds": drain_lag_seconds,
+        "ingest_ratio": ingested / published_data if published_data else 0,
+        "e2e_latency_seconds": percentiles(latency_samples),
+        "health_detection_seconds": percentiles(health_latencies),
+        "health_undetected": undetected,
+    }
+
+    if not args.keep:
+        fleet.cleanup()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Login storm benchmark for usermanagement.
+
+Creates a test account, then runs N concurrent clients that sign in in a
+closed loop while a separate prober calls /me at a fixed rate with a valid
+token. Reports sign-ins per second, how many were turned away with 503
+(password hashing saturated), and /me latency percentiles. /me does no
+password work, so its latency shows whether bcrypt is blocking the event loop.
+
+Usage (from the repository root):
+    python -m benchmarks.login_load --url http://localhost:5001 \
+        --concurrency 50 --duration 30 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import httpx
+
+from benchmarks.stats import percentiles
+
+
+async def signin_loop(client: httpx.AsyncClient, account: dict, deadline: float, latencies: list, statuses: dict):
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            status = (await client.post("/signin", json=account)).status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if status == 200:
+            latencies.append(time.perf_counter() - started)
+        elif status == 503:
+            await asyncio.sleep(0.05)
+
+
+async def probe_me(client: httpx.AsyncClient, token: str, interval: float, deadline: float, latencies: list):
+    headers = {"Authorization": f"Bearer {token}"}
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        response = await client.get("/me", headers=headers)
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(max(0.0, interval - (time.perf_counter() - started)))
+
+
+async def run(args) -> dict:
+    account = {
+        "username": "loadtest",
+        "email": f"loadtest-{uuid.uuid4().hex[:12]}@example.com",
+        "password": "correct horse battery staple",
+    }
+    limits = httpx.Limits(max_connections=args.concurrency + 1)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        (await client.post("/signup", json=account)).raise_for_status()
+        response = await client.post("/signin", json=account)
+        response.raise_for_status()
+        token = response.json()["access_token"]
+
+        # Baseline /me latency with no sign-in load
+        idle = []
+        await probe_me(client, token, args.probe_interval, time.perf_counter() + args.baseline, idle)
+
+        signins, statuses, loaded = [], {}, []
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(
+            probe_me(client, token, args.probe_interval, deadline, loaded),
+            *[signin_loop(client, account, deadline, signins, statuses) for _ in range(args.concurrency)],
+        )
+        elapsed = time.perf_counter() - started
+
+    return {
+        "concurrency": args.concurrency,
+        "duration": elapsed,
+        "signins_per_second": len(signins) / elapsed,
+        "signin_statuses": statuses,
+        "signin_latency_seconds": percentiles(signins),
+        "me_latency_idle_seconds": percentiles(idle),
+        "me_latency_under_load_seconds": percentiles(loaded),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5001")
+    parser.add_argument("--concurrency", type=int, default=50, help="Concurrent sign-in clients")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of sign-in load")
+    parser.add_argument("--baseline", type=float, default=5, help="Seconds of /me probing before the load")
+    parser.add_argument("--probe-interval", type=float, default=0.05, help="Seconds between /me probes")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="Write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    output = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Download benchmark for otafilehosting.
+
+Fetches a signed URL for one firmware image, then runs N concurrent clients that
+download it repeatedly. A share of the downloads drop the connection part way
+through and resume with Range/If-Range, the way a device on a flaky cellular
+link would, and every completed download is revalidated with If-None-Match.
+Each body is checked against the sha256 from the catalog. HEAD requests on the
+download URL must not hold a download slot: after the run every client is idle,
+so /rollouts has to report no download in flight.
+
+Reports throughput, the bytes that resumption and revalidation saved compared
+to restarting from byte zero, and, given the PIDs of the server processes on
+the same host, server CPU seconds per GB served (compare `python main.py`
+against the gunicorn/sendfile setup of the Dockerfile).
+
+Usage (from the repository root):
+    python -m benchmarks.ota_download --url http://localhost:5004 --token "$TOKEN" \
+        --device-id "$ENCRYPTED_DEVICE_ID" --concurrency 8 --downloads 200 \
+        --server-pid $(pgrep -f "gunicorn.*main:app") --output results.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import time
+from urllib.parse import urlparse
+
+import httpx
+
+from benchmarks.stats import percentiles
+
+READ_SIZE = 64 * 1024
+
+
+def cpu_seconds(pids: list) -> float:
+    # utime + stime of each process, from /proc (Linux only)
+    total = 0
+    for pid in pids:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+async def fetch(client: httpx.AsyncClient, url: str, headers: dict, digest, stop_after: int = None):
+    """
+    Returns:
+    - tuple: Status code and the number of body bytes read
+    """
+    received = 0
+    async with client.stream("GET", url, headers=headers) as response:
+        if response.status_code not in (200, 206):
+            return response.status_code, 0
+        async for chunk in response.aiter_raw(READ_SIZE):
+            digest.update(chunk)
+            received += len(chunk)
+            if stop_after is not None and received >= stop_after:
+                # Drop the connection mid-body
+                break
+        return response.status_code, received
+
+
+async def client_loop(client: httpx.AsyncClient, url: str, image: dict, jobs: list, args, totals: dict,
+                      latencies: list):
+    etag = f'"{image["sha256"]}"'
+    size = image["size"]
+    while jobs:
+        interrupted = jobs.pop()
+        started = time.perf_counter()
+        digest = hashlib.sha256()
+        try:
+            status, received = await fetch(
+                client, url, {}, digest, int(size * args.interrupt_at) if interrupted else None
+            )
+            totals["bytes"] += received
+            if interrupted and status == 200 and received < size:
+                status, rest = await fetch(
+                    client, url, {"Range": f"bytes={received}-", "If-Range": etag}, digest
+                )
+                totals["bytes"] += rest
+                if status == 206:
+                    totals["resumed"] += 1
+                    totals["saved_by_resume"] += received
+                received += rest
+            if status not in (200, 206):
+                totals["errors"][str(status)] = totals["errors"].get(str(status), 0) + 1
+                continue
+            if received != size or digest.hexdigest() != image["sha256"]:
+                totals["corrupt"] += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+            # The device checks again later and already has this image
+            response = await client.get(url, headers={"If-None-Match": etag})
+            if response.status_code == 304:
+                totals["not_modified"] += 1
+                totals["saved_by_revalidation"] += size
+        except httpx.HTTPError as e:
+            totals["errors"][type(e).__name__] = totals["errors"].get(type(e).__name__, 0) + 1
+
+
+async def run(args) -> dict:
+    headers = {"Authorization": f"Bearer {args.token}"}
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=args.timeout) as client:
+        response = await client.post(f"{args.url}/get-ota-files", json={"deviceID": args.device_id})
+        response.raise_for_status()
+        images = response.json()["files"]
+        image = next((f for f in images if f["name"] == args.file), None) if args.file else images[0]
+        if image is None:
+            raise SystemExit(f"{args.file} is not in the catalog: {[f['name'] for f in images]}")
+        # Signed URLs carry the public BASE_URL; keep the path and target --url instead
+        url = args.url + urlparse(image["url"]).path
+
+        rng = random.Random(args.seed)
+        jobs = [rng.random() < args.interrupt_rate for _ in range(args.downloads)]
+        totals = {"bytes": 0, "resumed": 0, "saved_by_resume": 0, "not_modified": 0,
+                  "saved_by_revalidation": 0, "corrupt": 0, "errors": {}}
+        latencies = []
+
+        cpu_before = cpu_seconds(args.server_pid) if args.server_pid else None
+        started = time.perf_counter()
+        heads = await asyncio.gather(*[client.head(url) for _ in range(args.heads)])
+        await asyncio.gather(*[
+            client_loop(client, url, image, jobs, args, totals, latencies) for _ in range(args.concurrency)
+        ])
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds(args.server_pid) - cpu_before if args.server_pid else None
+
+        response = await client.get(f"{args.url}/rollouts")
+        response.raise_for_status()
+        in_flight_after = response.json()["admission"]["in_flight"]
+
+    gigabytes = totals["bytes"] / 1e9
+    return {
+        "image": {"name": image["name"], "size": image["size"]},
+        "concurrency": args.concurrency,
+        "downloads": len(latencies),
+        "elapsed_seconds": elapsed,
+        "bytes_served": totals["bytes"],
+        "megabytes_per_second": totals["bytes"] / 1e6 / elapsed,
+        "server_cpu_seconds": cpu,
+        "server_cpu_seconds_per_gb": cpu / gigabytes if cpu is not None and gigabytes else None,
+        "resumed": totals["resumed"],
+        "bytes_saved_by_resume": totals["saved_by_resume"],
+        "not_modified": totals["not_modified"],
+        "bytes_saved_by_revalidation": totals["saved_by_revalidation"],
+        "corrupt": totals["corrupt"],
+        "errors": totals["errors"],
+        "download_seconds": percentiles(latencies),
+        "head_requests": sum(1 for response in heads if response.status_code == 200),
+        "in_flight_after": in_flight_after,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", required=True, help="Base URL of otafilehosting")
+    parser.add_argument("--token", required=True, help="Bearer token of the device owner")
+    parser.add_argument("--device-id", required=True, help="Encrypted device ID, as sent to /get-ota-files")
+    parser.add_argument("--file", help="Image to download, defaults to the first one in the catalog")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--downloads", type=int, default=100)
+    parser.add_argument("--interrupt-rate", type=float, default=0.5, help="Share of downloads that drop and resume")
+    parser.add_argument("--interrupt-at", type=float, default=0.5, help="Fraction of the image read before dropping")
+    parser.add_argument("--server-pid", type=int, nargs="*", help="Server PIDs to measure CPU time of")
+    parser.add_argument("--heads", type=int, default=32, help="HEAD requests sent before the downloads")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", help="Write results to this file as JSON")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    cpu_per_gb = results["server_cpu_seconds_per_gb"]
+    print(
+        f"{results['downloads']} downloads of {results['image']['size'] / 1e6:.1f} MB in "
+        f"{results['elapsed_seconds']:.1f} s ({results['megabytes_per_second']:.1f} MB/s), "
+        f"server CPU {f'{cpu_per_gb:.2f} s/GB' if cpu_per_gb is not None else 'not measured'}\n"
+        f"resumed {results['resumed']} (saved {results['bytes_saved_by_resume'] / 1e6:.1f} MB), "
+        f"304s {results['not_modified']} (saved {results['bytes_saved_by_revalidation'] / 1e6:.1f} MB), "
+        f"corrupt {results['corrupt']}, errors {sum(results['errors'].values())}, "
+        f"in flight after the run {results['in_flight_after']}"
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps(results, indent=2) + "\n")
+    # Download slots that are never given back end up refusing every device with 503
+    if results["in_flight_after"]:
+        raise SystemExit(f"{results['in_flight_after']} download slots still held after the run")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Micro-benchmark: JSON vs compact binary payload decoding.
+
+Compares decode cost and bytes on the wire for the devices/<id>/data and
+device/health payloads, using the same decoders the services use.
+
+Usage (from the repository root):
+    python -m benchmarks.payload_decode [--iterations 200000]
+"""
+import argparse
+import json
+import timeit
+
+from common.payload import decode_data, decode_health, encode_data, encode_health
+
+DEVICE_ID = "gAAAAABnO2xk1Qy8bT3Jt9cYQ0T3Xk8P2m0a7s4L9vW1eR6uI3oZ5nH8gF2dJ4kC7xB0"
+
+
+def sample_payloads():
+    data = {"value1": 23.5, "value2": 41.25, "value3": 1013.0, "data_timestamp": 1732960000000}
+    health = {"device_id": DEVICE_ID, "status": "connected", "battery_percentage": 87}
+    return {
+        "data": (
+            json.dumps(data).encode("utf-8"),
+            encode_data(data["data_timestamp"], data["value1"], data["value2"], data["value3"]),
+            decode_data,
+        ),
+        "health": (
+            json.dumps(health).encode("utf-8"),
+            encode_health(health["device_id"], health["status"], health["battery_percentage"]),
+            decode_health,
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200_000)
+    args = parser.parse_args()
+
+    print(f"{'payload':<8} {'format':<7} {'bytes':>6} {'ns/decode':>10}")
+    for name, (json_payload, binary_payload, decode) in sample_payloads().items():
+        results = {}
+        for fmt, payload in (("json", json_payload), ("binary", binary_payload)):
+            seconds = timeit.timeit(lambda: decode(payload), number=args.iterations)
+            results[fmt] = seconds / args.iterations * 1e9
+            print(f"{name:<8} {fmt:<7} {len(payload):>6} {results[fmt]:>10.0f}")
+        print(
+            f"{name:<8} binary is {results['json'] / results['binary']:.1f}x faster and "
+            f"{len(json_payload) / len(binary_payload):.1f}x smaller"
+        )
+
+
+if __name__ == "__main__":
+    main()
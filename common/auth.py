@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import jwt
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+class JWTAuth:
+    """
+    JWT signing and verification with a cache of verified tokens.
+
+    Clients send the same bearer token on every request, so once a token has
+    passed signature and expiry checks its claims are kept in a bounded LRU,
+    keyed by a digest of the token (raw tokens are not held in memory). A cached
+    entry is only used until the token's exp, and never longer than max_age
+    seconds. Tokens that fail verification are not cached.
+
+    Parameters:
+    - secret (str): HMAC key
+    - algorithm (str): JWT algorithm, e.g. HS256
+    - max_entries (int): Capacity of the verified-token cache
+    - max_age (float): Upper bound on how long a verified token is cached
+    - stats_interval (float): Seconds between stats log lines, 0 to disable
+    """
+
+    def __init__(self, secret: str, algorithm: str = "HS256", max_entries: int = 10000, max_age: float = 300,
+                 stats_interval: float = 60):
+        self.secret = secret
+        self.algorithm = algorithm
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+        self._cache = OrderedDict()  # digest -> (valid_until, claims)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.verify_seconds = 0.0
+
+        if stats_interval:
+            threading.Thread(target=self._report_stats, args=(stats_interval,), name="token-stats",
+                             daemon=True).start()
+
+    def encode(self, claims: dict) -> str:
+        return jwt.encode(claims, self.secret, algorithm=self.algorithm)
+
+    def verify(self, token: str) -> dict:
+        """
+        Verify a token and return its claims.
+
+        Raises:
+        - InvalidToken: Bad signature, malformed or expired
+        """
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(digest)
+            if entry is not None:
+                if entry[0] > now:
+                    self._cache.move_to_end(digest)
+                    self.hits += 1
+                    return dict(entry[1])
+                del self._cache[digest]
+
+        started = time.perf_counter()
+        try:
+            claims = jwt.decode(token, self.secret, algorithms=[self.algorithm])
+        except jwt.InvalidTokenError as e:
+            self.failures += 1
+            raise InvalidToken("Invalid token") from e
+        finally:
+            self.verify_seconds += time.perf_counter() - started
+
+        valid_until = now + self.max_age
+        if "exp" in claims:
+            valid_until = min(valid_until, float(claims["exp"]))
+        with self._lock:
+            self.misses += 1
+            self._cache[digest] = (valid_until, claims)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return dict(claims)
+
+    def verify_bearer(self, authorization: str) -> dict:
+        """
+        Verify the token of an "Authorization: Bearer <token>" header value.
+        """
+        scheme, _, token = (authorization or "").partition(" ")
+        if scheme.lower() != "bearer" or not token.strip():
+            raise InvalidToken("Authorization token is required")
+        return self.verify(token.strip())
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.failures
+        verified = self.misses + self.failures
+        return {
+            "entries": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "failures": self.failures,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "mean_verify_us": self.verify_seconds / verified * 1e6 if verified else 0.0,
+        }
+
+    def _report_stats(self, interval: float):
+        while True:
+            time.sleep(interval)
+            stats = self.stats()
+            logging.info(
+                f"Token cache: {stats['entries']} entries, hit ratio {stats['hit_ratio']:.1%} "
+                f"({stats['hits']} hits, {stats['misses']} verified, {stats['failures']} rejected), "
+                f"mean verification {stats['mean_verify_us']:.0f} us"
+            )
@@ -0,0 +1,198 @@
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from bson import json_util
+
+from common.telemetry import as_utc
+from common.updates import cache_key
+
+
+def _is_older(fields: dict, document: dict) -> bool:
+    new, current = fields.get("received_at"), document.get("received_at")
+    return new is not None and current is not None and as_utc(new) < as_utc(current)
+
+
+def _estimate_size(document: dict) -> int:
+    return sys.getsizeof(document) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in document.items())
+
+
+class LatestValueCache:
+    """
+    Read-through cache of device documents.
+
+    The first tier is an in-process LRU with a TTL; the optional second tier is
+    Redis, shared between processes. Entries are kept current by apply_updates()
+    with the values the ingestion path just wrote, so a device that keeps
+    publishing stays cached and is rarely read from MongoDB again.
+
+    A read-through load can race with an update: the document it read may be
+    older than a value written and announced while the load ran. A loaded
+    document is only cached if no update for the device arrived meanwhile;
+    otherwise it is returned uncached and the next lookup reads again. The TTL
+    bounds staleness if an update message is lost, or if another process fills
+    Redis after an update it has not heard of yet.
+
+    Parameters:
+    - loader (callable): device_id -> document or None (the MongoDB lookup)
+    - max_entries (int): In-process capacity; least recently used entries are evicted
+    - ttl_seconds (float): Lifetime of an entry without updates
+    - redis_client: Optional Redis client for the shared tier
+    - stats_interval (float): Seconds between stats log lines, 0 to disable
+    """
+
+    def __init__(self, loader, max_entries: int = 10000, ttl_seconds: float = 30, redis_client=None,
+                 stats_interval: float = 60):
+        self.loader = loader
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.redis = redis_client
+
+        self._entries = OrderedDict()  # device_id -> (expires_at, document, size)
+        self._loading = {}  # device_id -> [loads in progress, updated since the oldest began]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory_bytes = 0
+
+        if stats_interval:
+            threading.Thread(target=self._report_stats, args=(stats_interval,), name="cache-stats",
+                             daemon=True).start()
+
+    def get(self, device_id: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(device_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(device_id)
+                self.hits += 1
+                return entry[1]
+            loading = self._loading.setdefault(device_id, [0, False])
+            loading[0] += 1
+
+        try:
+            document = self._get_shared(device_id)
+            if document is not None:
+                self.redis_hits += 1
+            else:
+                self.misses += 1
+                document = self.loader(device_id)
+                if document is not None and not loading[1]:
+                    self._set_shared(device_id, document)
+        except Exception:
+            self._finish_load(device_id, loading)
+            raise
+        if document is None:
+            self._finish_load(device_id, loading)
+            return None
+        self._store(device_id, document, loading)
+        return document
+
+    def apply_updates(self, updates: dict):
+        """
+        Apply freshly written fields (device_id -> fields, or None to drop the device).
+        """
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            for device_id, fields in updates.items():
+                loading = self._loading.get(device_id)
+                if loading is not None:
+                    loading[1] = True
+                entry = self._entries.get(device_id)
+                if entry is None:
+                    continue
+                if fields is None:
+                    self._remove(device_id)
+                    continue
+                if _is_older(fields, entry[1]):
+                    # A late write (spool replay) that MongoDB's guard also rejected
+                    continue
+                document = dict(entry[1])
+                document.update(fields)
+                self._entries[device_id] = (expires_at, document, entry[2])
+
+    def invalidate(self, device_id: str):
+        with self._lock:
+            if device_id in self._loading:
+                self._loading[device_id][1] = True
+            self._remove(device_id)
+
+    def clear(self):
+        with self._lock:
+            for loading in self._loading.values():
+                loading[1] = True
+            self._entries.clear()
+            self.memory_bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.redis_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits + self.redis_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "memory_bytes": self.memory_bytes,
+        }
+
+    def _store(self, device_id: str, document: dict, loading: list):
+        size = _estimate_size(document)
+        with self._lock:
+            self._finish_load_locked(device_id, loading)
+            if loading[1]:
+                # What was read may be older than the update; the next lookup reads again
+                return
+            self._remove(device_id)
+            self._entries[device_id] = (time.monotonic() + self.ttl, document, size)
+            self.memory_bytes += size
+            while len(self._entries) > self.max_entries:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.memory_bytes -= evicted_size
+                self.evictions += 1
+
+    def _finish_load(self, device_id: str, loading: list):
+        with self._lock:
+            self._finish_load_locked(device_id, loading)
+
+    def _finish_load_locked(self, device_id: str, loading: list):
+        loading[0] -= 1
+        if loading[0] == 0 and self._loading.get(device_id) is loading:
+            del self._loading[device_id]
+
+    def _remove(self, device_id: str):
+        entry = self._entries.pop(device_id, None)
+        if entry is not None:
+            self.memory_bytes -= entry[2]
+
+    def _get_shared(self, device_id: str):
+        if self.redis is None:
+            return None
+        try:
+            data = self.redis.get(cache_key(device_id))
+            return json_util.loads(data) if data else None
+        except Exception as e:
+            logging.warning(f"Redis cache read failed for {device_id}: {e}")
+            return None
+
+    def _set_shared(self, device_id: str, document: dict):
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(cache_key(device_id), json_util.dumps(document), ex=int(self.ttl))
+        except Exception as e:
+            logging.warning(f"Redis cache write failed for {device_id}: {e}")
+
+    def _report_stats(self, interval: float):
+        while True:
+            time.sleep(interval)
+            stats = self.stats()
+            logging.info(
+                f"Device cache: {stats['entries']} entries, hit ratio {stats['hit_ratio']:.1%} "
+                f"({stats['hits']} local, {stats['redis_hits']} redis, {stats['misses']} misses), "
+                f"{stats['evictions']} evictions, ~{stats['memory_bytes'] / 1024:.0f} KiB"
+            )
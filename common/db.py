@@ -0,0 +1,41 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient
+
+# Connection settings, shared by the API services
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://mongodb:27017")
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "mydatabase")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "5"))
+# How long a request may wait for a free connection before failing
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000"))
+
+client = MongoClient(
+    MONGO_URL,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+)
+db = client[MONGO_DB_NAME]
+
+# One thread per pooled connection: blocking calls never queue for a connection
+# inside a thread, and the event loop never runs them itself
+_executor = ThreadPoolExecutor(max_workers=MONGO_MAX_POOL_SIZE, thread_name_prefix="mongo")
+
+
+async def run_db(function, *args, **kwargs):
+    """
+    Run a blocking database call on the database thread pool.
+
+    Parameters:
+    - function (callable): The pymongo call, or a helper that makes several
+    - args, kwargs: Passed through to function
+
+    Returns:
+    - Whatever function returns; cursors must be consumed inside function
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(function, *args, **kwargs))
@@ -0,0 +1,104 @@
+import logging
+import time
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import PyMongoError
+
+from common.telemetry import BUCKETS_COLLECTION, ROLLUPS
+
+# Every index the services query through, per collection. Unique where the code
+# relies on uniqueness instead of checking before it inserts.
+INDEXES = {
+    "devices": [
+        IndexModel([("device_id", ASCENDING)], unique=True),
+        # Keyset pagination of a user's devices
+        IndexModel([("user_id", ASCENDING), ("_id", ASCENDING)]),
+        # Stale-device sweep; device_id is included so the find is covered by the index
+        IndexModel([("status", ASCENDING), ("health_timestamp", ASCENDING), ("device_id", ASCENDING)]),
+        # Device registry refresh picks up devices created since its watermark
+        IndexModel([("created_at", ASCENDING)]),
+    ],
+    "users": [
+        IndexModel([("email", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING)], unique=True),
+    ],
+    "alert_rules": [
+        IndexModel([("rule_id", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING)]),
+    ],
+    # One alert document per (rule, device)
+    "alerts": [
+        IndexModel([("rule_id", ASCENDING), ("device_id", ASCENDING)], unique=True),
+        IndexModel([("user_id", ASCENDING), ("active", ASCENDING), ("raised_at", DESCENDING)]),
+        IndexModel([("active", ASCENDING)]),
+    ],
+    # One bucket per device per hour, one rollup document per device per window
+    BUCKETS_COLLECTION: [
+        IndexModel([("device_id", ASCENDING), ("start", ASCENDING)], unique=True),
+    ],
+    **{
+        name: [IndexModel([("device_id", ASCENDING), ("start", ASCENDING)], unique=True)]
+        for name, _ in ROLLUPS.values()
+    },
+}
+
+
+def ensure_indexes(db) -> bool:
+    """
+    Create the indexes in INDEXES that do not exist yet. Safe to run from every
+    service at startup: existing indexes are left as they are.
+
+    A collection whose indexes cannot be built (for example a unique index over
+    data that already has duplicates) is logged and skipped, so one bad
+    collection does not keep a service from starting.
+
+    Parameters:
+    - db (Database): The database holding the collections
+
+    Returns:
+    - bool: True if every index exists
+    """
+    ok = True
+    for name, indexes in INDEXES.items():
+        try:
+            db[name].create_indexes(indexes)
+        except PyMongoError as e:
+            ok = False
+            logging.error(f"Could not create the indexes of {name}: {e}")
+    return ok
+
+
+def require_indexes(db, name: str, timeout: float = 60):
+    """
+    ensure_indexes for a service that cannot run without the indexes of one
+    collection, e.g. because it relies on a unique index to reject duplicates.
+
+    Retries with backoff while MongoDB is not reachable yet, and raises if the
+    indexes of that collection still do not exist after timeout seconds (for
+    example because existing documents violate a unique index).
+
+    Parameters:
+    - db (Database): The database holding the collections
+    - name (str): The collection whose indexes are required
+    - timeout (float): Seconds to keep retrying
+
+    Raises:
+    - RuntimeError: If the indexes are still missing after timeout
+    """
+    required = {index.document["name"] for index in INDEXES[name]}
+    deadline = time.monotonic() + timeout
+    delay = 1.0
+    while True:
+        ensure_indexes(db)
+        try:
+            missing = required - set(db[name].index_information())
+        except PyMongoError as e:
+            missing = required
+            logging.error(f"Could not list the indexes of {name}: {e}")
+        if not missing:
+            return
+        if time.monotonic() + delay > deadline:
+            raise RuntimeError(f"Required indexes of {name} are missing: {sorted(missing)}")
+        logging.warning(f"Indexes of {name} are missing ({sorted(missing)}), retrying in {delay:.0f} s")
+        time.sleep(delay)
+        delay = min(delay * 2, 10)
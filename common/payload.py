@@ -0,0 +1,76 @@
+import json
+import struct
+
+# Compact binary frames. The first byte identifies the schema; JSON payloads
+# always start with "{" or whitespace, so any byte >= 0x80 marks a binary frame.
+#
+#   DATA_V1   (devices/<id>/data, 17 bytes):
+#       header:u8  data_timestamp:u32 (epoch seconds)  value1:f32  value2:f32  value3:f32
+#   HEALTH_V1 (device/health, 3 bytes + device_id):
+#       header:u8  status:u8  battery_percentage:u8  device_id:utf-8 (rest of frame)
+#
+# All integers and floats are little-endian. Values are float32, so readings
+# carry roughly 7 significant digits. data_timestamp is decoded to epoch
+# milliseconds, the unit JSON payloads use, so both formats store the same unit.
+DATA_V1 = 0x81
+HEALTH_V1 = 0x82
+
+_DATA_V1 = struct.Struct("<BIfff")
+_HEALTH_V1 = struct.Struct("<BBB")
+
+# Wire codes for the health status field
+STATUS_CODES = {"disconnected": 0, "connected": 1}
+STATUS_NAMES = {code: name for name, code in STATUS_CODES.items()}
+
+
+def is_binary(payload: bytes) -> bool:
+    return bool(payload) and payload[0] >= 0x80
+
+
+def decode_data(payload: bytes) -> dict:
+    """
+    Decode a devices/<id>/data payload, either JSON or a binary frame.
+
+    Parameters:
+    - payload (bytes): The raw MQTT payload
+
+    Returns:
+    - dict: The decoded message
+    """
+    if not is_binary(payload):
+        return json.loads(payload)
+    if payload[0] != DATA_V1 or len(payload) != _DATA_V1.size:
+        raise ValueError(f"Unsupported data frame (header 0x{payload[0]:02x}, {len(payload)} bytes)")
+    _, data_timestamp, value1, value2, value3 = _DATA_V1.unpack(payload)
+    return {"data_timestamp": data_timestamp * 1000, "value1": value1, "value2": value2, "value3": value3}
+
+
+def decode_health(payload: bytes) -> dict:
+    """
+    Decode a device/health payload, either JSON or a binary frame.
+
+    Parameters:
+    - payload (bytes): The raw MQTT payload
+
+    Returns:
+    - dict: The decoded message
+    """
+    if not is_binary(payload):
+        return json.loads(payload)
+    if payload[0] != HEALTH_V1 or len(payload) <= _HEALTH_V1.size:
+        raise ValueError(f"Unsupported health frame (header 0x{payload[0]:02x}, {len(payload)} bytes)")
+    _, status, battery_percentage = _HEALTH_V1.unpack_from(payload)
+    return {
+        "device_id": payload[_HEALTH_V1.size:].decode("utf-8"),
+        "status": STATUS_NAMES.get(status, "unknown"),
+        "battery_percentage": battery_percentage,
+    }
+
+
+def encode_data(data_timestamp: int, value1: float, value2: float, value3: float) -> bytes:
+    # data_timestamp in epoch milliseconds, like decode_data returns it
+    return _DATA_V1.pack(DATA_V1, data_timestamp // 1000, value1, value2, value3)
+
+
+def encode_health(device_id: str, status: str, battery_percentage: int) -> bytes:
+    return _HEALTH_V1.pack(HEALTH_V1, STATUS_CODES[status], battery_percentage) + device_id.encode("utf-8")
@@ -0,0 +1,40 @@
+"""
+Filters of the device queries that run on hot paths. The services build their
+queries here and common/queryplans.py explains the same filters, so the index
+check follows any change to their shape.
+"""
+from datetime import datetime
+
+
+def device_page_filter(user_id: str, after=None, status: str = None, device_type: str = None) -> dict:
+    """
+    One page of a user's devices in _id order (keyset pagination).
+
+    Parameters:
+    - user_id (str): Owner of the devices
+    - after (ObjectId): _id of the last device of the previous page, None for the first page
+    - status (str): Only devices with this status
+    - device_type (str): Only devices of this type
+    """
+    query = {"user_id": user_id}
+    if after is not None:
+        query["_id"] = {"$gt": after}
+    if status is not None:
+        query["status"] = status
+    if device_type is not None:
+        query["device_type"] = device_type
+    return query
+
+
+def stale_devices_filter(cutoff: datetime) -> dict:
+    """
+    Connected devices whose last heartbeat is older than cutoff.
+    """
+    return {"status": "connected", "health_timestamp": {"$lt": cutoff}}
+
+
+def created_since_filter(since: datetime) -> dict:
+    """
+    Devices created at or after since (device registry refresh).
+    """
+    return {"created_at": {"$gte": since}}
@@ -0,0 +1,104 @@
+"""
+Check that the hot-path queries of the services are planned on an index.
+
+Ensures the indexes from common/indexes.py, runs explain() on each query below
+and exits with status 1 if any winning plan contains a COLLSCAN. Point it at a
+local mongod (an empty database is enough, plans are chosen from the indexes):
+
+    python -m common.queryplans --mongo-url mongodb://localhost:27017 --db plancheck
+
+Whole-collection reads (device registry and alert rule loads) scan by design
+and are not listed.
+"""
+import argparse
+import sys
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, MongoClient
+
+from common.indexes import ensure_indexes
+from common.queries import created_since_filter, device_page_filter, stale_devices_filter
+from common.telemetry import BUCKETS_COLLECTION, ROLLUPS
+
+NOW = datetime.now(timezone.utc)
+
+# (name, collection, filter, sort). Device filters come from common.queries, the
+# builders the services use; the single-field lookups are written out here
+HOT_PATH_QUERIES = [
+    ("get_device", "devices", {"device_id": "device"}, None),
+    ("device listing page", "devices", device_page_filter("user", ObjectId()), [("_id", ASCENDING)]),
+    ("filtered device listing", "devices",
+     device_page_filter("user", ObjectId(), "connected", "type"), [("_id", ASCENDING)]),
+    ("owned devices batch", "devices", {"device_id": {"$in": ["a", "b"]}, "user_id": "user"}, None),
+    ("health sweep", "devices", stale_devices_filter(NOW), None),
+    ("registry refresh", "devices", created_since_filter(NOW), None),
+    ("user by email", "users", {"email": "user@example.com"}, None),
+    ("user by user_id", "users", {"user_id": "user"}, None),
+    ("rules of a user", "alert_rules", {"user_id": "user"}, None),
+    ("rule delete", "alert_rules", {"rule_id": "rule", "user_id": "user"}, None),
+    ("alerts of a user", "alerts", {"user_id": "user", "active": True}, [("raised_at", DESCENDING)]),
+    ("alerts of a rule", "alerts", {"rule_id": "rule"}, None),
+    ("active alerts", "alerts", {"active": True}, None),
+    ("raw history", BUCKETS_COLLECTION,
+     {"device_id": "device", "start": {"$gte": NOW, "$lt": NOW}}, [("start", ASCENDING)]),
+] + [
+    (f"{resolution} history", name,
+     {"device_id": "device", "start": {"$gte": NOW, "$lt": NOW}}, [("start", ASCENDING)])
+    for resolution, (name, _) in ROLLUPS.items()
+]
+
+
+def plan_stages(plan) -> list:
+    """
+    Collect every stage name in an explain plan, classic or slot-based.
+    """
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+
+def check(db) -> list:
+    """
+    Returns:
+    - list: (name, stages) for every query, in HOT_PATH_QUERIES order
+    """
+    results = []
+    for name, collection, query, sort in HOT_PATH_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = cursor.explain()
+        results.append((name, plan_stages(explain["queryPlanner"]["winningPlan"])))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--db", default="plancheck")
+    args = parser.parse_args()
+
+    db = MongoClient(args.mongo_url)[args.db]
+    if not ensure_indexes(db):
+        print("Some indexes could not be created, see the log above")
+        return 1
+
+    failed = 0
+    for name, stages in check(db):
+        scan = "COLLSCAN" in stages
+        failed += scan
+        print(f"{'FAIL' if scan else 'ok  '}  {name:<26} {' > '.join(stages)}")
+    print(f"{failed} of {len(HOT_PATH_QUERIES)} hot-path queries scan the collection")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+import logging
+import threading
+from datetime import timedelta
+
+from common.queries import created_since_filter
+
+
+class DeviceRegistry:
+    """
+    In-memory index of registered device_ids.
+
+    The index is loaded once at startup and then kept current by a background
+    thread that fetches devices created since the last refresh (keyed on
+    created_at). Every full_resync_every refreshes the whole set is reloaded so
+    that deleted devices drop out as well. Membership checks never touch MongoDB.
+    """
+
+    # Re-read a small window before the watermark so devices inserted with a
+    # slightly older created_at (clock skew, in-flight inserts) are not missed
+    REFRESH_OVERLAP = timedelta(seconds=5)
+
+    def __init__(self, collection, refresh_seconds: float = 5, full_resync_every: int = 60):
+        self.collection = collection
+        self.refresh_seconds = refresh_seconds
+        self.full_resync_every = full_resync_every
+
+        self._device_ids = set()
+        self._watermark = None
+        self._refreshes = 0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __contains__(self, device_id) -> bool:
+        return device_id in self._device_ids
+
+    def __len__(self) -> int:
+        return len(self._device_ids)
+
+    def start(self):
+        """
+        Load the full index and start the background refresh thread.
+        """
+        self.load()
+        self._thread = threading.Thread(target=self._run, name="device-registry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def load(self):
+        """
+        Replace the index with every device_id currently in the collection.
+        """
+        device_ids = set()
+        watermark = None
+        for device in self.collection.find({}, {"_id": 0, "device_id": 1, "created_at": 1}):
+            device_ids.add(device["device_id"])
+            created_at = device.get("created_at")
+            if created_at and (watermark is None or created_at > watermark):
+                watermark = created_at
+        # Swap the reference so readers never see a half-built set
+        self._device_ids = device_ids
+        self._watermark = watermark
+        logging.info(f"Device registry loaded {len(device_ids)} devices")
+
+    def refresh(self):
+        """
+        Add devices created since the last refresh, or reload everything when a
+        full resync is due.
+        """
+        self._refreshes += 1
+        if self._watermark is None or self._refreshes % self.full_resync_every == 0:
+            self.load()
+            return
+
+        query = created_since_filter(self._watermark - self.REFRESH_OVERLAP)
+        added = 0
+        for device in self.collection.find(query, {"_id": 0, "device_id": 1, "created_at": 1}):
+            if device["device_id"] not in self._device_ids:
+                self._device_ids.add(device["device_id"])
+                added += 1
+            if device["created_at"] > self._watermark:
+                self._watermark = device["created_at"]
+        if added:
+            logging.info(f"Device registry added {added} new devices")
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f"Error refreshing device registry: {e}")
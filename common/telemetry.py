@@ -0,0 +1,195 @@
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ASCENDING, UpdateOne
+
+# Numeric fields that are kept in history and rolled up
+TELEMETRY_FIELDS = ("value1", "value2", "value3")
+
+# Raw readings are appended to one bucket document per device per hour
+BUCKET_SPAN = timedelta(hours=1)
+BUCKETS_COLLECTION = "telemetry_buckets"
+
+# Pre-aggregated min/max/sum/count per device per window
+ROLLUPS = {
+    "1m": ("telemetry_rollups_1m", timedelta(minutes=1)),
+    "1h": ("telemetry_rollups_1h", timedelta(hours=1)),
+}
+
+# Longest window served from each resolution when resolution="auto"
+AUTO_RESOLUTION_LIMITS = (
+    ("raw", timedelta(hours=1)),
+    ("1m", timedelta(days=2)),
+)
+
+
+def as_utc(ts: datetime) -> datetime:
+    """
+    Treat naive datetimes (as returned by pymongo) as UTC.
+    """
+    if ts.tzinfo is None:
+        return ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(timezone.utc)
+
+
+def window_start(ts: datetime, span: timedelta) -> datetime:
+    """
+    Floor a timestamp to the start of the window of the given span.
+    """
+    seconds = span.total_seconds()
+    epoch = as_utc(ts).timestamp()
+    return datetime.fromtimestamp(epoch - epoch % seconds, timezone.utc)
+
+
+def choose_resolution(start: datetime, end: datetime) -> str:
+    """
+    Pick the coarsest resolution that still gives a useful number of points.
+    """
+    span = as_utc(end) - as_utc(start)
+    for resolution, limit in AUTO_RESOLUTION_LIMITS:
+        if span <= limit:
+            return resolution
+    return "1h"
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class TelemetryStore:
+    """
+    Append-only telemetry history with incrementally maintained rollups.
+
+    Readings are (device_id, received_at, fields) tuples. Each batch becomes one
+    $push per device bucket and one $min/$max/$inc upsert per device per rollup
+    window, so the write cost grows with the number of devices in the batch
+    rather than the number of readings.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.buckets = db[BUCKETS_COLLECTION]
+        self.rollups = {resolution: db[name] for resolution, (name, _) in ROLLUPS.items()}
+
+    def build_operations(self, readings) -> dict:
+        """
+        Build the bulk operations for a batch of readings.
+
+        Parameters:
+        - readings (list): (device_id, received_at, fields) tuples
+
+        Returns:
+        - dict: Collection name -> list of UpdateOne operations
+        """
+        buckets = defaultdict(list)
+        windows = {resolution: {} for resolution in ROLLUPS}
+
+        for device_id, received_at, fields in readings:
+            point = {"t": received_at}
+            point.update(fields)
+            buckets[(device_id, window_start(received_at, BUCKET_SPAN))].append(point)
+
+            numeric = {field: fields[field] for field in TELEMETRY_FIELDS if _is_number(fields.get(field))}
+            if not numeric:
+                continue
+            for resolution, (_, span) in ROLLUPS.items():
+                key = (device_id, window_start(received_at, span))
+                aggregates = windows[resolution].setdefault(key, {})
+                for field, value in numeric.items():
+                    agg = aggregates.get(field)
+                    if agg is None:
+                        aggregates[field] = [value, value, value, 1]
+                    else:
+                        agg[0] = min(agg[0], value)
+                        agg[1] = max(agg[1], value)
+                        agg[2] += value
+                        agg[3] += 1
+
+        operations = {
+            BUCKETS_COLLECTION: [
+                UpdateOne(
+                    {"device_id": device_id, "start": start},
+                    {"$push": {"readings": {"$each": points}}, "$inc": {"count": len(points)}},
+                    upsert=True,
+                )
+                for (device_id, start), points in buckets.items()
+            ]
+        }
+        for resolution, aggregates_by_window in windows.items():
+            operations[ROLLUPS[resolution][0]] = [
+                UpdateOne(
+                    {"device_id": device_id, "start": start},
+                    {
+                        "$min": {f"{field}.min": agg[0] for field, agg in aggregates.items()},
+                        "$max": {f"{field}.max": agg[1] for field, agg in aggregates.items()},
+                        "$inc": {
+                            **{f"{field}.sum": agg[2] for field, agg in aggregates.items()},
+                            **{f"{field}.count": agg[3] for field, agg in aggregates.items()},
+                        },
+                    },
+                    upsert=True,
+                )
+                for (device_id, start), aggregates in aggregates_by_window.items()
+            ]
+        return operations
+
+    def record(self, readings):
+        """
+        Append a batch of readings and update the rollups.
+        """
+        for name, operations in self.build_operations(readings).items():
+            if operations:
+                self.db[name].bulk_write(operations, ordered=False)
+
+    def query(self, device_id: str, field: str, start: datetime, end: datetime, resolution: str = "auto"):
+        """
+        Fetch history for one field of a device.
+
+        Parameters:
+        - device_id (str): The device to query
+        - field (str): One of TELEMETRY_FIELDS
+        - start (datetime): Start of the range (inclusive)
+        - end (datetime): End of the range (exclusive)
+        - resolution (str): "raw", "1m", "1h" or "auto"
+
+        Returns:
+        - tuple: The resolution used and the list of points
+        """
+        start, end = as_utc(start), as_utc(end)
+        if resolution == "auto":
+            resolution = choose_resolution(start, end)
+
+        if resolution == "raw":
+            return resolution, self._query_raw(device_id, field, start, end)
+
+        collection = self.rollups[resolution]
+        cursor = collection.find(
+            {"device_id": device_id, "start": {"$gte": window_start(start, ROLLUPS[resolution][1]), "$lt": end}},
+            {"_id": 0, "start": 1, field: 1},
+        ).sort("start", ASCENDING)
+        points = []
+        for doc in cursor:
+            agg = doc.get(field)
+            if not agg or not agg.get("count"):
+                continue
+            points.append({
+                "t": as_utc(doc["start"]),
+                "min": agg["min"],
+                "max": agg["max"],
+                "avg": agg["sum"] / agg["count"],
+                "count": agg["count"],
+            })
+        return resolution, points
+
+    def _query_raw(self, device_id: str, field: str, start: datetime, end: datetime):
+        cursor = self.buckets.find(
+            {"device_id": device_id, "start": {"$gte": window_start(start, BUCKET_SPAN), "$lt": end}},
+            {"_id": 0, "readings.t": 1, f"readings.{field}": 1},
+        ).sort("start", ASCENDING)
+        points = []
+        for bucket in cursor:
+            for reading in bucket.get("readings", []):
+                t = as_utc(reading["t"])
+                if start <= t < end and field in reading:
+                    points.append({"t": t, "value": reading[field]})
+        return points
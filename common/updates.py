@@ -0,0 +1,82 @@
+import logging
+import os
+import threading
+import time
+
+from bson import json_util
+
+# Redis pub/sub channel carrying the latest values written for each device
+CHANNEL = "device-updates"
+
+
+def cache_key(device_id: str) -> str:
+    return f"device:{device_id}"
+
+
+def redis_from_env():
+    """
+    Redis client from REDIS_URL, or None when Redis is not configured.
+    """
+    url = os.getenv("REDIS_URL")
+    if not url:
+        return None
+    import redis
+
+    return redis.Redis.from_url(url)
+
+
+class UpdatePublisher:
+    """
+    Announces device changes to every service holding cached device data.
+
+    A message maps device_id -> fields that were just written, or None when the
+    device was removed. The shared Redis cache entries of those devices are
+    dropped in the same round trip.
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    def publish(self, updates: dict):
+        if not updates:
+            return
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.delete(*[cache_key(device_id) for device_id in updates])
+            pipeline.publish(CHANNEL, json_util.dumps(updates))
+            pipeline.execute()
+        except Exception as e:
+            logging.error(f"Failed to publish updates for {len(updates)} devices: {e}")
+
+
+class UpdateSubscriber:
+    """
+    Background thread that feeds device update messages to a callback.
+
+    on_reset is called whenever the subscription is (re)established, because
+    messages sent while disconnected are lost and caches must not trust what
+    they hold from before.
+    """
+
+    def __init__(self, redis_client, on_updates, on_reset=None):
+        self.redis = redis_client
+        self.on_updates = on_updates
+        self.on_reset = on_reset
+        self._thread = threading.Thread(target=self._run, name="device-updates", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                if self.on_reset is not None:
+                    self.on_reset()
+                for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.on_updates(json_util.loads(message["data"]))
+            except Exception as e:
+                logging.error(f"Device update subscription failed, reconnecting: {e}")
+                time.sleep(1)
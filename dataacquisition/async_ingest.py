@@ -0,0 +1,235 @@
+import asyncio
+import logging
+import signal
+import time
+import zlib
+from datetime import datetime, timezone
+
+import aiomqtt
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError
+
+from batcher import build_update_operations, coalesce_readings
+
+BACKPRESSURE_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+# Wait before reconnecting to the broker, doubled after every failed attempt
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+
+
+class AsyncIngestEngine:
+    """
+    asyncio ingestion pipeline: async MQTT reader -> bounded queues -> async writers.
+
+    Each writer owns one queue and messages are routed to a queue by a hash of
+    the device_id, so updates for one device are always written in order. The
+    total number of buffered messages never exceeds queue_size; when the queues
+    are full the backpressure policy decides what happens:
+
+    - block: stop reading from the broker until a writer catches up
+    - drop-oldest: discard the oldest buffered message to make room
+    - drop-newest: discard the incoming message
+
+    In block mode the MQTT client's own receive buffer is capped at queue_size as
+    well, so a long stall ends with the client discarding (and logging) messages
+    instead of growing without limit.
+
+    When a spool is given, batches whose device documents fail to write are
+    appended to it, and while it holds data new batches queue behind it. History
+    that fails to write is logged and not spooled: replaying it would append the
+    samples and count them in the rollups a second time.
+
+    Written values are announced through the publisher, if one is given.
+    """
+
+    def __init__(
+        self,
+        mongo_uri: str,
+        db_name: str,
+        collection_name: str,
+        parse_message,
+        telemetry=None,
+        queue_size: int = 10000,
+        policy: str = "block",
+        writers: int = 4,
+        batch_size: int = 500,
+        stats_interval: float = 10,
+        mqtt_v5: bool = False,
+        spool=None,
+        publisher=None,
+    ):
+        if policy not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy '{policy}', expected one of {BACKPRESSURE_POLICIES}")
+
+        self.mongo_uri = mongo_uri
+        self.db_name = db_name
+        self.collection_name = collection_name
+        self.parse_message = parse_message
+        self.telemetry = telemetry
+        self.queue_size = queue_size
+        self.policy = policy
+        self.batch_size = batch_size
+        self.stats_interval = stats_interval
+        self.writers = writers
+        self.mqtt_v5 = mqtt_v5
+        self.spool = spool
+        self.publisher = publisher
+        self.queues = []
+
+        # Counters reported by the stats task
+        self.received = 0
+        self.written = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.max_lag = 0.0
+        self._reported_dropped = 0
+
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    async def enqueue(self, device_id: str, update_data: dict):
+        """
+        Put a parsed update on its device's queue, applying the backpressure policy.
+        """
+        queue = self.queues[zlib.crc32(device_id.encode()) % len(self.queues)]
+        item = (device_id, update_data, time.monotonic(), datetime.now(timezone.utc))
+        self.received += 1
+
+        if self.policy == "block":
+            await queue.put(item)
+            return
+        if queue.full():
+            self.dropped += 1
+            if self.policy == "drop-newest":
+                return
+            queue.get_nowait()
+            queue.task_done()
+        queue.put_nowait(item)
+
+    async def run(self, broker: str, port: int, topic: str):
+        """
+        Consume MQTT messages until SIGTERM/SIGINT, then drain the queues.
+        """
+        # Created here so they bind to the running loop
+        self.db = AsyncIOMotorClient(self.mongo_uri)[self.db_name]
+        self.collection = self.db[self.collection_name]
+        self.queues = [asyncio.Queue(maxsize=max(1, self.queue_size // self.writers)) for _ in range(self.writers)]
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+
+        writers = [asyncio.create_task(self._writer(queue)) for queue in self.queues]
+        stats = asyncio.create_task(self._report_stats())
+        reader = asyncio.create_task(self._read(broker, port, topic, stop))
+
+        await asyncio.wait([reader, asyncio.create_task(stop.wait())], return_when=asyncio.FIRST_COMPLETED)
+        if reader.done() and not reader.cancelled() and reader.exception() is not None:
+            logging.error("MQTT reader stopped unexpectedly", exc_info=reader.exception())
+        reader.cancel()
+        logging.info("Shutting down, draining queued updates...")
+        for queue in self.queues:
+            await queue.join()
+        for task in writers + [stats]:
+            task.cancel()
+        self._log_stats()
+
+    async def _read(self, broker: str, port: int, topic: str, stop: asyncio.Event):
+        max_queued = self.queue_size if self.policy == "block" else None
+        protocol = aiomqtt.ProtocolVersion.V5 if self.mqtt_v5 else aiomqtt.ProtocolVersion.V311
+        delay = RECONNECT_DELAY
+        # Like paho's loop_forever: keep reconnecting until asked to stop
+        while not stop.is_set():
+            try:
+                async with aiomqtt.Client(
+                    broker, port, protocol=protocol, max_queued_incoming_messages=max_queued
+                ) as client:
+                    await client.subscribe(topic)
+                    logging.info(f"Listening for messages on topic: {topic} (async mode, policy={self.policy})")
+                    delay = RECONNECT_DELAY
+                    async for message in client.messages:
+                        try:
+                            parsed = self.parse_message(message.topic.value, message.payload)
+                        except Exception as e:
+                            logging.error(f"Error processing message from topic {message.topic.value}: {e}")
+                            continue
+                        if parsed:
+                            await self.enqueue(*parsed)
+            except aiomqtt.MqttError as e:
+                logging.error(f"MQTT connection to {broker}:{port} lost, reconnecting in {delay:.0f} s: {e}")
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    async def _writer(self, queue: asyncio.Queue):
+        while True:
+            items = [await queue.get()]
+            while len(items) < self.batch_size and not queue.empty():
+                items.append(queue.get_nowait())
+            readings = [(device_id, received_at, update_data) for device_id, update_data, _, received_at in items]
+            try:
+                if self.spool is not None and not self.spool.empty():
+                    self._spill(readings)
+                else:
+                    await self._write(readings)
+            except Exception as e:
+                logging.error(f"Bulk write of {len(items)} messages failed: {e}")
+                if self.spool is not None:
+                    self._spill(readings)
+            finally:
+                self.max_lag = max(self.max_lag, time.monotonic() - items[0][2])
+                for _ in items:
+                    queue.task_done()
+
+    def _spill(self, readings: list):
+        try:
+            self.spool.append(readings)
+            self.spooled += len(readings)
+        except Exception as e:
+            logging.error(f"Failed to spool {len(readings)} messages, they are lost: {e}")
+
+    async def _write(self, readings: list):
+        # Same contract as batcher.write_readings: only a failed device write raises
+        latest = coalesce_readings(readings)
+        try:
+            await self.collection.bulk_write(build_update_operations(latest), ordered=False)
+        except BulkWriteError as e:
+            logging.error(f"Bulk write completed with {len(e.details.get('writeErrors', []))} errors")
+        if self.publisher is not None:
+            try:
+                await asyncio.to_thread(self.publisher.publish, latest)
+            except Exception as e:
+                logging.error(f"Failed to publish updates for {len(latest)} devices: {e}")
+
+        if self.telemetry is not None:
+            for name, history_operations in self.telemetry.build_operations(readings).items():
+                if not history_operations:
+                    continue
+                try:
+                    await self.db[name].bulk_write(history_operations, ordered=False)
+                except Exception as e:
+                    logging.error(f"Failed to record {len(readings)} readings in {name}: {e}")
+        self.written += len(readings)
+
+    async def _report_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self._log_stats()
+
+    def _log_stats(self):
+        depth = self.depth()
+        message = (
+            f"Ingest queue depth {depth}/{self.queue_size}, received {self.received}, "
+            f"written {self.written}, spooled {self.spooled}, dropped {self.dropped}, "
+            f"max lag {self.max_lag * 1000:.0f} ms"
+        )
+        if self.dropped > self._reported_dropped or depth >= self.queue_size * 0.8:
+            logging.warning(message)
+        else:
+            logging.info(message)
+        self._reported_dropped = self.dropped
+        self.max_lag = 0.0
@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+def coalesce_readings(readings: list) -> dict:
+    """
+    Merge readings into the latest fields per device (last write wins).
+
+    Parameters:
+    - readings (list): (device_id, received_at, update_data) tuples, oldest first
+
+    Returns:
+    - dict: device_id -> fields to $set, including received_at
+    """
+    latest = {}
+    for device_id, received_at, update_data in readings:
+        fields = latest.get(device_id)
+        if fields is None:
+            fields = latest[device_id] = {}
+        fields.update(update_data)
+        fields["received_at"] = received_at
+    return latest
+
+
+def build_update_operations(latest: dict) -> list:
+    """
+    Turn coalesced fields into one $set per device.
+
+    Each update also stores the reading's received_at and only applies if the
+    device document does not already hold newer data, so batches that are
+    written late (replayed from the spool, or by another writer) can never
+    overwrite fresher values.
+
+    Parameters:
+    - latest (dict): device_id -> fields, as returned by coalesce_readings
+
+    Returns:
+    - list: UpdateOne operations
+    """
+    return [
+        UpdateOne(
+            {"device_id": device_id, "received_at": {"$not": {"$gt": fields["received_at"]}}},
+            {"$set": fields},
+        )
+        for device_id, fields in latest.items()
+    ]
+
+
+def write_readings(collection, telemetry, readings: list, publisher=None):
+    """
+    Write a batch of readings: latest values to the device documents, then history.
+
+    Once the device documents are written the new values are announced through
+    the publisher (if any), so caches of latest values stay current.
+
+    Raises if the device documents could not be written at all.
+
+    Returns:
+    - tuple: Number of update operations and how many matched a device
+    """
+    latest = coalesce_readings(readings)
+    operations = build_update_operations(latest)
+    try:
+        matched = collection.bulk_write(operations, ordered=False).matched_count
+    except BulkWriteError as e:
+        matched = e.details.get("nMatched", 0)
+        logging.error(f"Bulk write completed with {len(e.details.get('writeErrors', []))} errors")
+    if publisher is not None:
+        publisher.publish(latest)
+    if telemetry is not None:
+        try:
+            telemetry.record(readings)
+        except Exception as e:
+            logging.error(f"Failed to record {len(readings)} readings in telemetry history: {e}")
+    return len(operations), matched
+
+
+class BulkWriteBatcher:
+    """
+    Buffer device updates and write them to MongoDB as one unordered bulk_write.
+
+    Updates for the same device_id are merged (last write wins), so a device that
+    publishes several times between flushes costs a single UpdateOne. A flush is
+    triggered by whichever comes first: max_messages buffered messages, or
+    max_latency_ms since the oldest buffered message arrived.
+
+    When a telemetry store is given, every reading (not just the latest per
+    device) is also appended to the history in the same flush.
+
+    When a spool is given, batches that fail to write go to disk instead of being
+    dropped, and so does the buffer if it grows past high_water messages while
+    MongoDB is slow. While the spool holds data, new batches queue behind it.
+
+    Written values are announced through the publisher, if one is given.
+    """
+
+    def __init__(
+        self,
+        collection,
+        max_messages: int = 500,
+        max_latency_ms: int = 200,
+        telemetry=None,
+        spool=None,
+        high_water: int = None,
+        publisher=None,
+    ):
+        self.collection = collection
+        self.max_messages = max_messages
+        self.max_latency = max_latency_ms / 1000.0
+        self.telemetry = telemetry
+        self.spool = spool
+        self.high_water = high_water
+        self.publisher = publisher
+
+        self._readings = []
+        self._first_pending_at = None
+        self._closed = False
+        self._condition = threading.Condition()
+
+        # Running totals, useful for tuning the batch parameters
+        self.flushes = 0
+        self.messages_written = 0
+        self.updates_written = 0
+        self.messages_spooled = 0
+
+        self._thread = threading.Thread(target=self._run, name="bulk-writer", daemon=True)
+        self._thread.start()
+
+    def add(self, device_id: str, update_data: dict):
+        """
+        Queue an update for a device.
+
+        Parameters:
+        - device_id (str): The device to update
+        - update_data (dict): Fields to $set on the device document
+        """
+        overflow = None
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Batcher is closed")
+            self._readings.append((device_id, datetime.now(timezone.utc), update_data))
+            if self._first_pending_at is None:
+                self._first_pending_at = time.monotonic()
+                self._condition.notify()
+            elif len(self._readings) >= self.max_messages:
+                self._condition.notify()
+            if self.spool is not None and self.high_water and len(self._readings) >= self.high_water:
+                overflow = self._swap()
+        if overflow:
+            self._spill(overflow, "buffer passed its high-water mark")
+
+    def close(self):
+        """
+        Stop accepting updates and block until everything buffered has been written.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _swap(self):
+        readings = self._readings
+        self._readings = []
+        self._first_pending_at = None
+        return readings
+
+    def _take_batch(self):
+        # Called with the condition held; waits until a flush is due
+        while not self._closed:
+            if self._first_pending_at is None:
+                self._condition.wait()
+                continue
+            if len(self._readings) >= self.max_messages:
+                break
+            remaining = self._first_pending_at + self.max_latency - time.monotonic()
+            if remaining <= 0:
+                break
+            self._condition.wait(remaining)
+        return self._swap()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                readings = self._take_batch()
+                closed = self._closed
+            if readings:
+                self._write(readings)
+            if closed:
+                return
+
+    def _spill(self, readings: list, reason: str):
+        try:
+            self.spool.append(readings)
+        except Exception as e:
+            logging.error(f"Failed to spool {len(readings)} messages, they are lost: {e}")
+            return
+        self.messages_spooled += len(readings)
+        logging.warning(f"Spooled {len(readings)} messages to disk ({reason})")
+
+    def _write(self, readings: list):
+        if self.spool is not None and not self.spool.empty():
+            self._spill(readings, "older messages are still waiting in the spool")
+            return
+
+        started = time.perf_counter()
+        try:
+            updates, matched = write_readings(self.collection, self.telemetry, readings, self.publisher)
+        except Exception as e:
+            logging.error(f"Bulk write of {len(readings)} messages failed: {e}")
+            if self.spool is not None:
+                self._spill(readings, "MongoDB write failed")
+            return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        self.flushes += 1
+        self.messages_written += len(readings)
+        self.updates_written += updates
+        logging.info(f"Flushed {len(readings)} messages as {updates} updates in {elapsed_ms:.1f} ms")
+        if matched < updates:
+            logging.warning(f"{updates - matched} updates matched no device (unregistered, or newer data already stored)")
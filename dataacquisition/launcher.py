@@ -0,0 +1,59 @@
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler()]
+)
+
+# Number of workers to run, defaults to one per CPU
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "0")) or os.cpu_count() or 1
+
+# How the workers split the load: shared (MQTT shared subscription) or hash
+SHARD_MODE = os.getenv("SHARD_MODE", "shared")
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+stopping = False
+workers = {}
+
+
+def start_worker(index: int):
+    env = dict(os.environ, WORKER_INDEX=str(index), WORKER_COUNT=str(WORKER_COUNT), SHARD_MODE=SHARD_MODE)
+    workers[index] = subprocess.Popen([sys.executable, WORKER_SCRIPT], env=env)
+    logging.info(f"Started worker {index}/{WORKER_COUNT} (pid {workers[index].pid})")
+
+
+# Forward shutdown to the workers so each one flushes its pending updates
+def shutdown(signum, frame):
+    global stopping
+    stopping = True
+    for process in workers.values():
+        process.send_signal(signal.SIGTERM)
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    logging.info(f"Launching {WORKER_COUNT} dataacquisition workers in {SHARD_MODE} mode")
+    for index in range(WORKER_COUNT):
+        start_worker(index)
+
+    # Restart workers that die; in hash mode a missing worker means its devices go unprocessed
+    while not stopping:
+        time.sleep(1)
+        for index, process in list(workers.items()):
+            if process.poll() is not None and not stopping:
+                logging.error(f"Worker {index} exited with code {process.returncode}, restarting")
+                start_worker(index)
+
+    for process in workers.values():
+        process.wait()
+    logging.info("All workers stopped")
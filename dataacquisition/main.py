@@ -1,8 +1,18 @@
 import paho.mqtt.client as mqtt
 from pymongo import MongoClient
-import json
+import asyncio
 import logging
-from concurrent.futures import ThreadPoolExecutor
+import os
+import signal
+
+from batcher import BulkWriteBatcher, write_readings
+from sharding import device_owner, subscription_topic
+from spool import DiskSpool, SpoolReplayer
+from common.indexes import ensure_indexes
+from common.payload import decode_data
+from common.registry import DeviceRegistry
+from common.telemetry import TelemetryStore
+from common.updates import UpdatePublisher, redis_from_env
 
 # Configure logging
 logging.basicConfig(
@@ -21,6 +31,35 @@ BROKER = "mosquitto"
 PORT = 1884
 TOPIC = "devices/+/data"
 
+# Batching configuration: flush every N messages or M milliseconds, whichever comes first
+BATCH_MAX_MESSAGES = int(os.getenv("BATCH_MAX_MESSAGES", "500"))
+BATCH_MAX_LATENCY_MS = int(os.getenv("BATCH_MAX_LATENCY_MS", "200"))
+
+# Ingestion mode: "threaded" (paho + batcher) or "async" (asyncio engine with a bounded queue)
+INGEST_MODE = os.getenv("INGEST_MODE", "threaded")
+
+# Async mode configuration
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "10000"))
+INGEST_BACKPRESSURE = os.getenv("INGEST_BACKPRESSURE", "block")  # block, drop-oldest or drop-newest
+INGEST_WRITERS = int(os.getenv("INGEST_WRITERS", "4"))
+INGEST_STATS_INTERVAL_SECONDS = float(os.getenv("INGEST_STATS_INTERVAL_SECONDS", "10"))
+
+# Sharding across several workers: "none", "shared" (MQTT v5 shared subscription) or "hash"
+SHARD_MODE = os.getenv("SHARD_MODE", "none")
+SHARED_GROUP = os.getenv("SHARED_GROUP", "dataacquisition")
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+SUBSCRIPTION = subscription_topic(TOPIC, SHARD_MODE, SHARED_GROUP)
+
+# Disk spool used while MongoDB is unavailable or slow (one directory per worker)
+SPOOL_DIR = os.getenv("SPOOL_DIR", "/app/spool")
+SPOOL_SEGMENT_MB = int(os.getenv("SPOOL_SEGMENT_MB", "64"))
+SPOOL_MAX_MB = int(os.getenv("SPOOL_MAX_MB", "1024"))
+SPOOL_HIGH_WATER = int(os.getenv("SPOOL_HIGH_WATER", str(BATCH_MAX_MESSAGES * 20)))
+
+# How often the in-memory device registry picks up newly added devices
+REGISTRY_REFRESH_SECONDS = float(os.getenv("REGISTRY_REFRESH_SECONDS", "5"))
+
 # Define accepted keys
 ACCEPTED_KEYS = {"value1", "value2", "value3", "data_timestamp"}
 
@@ -29,57 +68,127 @@ mongo_client = MongoClient(MONGO_URI)
 db = mongo_client[DB_NAME]
 devices_collection = db[COLLECTION_NAME]
 
-# ThreadPoolExecutor for handling high throughput
-executor = ThreadPoolExecutor(max_workers=10)
+# Known device_ids, so unknown devices are rejected without a database lookup
+registry = DeviceRegistry(devices_collection, REGISTRY_REFRESH_SECONDS)
+registry.start()
+
+# Telemetry history (raw buckets plus 1-minute and 1-hour rollups)
+telemetry = TelemetryStore(db)
+ensure_indexes(db)
+
+# Disk spool plus the thread that replays it once MongoDB is reachable again
+spool = DiskSpool(
+    os.path.join(SPOOL_DIR, f"worker-{WORKER_INDEX}"),
+    segment_bytes=SPOOL_SEGMENT_MB * 1024 * 1024,
+    max_bytes=SPOOL_MAX_MB * 1024 * 1024,
+)
+
+def mongo_available():
+    try:
+        mongo_client.admin.command("ping")
+        return True
+    except Exception:
+        return False
+
+# Announces written values to the latest-value caches (only when REDIS_URL is set)
+redis_client = redis_from_env()
+publisher = UpdatePublisher(redis_client) if redis_client is not None else None
+
+replayer = SpoolReplayer(
+    spool,
+    lambda readings: write_readings(devices_collection, telemetry, readings, publisher),
+    mongo_available,
+    batch_size=BATCH_MAX_MESSAGES,
+)
+replayer.start()
+
+# Parse a message into (device_id, update_data), or None if it should be ignored
+def parse_message(topic, payload):
+    # Parse topic to extract device_id
+    topic_parts = topic.split("/")
+    device_id = topic_parts[1]  # Extract the wildcard (device_id)
+
+    # In hash mode every worker sees every message and keeps only its own devices
+    if SHARD_MODE == "hash" and device_owner(device_id, WORKER_COUNT) != WORKER_INDEX:
+        return None
+
+    # Check if device_id is registered
+    if device_id not in registry:
+        logging.debug(f"Device with device_id {device_id} is not registered.")
+        return None
+
+    # Parse (JSON or binary frame) and validate the message payload
+    data = decode_data(payload)
+    update_data = {key: data[key] for key in ACCEPTED_KEYS if key in data}
+    if not update_data:
+        logging.warning(f"Message contains no valid keys for device_id {device_id}: {data}")
+        return None
+    return device_id, update_data
 
 # Function to process each message
 def process_message(topic, payload):
     try:
-        # Parse topic to extract device_id
-        topic_parts = topic.split("/")
-        device_id = topic_parts[1]  # Extract the wildcard (device_id)
-
-        # Check if device_id exists in the devices collection
-        device = devices_collection.find_one({"device_id": device_id})
-        if not device:
-            logging.warning(f"Device with device_id {device_id} not found in the database.")
-            return  # If device does not exist, exit without updating
-
-        # Parse and validate the message payload
-        data = json.loads(payload)
-        update_data = {key: data[key] for key in ACCEPTED_KEYS if key in data}
-
-        if update_data:
-            # Update the device document with valid keys
-            result = devices_collection.update_one(
-                {"device_id": device_id},
-                {"$set": update_data}
-            )
-
-            if result.matched_count > 0:
-                logging.info(f"Updated {device_id} with data: {update_data}")
-            else:
-                logging.warning(f"No matching device found for device_id {device_id}.")
-        else:
-            logging.warning(f"Message contains no valid keys for device_id {device_id}: {data}")
+        parsed = parse_message(topic, payload)
+        if parsed:
+            batcher.add(*parsed)
     except Exception as e:
         logging.error(f"Error processing message from topic {topic}: {e}")
 
 # MQTT message callback
 def on_message(client, userdata, msg):
-    # Submit the message processing task to the executor
-    executor.submit(process_message, msg.topic, msg.payload.decode("utf-8"))
-
-# MQTT client setup
-client = mqtt.Client()
-client.on_message = on_message
-
-# Connect to the MQTT broker
-client.connect(BROKER, PORT, 60)
-
-# Subscribe to the topic
-client.subscribe(TOPIC)
-
-# Start the MQTT client loop
-logging.info(f"Listening for messages on topic: {TOPIC}")
-client.loop_forever()
+    # Parsing is cheap; the database work happens on the batcher's flush thread
+    process_message(msg.topic, msg.payload)
+
+# Stop the MQTT loop so pending updates can be flushed before exiting
+def shutdown(signum, frame):
+    logging.info("Shutting down, flushing pending updates...")
+    client.disconnect()
+
+if INGEST_MODE == "async":
+    from async_ingest import AsyncIngestEngine
+
+    engine = AsyncIngestEngine(
+        MONGO_URI,
+        DB_NAME,
+        COLLECTION_NAME,
+        parse_message,
+        telemetry,
+        queue_size=INGEST_QUEUE_SIZE,
+        policy=INGEST_BACKPRESSURE,
+        writers=INGEST_WRITERS,
+        batch_size=BATCH_MAX_MESSAGES,
+        stats_interval=INGEST_STATS_INTERVAL_SECONDS,
+        mqtt_v5=SHARD_MODE == "shared",
+        spool=spool,
+        publisher=publisher,
+    )
+    asyncio.run(engine.run(BROKER, PORT, SUBSCRIPTION))
+else:
+    # Buffers updates and writes them to MongoDB in bulk
+    batcher = BulkWriteBatcher(
+        devices_collection,
+        BATCH_MAX_MESSAGES,
+        BATCH_MAX_LATENCY_MS,
+        telemetry,
+        spool=spool,
+        high_water=SPOOL_HIGH_WATER,
+        publisher=publisher,
+    )
+
+    # MQTT client setup
+    protocol = mqtt.MQTTv5 if SHARD_MODE == "shared" else mqtt.MQTTv311
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, protocol=protocol)
+    client.on_message = on_message
+
+    # Connect to the MQTT broker
+    client.connect(BROKER, PORT, 60)
+
+    # Subscribe to the topic
+    client.subscribe(SUBSCRIPTION)
+
+    # Start the MQTT client loop
+    logging.info(f"Listening for messages on topic: {SUBSCRIPTION} (worker {WORKER_INDEX}/{WORKER_COUNT})")
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    client.loop_forever()
+    batcher.close()
@@ -0,0 +1,38 @@
+import hashlib
+from functools import lru_cache
+
+SHARD_MODES = ("none", "shared", "hash")
+
+
+def subscription_topic(topic: str, mode: str, group: str) -> str:
+    """
+    Topic a worker subscribes to for the given shard mode.
+
+    Parameters:
+    - topic (str): The base topic, e.g. devices/+/data
+    - mode (str): none, shared or hash
+    - group (str): Shared subscription group name
+
+    Returns:
+    - str: The topic filter to subscribe to
+    """
+    if mode not in SHARD_MODES:
+        raise ValueError(f"Unknown shard mode '{mode}', expected one of {SHARD_MODES}")
+    if mode == "shared":
+        # The broker hands each message to exactly one member of the group
+        return f"$share/{group}/{topic}"
+    return topic
+
+
+@lru_cache(maxsize=1_000_000)
+def device_owner(device_id: str, worker_count: int) -> int:
+    """
+    Worker index that owns a device, by rendezvous (highest random weight) hashing.
+
+    Adding or removing a worker only moves the devices that hashed to that
+    worker, so the other workers keep their devices and their write order.
+    """
+    return max(
+        range(worker_count),
+        key=lambda worker: hashlib.blake2b(f"{worker}:{device_id}".encode(), digest_size=8).digest(),
+    )
@@ -0,0 +1,231 @@
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime, timezone
+
+
+class DiskSpool:
+    """
+    Append-only on-disk spool for readings that could not be written to MongoDB.
+
+    Readings are appended to numbered segment files as length-prefixed,
+    CRC-checked JSON records. A segment is closed once it reaches segment_bytes
+    and a new one is started; segments are consumed oldest first, so readings
+    are replayed in the order they were spooled. When the spool grows past
+    max_bytes the oldest segments are dropped (and logged) so a long outage
+    cannot fill the disk. Segments left over from a previous run are picked up
+    again at startup.
+
+    How many readings of a segment were already replayed is kept next to it, so
+    a replay that fails part-way resumes after the last written batch.
+    """
+
+    HEADER = struct.Struct("<II")  # record length, crc32
+    SUFFIX = ".seg"
+    PROGRESS_SUFFIX = ".replayed"
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024, max_bytes: int = 1024 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._segments = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(self.SUFFIX)
+        )
+        self._sizes = {path: os.path.getsize(path) for path in self._segments}
+        # Segment names are reused after the spool empties: drop progress of segments that are gone
+        for name in os.listdir(directory):
+            segment = os.path.join(directory, name[:-len(self.PROGRESS_SUFFIX)])
+            if name.endswith(self.PROGRESS_SUFFIX) and segment not in self._sizes:
+                os.remove(os.path.join(directory, name))
+        self._next_sequence = int(os.path.basename(self._segments[-1])[:-len(self.SUFFIX)]) + 1 if self._segments else 0
+        self._active = None
+        self._active_path = None
+        if self._segments:
+            logging.warning(f"Spool has {len(self._segments)} segments ({self.size()} bytes) left from a previous run")
+
+    def empty(self) -> bool:
+        with self._lock:
+            return not self._segments
+
+    def size(self) -> int:
+        return sum(self._sizes.values())
+
+    def append(self, readings: list):
+        """
+        Durably append readings to the active segment.
+
+        Parameters:
+        - readings (list): (device_id, received_at, update_data) tuples
+        """
+        data = b"".join(self._encode(reading) for reading in readings)
+        with self._lock:
+            if self._active is None or self._sizes[self._active_path] + len(data) > self.segment_bytes:
+                self._rotate()
+            self._active.write(data)
+            self._active.flush()
+            os.fsync(self._active.fileno())
+            self._sizes[self._active_path] += len(data)
+            self._enforce_cap()
+
+    def read_oldest(self):
+        """
+        Read every record of the oldest segment.
+
+        Returns:
+        - tuple: The segment path and its list of readings, or (None, []) if empty
+        """
+        with self._lock:
+            if not self._segments:
+                return None, []
+            path = self._segments[0]
+            if path == self._active_path:
+                # Seal it; later appends go to a new segment
+                self._active.close()
+                self._active = None
+                self._active_path = None
+
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return path, []
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return path, self._decode(mapped, path)
+        except FileNotFoundError:
+            return path, []
+
+    def replayed(self, path: str) -> int:
+        """
+        Returns:
+        - int: Number of readings at the start of the segment already written to MongoDB
+        """
+        try:
+            with open(path + self.PROGRESS_SUFFIX) as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+        except ValueError:
+            logging.warning(f"Ignoring unreadable replay progress of {path}, replaying it from the start")
+            return 0
+
+    def mark_replayed(self, path: str, count: int):
+        """
+        Durably record that the first count readings of a segment were written.
+        """
+        temporary = path + self.PROGRESS_SUFFIX + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(str(count))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path + self.PROGRESS_SUFFIX)
+
+    def remove(self, path: str):
+        """
+        Delete a segment once its readings have been written to MongoDB.
+        """
+        with self._lock:
+            if path in self._segments:
+                self._segments.remove(path)
+                self._sizes.pop(path, None)
+            self._delete(path)
+
+    def _rotate(self):
+        if self._active is not None:
+            self._active.close()
+        self._active_path = os.path.join(self.directory, f"{self._next_sequence:012d}{self.SUFFIX}")
+        self._next_sequence += 1
+        self._active = open(self._active_path, "ab")
+        self._segments.append(self._active_path)
+        self._sizes[self._active_path] = 0
+
+    def _enforce_cap(self):
+        while self.size() > self.max_bytes and len(self._segments) > 1:
+            path = self._segments.pop(0)
+            logging.error(f"Spool over {self.max_bytes} bytes, dropping oldest segment {path} ({self._sizes[path]} bytes)")
+            self._sizes.pop(path)
+            self._delete(path)
+
+    def _delete(self, path: str):
+        # Progress first: a leftover progress file would skip readings of a reused name
+        for name in (path + self.PROGRESS_SUFFIX, path):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+    def _encode(self, reading) -> bytes:
+        device_id, received_at, update_data = reading
+        payload = json.dumps([device_id, received_at.timestamp(), update_data]).encode("utf-8")
+        return self.HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def _decode(self, mapped, path: str) -> list:
+        readings = []
+        offset = 0
+        end = len(mapped)
+        while offset + self.HEADER.size <= end:
+            length, crc = self.HEADER.unpack_from(mapped, offset)
+            start = offset + self.HEADER.size
+            payload = mapped[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                # A torn write at the tail of the segment (e.g. after a crash)
+                logging.warning(f"Spool segment {path} has a damaged record at offset {offset}, skipping the rest")
+                break
+            device_id, received_at, update_data = json.loads(payload)
+            readings.append((device_id, datetime.fromtimestamp(received_at, timezone.utc), update_data))
+            offset = start + length
+        return readings
+
+
+class SpoolReplayer:
+    """
+    Background thread that drains the spool back into MongoDB once it is reachable.
+
+    write_batch is called with lists of up to batch_size readings, oldest first.
+    Progress is saved after every batch and a segment is deleted once all of its
+    readings were written, so a failure part-way through resumes at the failed
+    batch: batches already written (telemetry included) are not written twice.
+    """
+
+    def __init__(self, spool: DiskSpool, write_batch, is_available, batch_size: int = 500, interval: float = 5):
+        self.spool = spool
+        self.write_batch = write_batch
+        self.is_available = is_available
+        self.batch_size = batch_size
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="spool-replay", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            if self.spool.empty():
+                continue
+            try:
+                if not self.is_available():
+                    continue
+                self.drain()
+            except Exception as e:
+                logging.error(f"Spool replay failed, will retry: {e}")
+
+    def drain(self):
+        while not self.spool.empty() and not self._stopped.is_set():
+            path, readings = self.spool.read_oldest()
+            replayed = self.spool.replayed(path) if path is not None else 0
+            for offset in range(replayed, len(readings), self.batch_size):
+                batch = readings[offset:offset + self.batch_size]
+                self.write_batch(batch)
+                self.spool.mark_replayed(path, offset + len(batch))
+            self.spool.remove(path)
+            logging.info(f"Replayed {len(readings) - replayed} spooled messages from {os.path.basename(path)}")
@@ -1,14 +1,32 @@
 from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from datetime import datetime
-from pymongo import MongoClient
-from jose import JWTError, jwt
-from typing import Optional
-
-# MongoDB setup
-client = MongoClient("mongodb://mongodb:27017")
-db = client["mydatabase"]
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+import asyncio
+import os
+
+from common.auth import InvalidToken, JWTAuth
+from common.cache import LatestValueCache
+from common.db import db, run_db
+from common.indexes import ensure_indexes
+from common.telemetry import ROLLUPS, TELEMETRY_FIELDS, TelemetryStore, as_utc
+from common.updates import UpdateSubscriber, redis_from_env
+from stream import UpdateBroadcaster
+
+# MongoDB setup (MONGO_URL and pool sizes come from the environment, see common/db.py)
 devices_collection = db["devices"]
+telemetry = TelemetryStore(db)
+ensure_indexes(db)
+
+# Latest device documents, kept current by the updates published on ingestion
+redis_client = redis_from_env()
+device_cache = LatestValueCache(
+    lambda device_id: devices_collection.find_one({"device_id": device_id}),
+    max_entries=int(os.getenv("DEVICE_CACHE_SIZE", "10000")),
+    ttl_seconds=float(os.getenv("DEVICE_CACHE_TTL_SECONDS", "30")),
+    redis_client=redis_client,
+)
 
 # Application setup
 app = FastAPI()
@@ -16,22 +34,58 @@ app = FastAPI()
 # Security configurations
 SECRET_KEY = "your_secret_key_here"
 ALGORITHM = "HS256"
+auth = JWTAuth(SECRET_KEY, ALGORITHM)
+
+# Fields that can be read through the batch endpoint
+READABLE_FIELDS = {"value1", "value2", "value3", "battery_percentage", "status", "data_timestamp", "health_timestamp"}
+MAX_BATCH_DEVICES = 1000
+
+# Live update streams: pending events per client before it is evicted, idle keepalive interval
+STREAM_BUFFER_SIZE = int(os.getenv("STREAM_BUFFER_SIZE", "100"))
+STREAM_KEEPALIVE_SECONDS = float(os.getenv("STREAM_KEEPALIVE_SECONDS", "15"))
+broadcaster = UpdateBroadcaster(READABLE_FIELDS, STREAM_BUFFER_SIZE)
+
+# The update channel feeds both the cache and the live streams
+def on_device_updates(updates: dict):
+    device_cache.apply_updates(updates)
+    broadcaster.publish(updates)
+
+if redis_client is not None:
+    UpdateSubscriber(redis_client, on_device_updates, device_cache.clear).start()
+
+# History query limits
+DEFAULT_HISTORY_WINDOW = timedelta(hours=24)
+MAX_RAW_HISTORY_WINDOW = timedelta(days=1)
+
+# Models
+class BatchReadRequest(BaseModel):
+    device_ids: List[str]
+    value_types: List[str]
 
 # Helper functions
 
-def decode_jwt_token(token: str):
+def authenticate(authorization: str):
+    # Verified tokens are cached, so repeated requests skip the signature check
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except JWTError:
+        return auth.verify_bearer(authorization)
+    except InvalidToken:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 def get_device(device_id: str):
-    return devices_collection.find_one({"device_id": device_id})
+    return device_cache.get(device_id)
 
 def get_devices_by_user(user_id: str):
     return list(devices_collection.find({"user_id": user_id}))
 
+def get_user_devices_fields(user_id: str, device_ids: List[str], fields: List[str]):
+    # Ownership is part of the filter and only the requested fields are fetched
+    projection = {"_id": 0, "device_id": 1, **{field: 1 for field in fields}}
+    return list(devices_collection.find({"device_id": {"$in": device_ids}, "user_id": user_id}, projection))
+
+def get_user_device_ids(user_id: str):
+    projection = {"_id": 0, "device_id": 1}
+    return [device["device_id"] for device in devices_collection.find({"user_id": user_id}, projection)]
+
 # API Endpoints
 
 @app.get("/device/{device_id}/{value_type}")
@@ -42,12 +96,10 @@ async def get_device_value(device_id: str, value_type: str, authorization: str =
     :param value_type: The value to fetch (e.g., value1, value2, etc.).
     :param authorization: The Bearer token for authentication.
     """
-    # Extract the token from the Authorization header
-    token = authorization.split(" ")[1]  # "Bearer <token>"
-    payload = decode_jwt_token(token)
+    payload = authenticate(authorization)
 
     # Ensure the device exists
-    device = get_device(device_id)
+    device = await run_db(get_device, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
 
@@ -62,3 +114,112 @@ async def get_device_value(device_id: str, value_type: str, authorization: str =
     # Return the requested value
     return {value_type: device[value_type],"timestamp":device["data_timestamp"]}
 
+@app.get("/device/{device_id}/{value_type}/history")
+async def get_device_history(
+    device_id: str,
+    value_type: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    resolution: str = "auto",
+    authorization: str = Header(...),
+):
+    """
+    Endpoint to fetch the history of a value over a time range.
+    :param device_id: The unique identifier of the device.
+    :param value_type: The value to fetch (value1, value2 or value3).
+    :param start: Start of the range, defaults to 24 hours before end.
+    :param end: End of the range, defaults to now.
+    :param resolution: raw, 1m, 1h or auto (picked from the length of the range).
+    :param authorization: The Bearer token for authentication.
+    """
+    payload = authenticate(authorization)
+
+    # Ensure the device exists and belongs to the user
+    device = await run_db(get_device, device_id)
+    if not device:
+        raise HTTPException(status_code=404, detail="Device not found")
+    if device["user_id"] != payload["user_id"]:
+        raise HTTPException(status_code=403, detail="Access denied for this device")
+
+    if value_type not in TELEMETRY_FIELDS:
+        raise HTTPException(status_code=400, detail=f"No history is kept for value type '{value_type}'")
+    if resolution != "auto" and resolution != "raw" and resolution not in ROLLUPS:
+        raise HTTPException(status_code=400, detail=f"Invalid resolution '{resolution}'")
+
+    end = as_utc(end) if end else datetime.now(timezone.utc)
+    start = as_utc(start) if start else end - DEFAULT_HISTORY_WINDOW
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    if resolution == "raw" and end - start > MAX_RAW_HISTORY_WINDOW:
+        raise HTTPException(status_code=400, detail="Range too long for raw resolution, use 1m or 1h")
+
+    resolution, points = await run_db(telemetry.query, device_id, value_type, start, end, resolution)
+    return {"device_id": device_id, "value_type": value_type, "resolution": resolution, "points": points}
+
+@app.get("/devices/stream")
+async def stream_devices(device_ids: Optional[str] = None, authorization: str = Header(...)):
+    """
+    Endpoint to receive device updates as Server-Sent Events while they are ingested.
+    :param device_ids: Comma separated devices to watch, defaults to all of the user's devices.
+    :param authorization: The Bearer token for authentication.
+    :return: An event stream of "update" events ({"device_id", "values"}) and
+             "removed" events. A client that falls too far behind receives an
+             "evicted" event and should reconnect.
+    """
+    payload = authenticate(authorization)
+
+    if redis_client is None:
+        raise HTTPException(status_code=503, detail="Live updates are not enabled")
+
+    if device_ids:
+        requested = list(dict.fromkeys(device_id for device_id in device_ids.split(",") if device_id))
+        if len(requested) > MAX_BATCH_DEVICES:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_DEVICES} devices per stream")
+        devices = await run_db(get_user_devices_fields, payload["user_id"], requested, [])
+        owned = [device["device_id"] for device in devices]
+        if len(owned) < len(requested):
+            raise HTTPException(status_code=403, detail="Access denied for some of the devices")
+    else:
+        owned = await run_db(get_user_device_ids, payload["user_id"])
+    if not owned:
+        raise HTTPException(status_code=404, detail="No devices to stream")
+
+    broadcaster.bind(asyncio.get_running_loop())
+    return StreamingResponse(
+        broadcaster.events(owned, STREAM_KEEPALIVE_SECONDS),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/devices/values")
+async def get_devices_values(request: BatchReadRequest, authorization: str = Header(...)):
+    """
+    Endpoint to fetch several values from many devices in one request.
+    :param request: The device_ids and value_types to fetch.
+    :param authorization: The Bearer token for authentication.
+    :return: Columnar response: device_ids plus one list per value type, in the
+             same order. Devices that do not exist or belong to another user are
+             listed under "missing".
+    """
+    payload = authenticate(authorization)
+
+    device_ids = list(dict.fromkeys(request.device_ids))
+    value_types = list(dict.fromkeys(request.value_types))
+    if not device_ids or not value_types:
+        raise HTTPException(status_code=400, detail="device_ids and value_types must not be empty")
+    if len(device_ids) > MAX_BATCH_DEVICES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_DEVICES} devices per request")
+    invalid = [value_type for value_type in value_types if value_type not in READABLE_FIELDS]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid value types requested: {invalid}")
+
+    devices = {
+        device["device_id"]: device
+        for device in await run_db(get_user_devices_fields, payload["user_id"], device_ids, value_types)
+    }
+    found = [device_id for device_id in device_ids if device_id in devices]
+    response = {"device_ids": found}
+    for value_type in value_types:
+        response[value_type] = [devices[device_id].get(value_type) for device_id in found]
+    response["missing"] = [device_id for device_id in device_ids if device_id not in devices]
+    return response
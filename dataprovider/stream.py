@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+from datetime import datetime
+
+# Put on a subscription's queue in place of its pending events when it is evicted
+EVICTED = object()
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def format_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=_json_default)}\n\n"
+
+
+class Subscription:
+    """
+    One streaming client: the devices it watches and a bounded queue of pending events.
+    """
+
+    def __init__(self, device_ids: set, buffer_size: int):
+        self.device_ids = device_ids
+        self.queue = asyncio.Queue(maxsize=buffer_size)
+
+
+class UpdateBroadcaster:
+    """
+    Fan device updates out to streaming subscribers.
+
+    publish() is called from the thread that listens to the update channel and
+    hands the message over to the event loop; dispatching then only touches the
+    subscribers of the devices in the message. Each event is encoded once and
+    shared by all of its subscribers.
+
+    A subscriber whose buffer is full is evicted rather than allowed to hold
+    events (and memory) back: its queue is cleared and replaced by EVICTED, and
+    the client is expected to reconnect.
+
+    Parameters:
+    - fields (set): Device fields that are forwarded to subscribers
+    - buffer_size (int): Pending events allowed per subscriber
+    """
+
+    def __init__(self, fields: set, buffer_size: int = 100):
+        self.fields = fields
+        self.buffer_size = buffer_size
+        self.loop = None
+        self._by_device = {}  # device_id -> set of Subscription
+        self.evicted = 0
+
+    def bind(self, loop):
+        self.loop = loop
+
+    def subscribe(self, device_ids) -> Subscription:
+        subscription = Subscription(set(device_ids), self.buffer_size)
+        for device_id in subscription.device_ids:
+            self._by_device.setdefault(device_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        for device_id in subscription.device_ids:
+            subscribers = self._by_device.get(device_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._by_device[device_id]
+
+    def publish(self, updates: dict):
+        """
+        Thread-safe entry point for a device update message.
+        """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._dispatch, updates)
+
+    def _dispatch(self, updates: dict):
+        for device_id, fields in updates.items():
+            subscribers = self._by_device.get(device_id)
+            if not subscribers:
+                continue
+            if fields is None:
+                event = format_event("removed", {"device_id": device_id})
+            else:
+                values = {field: value for field, value in fields.items() if field in self.fields}
+                if not values:
+                    continue
+                event = format_event("update", {"device_id": device_id, "values": values})
+            for subscription in list(subscribers):
+                self._offer(subscription, event)
+
+    def _offer(self, subscription: Subscription, event: str):
+        try:
+            subscription.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.unsubscribe(subscription)
+            while not subscription.queue.empty():
+                subscription.queue.get_nowait()
+            subscription.queue.put_nowait(EVICTED)
+            self.evicted += 1
+            logging.warning(f"Evicted a slow stream subscriber ({len(subscription.device_ids)} devices)")
+
+    async def events(self, device_ids, keepalive_seconds: float):
+        """
+        Server-Sent Events for the given devices, until the client goes away or is evicted.
+        """
+        subscription = self.subscribe(device_ids)
+        try:
+            yield format_event("subscribed", {"device_ids": sorted(subscription.device_ids)})
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.queue.get(), keepalive_seconds)
+                except asyncio.TimeoutError:
+                    # A comment line keeps proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                    continue
+                if event is EVICTED:
+                    yield format_event("evicted", {"reason": "client too slow, reconnect to resume"})
+                    return
+                yield event
+        finally:
+            self.unsubscribe(subscription)
@@ -1,28 +1,65 @@
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from datetime import datetime, timezone
-from pymongo import MongoClient
-from jose import JWTError, jwt
-from typing import List
+from typing import List, Optional
+import json
+import logging
+import os
 import uuid
+from bson import ObjectId
 from cryptography.fernet import Fernet
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-# MongoDB setup
-client = MongoClient("mongodb://mongodb:27017")
-db = client["mydatabase"]
+from common.auth import InvalidToken, JWTAuth
+from common.db import db, run_db
+from common.indexes import require_indexes
+from common.queries import device_page_filter
+from common.updates import UpdatePublisher, redis_from_env
+import provisioning
+
+logger = logging.getLogger(__name__)
+
+# MongoDB setup (MONGO_URL and pool sizes come from the environment, see common/db.py)
 devices_collection = db["devices"]
 
+# device_id is unique in the index, so inserts need no check-then-insert round trip;
+# without that index duplicates would go in unnoticed, so startup fails instead
+INDEX_STARTUP_TIMEOUT_SECONDS = float(os.getenv("INDEX_STARTUP_TIMEOUT_SECONDS", "60"))
+require_indexes(db, "devices", INDEX_STARTUP_TIMEOUT_SECONDS)
+
+# Tells the latest-value caches to drop removed devices (only when REDIS_URL is set)
+redis_client = redis_from_env()
+publisher = UpdatePublisher(redis_client) if redis_client is not None else None
+
 # Application setup
 app = FastAPI()
 
 # Security configurations
 SECRET_KEY = "your_secret_key_here"
 ALGORITHM = "HS256"
+auth = JWTAuth(SECRET_KEY, ALGORITHM)
 
 #Device Security configurations
 ENCRYPTION_KEY = b'_T3L0eU8ovtJSZCMf7GxkXh1GP1ebNuLlHLcfM8vu4Q='
 cipher = Fernet(ENCRYPTION_KEY)
 
+# Bulk provisioning: device IDs per request, decryption processes and IDs per decryption task
+BULK_MAX_DEVICES = int(os.getenv("BULK_MAX_DEVICES", "50000"))
+BULK_DECRYPT_WORKERS = int(os.getenv("BULK_DECRYPT_WORKERS", str(os.cpu_count() or 1)))
+BULK_DECRYPT_CHUNK_SIZE = int(os.getenv("BULK_DECRYPT_CHUNK_SIZE", "2000"))
+decoder = provisioning.DeviceIdDecoder(ENCRYPTION_KEY, BULK_DECRYPT_WORKERS, BULK_DECRYPT_CHUNK_SIZE)
+
+# Device listing: fields that can be selected, the default selection and page sizes
+LISTABLE_FIELDS = {
+    "device_id", "device_name", "device_type", "status", "created_at", "health_timestamp",
+    "value1", "value2", "value3", "battery_percentage", "data_timestamp",
+}
+DEFAULT_LIST_FIELDS = ["device_id", "device_name", "device_type", "status", "created_at"]
+DEVICE_PAGE_SIZE = int(os.getenv("DEVICE_PAGE_SIZE", "100"))
+MAX_DEVICE_PAGE_SIZE = int(os.getenv("MAX_DEVICE_PAGE_SIZE", "1000"))
+DEVICE_STREAM_BATCH_SIZE = int(os.getenv("DEVICE_STREAM_BATCH_SIZE", "1000"))
+
 # Models
 class Device(BaseModel):
     device_id: str  # device_id passed from the device memory
@@ -30,6 +67,9 @@ class Device(BaseModel):
     #device_type: str
     #status: str
 
+class DeviceBatch(BaseModel):
+    device_ids: List[str]
+
 class DeviceResponse(BaseModel):
     device_id: str
     device_name: str
@@ -45,8 +85,45 @@ class User(BaseModel):
 def get_device(device_id: str):
     return devices_collection.find_one({"device_id": device_id})
 
-def get_devices_by_user(user_id: str):
-    return list(devices_collection.find({"user_id": user_id}))
+def get_devices_page(user_id: str, fields: List[str], limit: int, after: Optional[ObjectId] = None,
+                     status: Optional[str] = None, device_type: Optional[str] = None):
+    """
+    Fetch one page of a user's devices in _id order, starting after the given _id.
+
+    Parameters:
+    - user_id (str): Owner of the devices
+    - fields (List[str]): Fields to return besides _id
+    - limit (int): Maximum number of devices in the page
+    - after (ObjectId): _id of the last device of the previous page, None for the first page
+    - status (str): Only devices with this status
+    - device_type (str): Only devices of this type
+
+    Returns:
+    - list: Device documents with _id and the requested fields
+    """
+    query = device_page_filter(user_id, after, status, device_type)
+    projection = {"_id": 1, **{field: 1 for field in fields}}
+    return list(devices_collection.find(query, projection).sort("_id", 1).limit(limit))
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+async def stream_device_pages(user_id: str, fields: List[str], after: Optional[ObjectId],
+                              status: Optional[str], device_type: Optional[str]):
+    # One page in memory at a time, each line written as soon as its page is read
+    while True:
+        page = await run_db(get_devices_page, user_id, fields, DEVICE_STREAM_BATCH_SIZE, after, status, device_type)
+        if not page:
+            return
+        after = page[-1]["_id"]
+        yield "".join(
+            json.dumps({field: device[field] for field in fields if field in device}, default=_json_default) + "\n"
+            for device in page
+        )
+        if len(page) < DEVICE_STREAM_BATCH_SIZE:
+            return
 
 def decode_device_info(encoded_data: str) -> dict:
     """
@@ -58,27 +135,10 @@ def decode_device_info(encoded_data: str) -> dict:
     Returns:
     - dict: Contains the original manufacturer name, device type, secret key, and timestamp
     """
-    try:
-        # Decrypt the data
-        decoded_data = cipher.decrypt(encoded_data.encode('utf-8')).decode('utf-8')
-        # Split the data into components
-        manufacturer_name, device_Name, device_type, timestamp = decoded_data.split(":")
-        return {
-            "manufacturer_name": manufacturer_name,
-            "device_name": device_Name,
-            "device_type": device_type,
-            "timestamp": timestamp
-        }
-    except Exception as e:
-        raise ValueError("Invalid encoded data or decryption failed.") from e
+    return provisioning.decode_device_info(cipher, encoded_data)
 
-def create_device(user_id: str, device_id: str):
-    # Ensure device ID is unique
-    if get_device(device_id):
-        raise HTTPException(status_code=400, detail="Device ID already exists")
-    current_time = datetime.now(timezone.utc)
-    decoded_info = decode_device_info(device_id)
-    device = {
+def build_device(user_id: str, device_id: str, decoded_info: dict, current_time: datetime):
+    return {
         "device_id": device_id,
         "user_id": user_id,
         "device_name": decoded_info["device_name"],
@@ -92,56 +152,175 @@ def create_device(user_id: str, device_id: str):
         "battery_percentage": 100,
         "data_timestamp": current_time,
     }
-    devices_collection.insert_one(device)
+
+def create_device(user_id: str, device_id: str):
+    try:
+        decoded_info = decode_device_info(device_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid device ID")
+    device = build_device(user_id, device_id, decoded_info, datetime.now(timezone.utc))
+    # Ensure device ID is unique
+    try:
+        devices_collection.insert_one(device)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Device ID already exists")
     return device
 
+def insert_devices(devices: list):
+    """
+    Insert devices in one unordered bulk write, so duplicates do not stop the rest.
+
+    Parameters:
+    - devices (list): Device documents to insert
+
+    Returns:
+    - set: Positions in devices that were rejected as duplicate device IDs
+    - list: Positions in devices that failed for any other reason
+    """
+    if not devices:
+        return set(), []
+    try:
+        devices_collection.insert_many(devices, ordered=False)
+    except BulkWriteError as e:
+        duplicates = set()
+        failed = []
+        for error in e.details.get("writeErrors", []):
+            if error.get("code") == 11000:
+                duplicates.add(error["index"])
+            else:
+                failed.append(error["index"])
+        return duplicates, failed
+    return set(), []
+
 def remove_device(device_id: str):
     result = devices_collection.delete_one({"device_id": device_id})
+    if publisher is not None and result.deleted_count:
+        publisher.publish({device_id: None})
     return result.deleted_count > 0
 
-def decode_jwt_token(token: str):
+def authenticate(authorization: str):
+    # Verified tokens are cached, so repeated requests skip the signature check
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except JWTError:
+        return auth.verify_bearer(authorization)
+    except InvalidToken:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 # API Endpoints
 
 @app.post("/add_device", response_model=DeviceResponse)
 async def add_device(device: Device, authorization: str = Header(...)):
-    # Extract the token from the Authorization header
-    token = authorization.split(" ")[1]  # "Bearer <token>"
-    payload = decode_jwt_token(token)
-
-    # Ensure device ID is unique across all users
-    if get_device(device.device_id):
-        raise HTTPException(status_code=400, detail="Device ID already exists")
+    payload = authenticate(authorization)
 
-    # Assign device to user
-    device_data = create_device(user_id=payload["user_id"], device_id=device.device_id)
+    # Assign device to user (the unique index rejects IDs that already exist)
+    device_data = await run_db(create_device, user_id=payload["user_id"], device_id=device.device_id)
     return device_data
 
-@app.get("/devices", response_model=List[DeviceResponse])
-async def get_devices(authorization: str = Header(...)):
-    # Extract the token from the Authorization header
-    token = authorization.split(" ")[1]  # "Bearer <token>"
-    payload = decode_jwt_token(token)
+@app.post("/add_devices")
+async def add_devices(batch: DeviceBatch, authorization: str = Header(...)):
+    """
+    Endpoint to register many devices to the user in one request.
+    :param batch: The encrypted device_ids to register.
+    :param authorization: The Bearer token for authentication.
+    :return: Counts per outcome plus a "results" entry per requested device_id,
+             in request order, with status "created", "duplicate" (already
+             registered or repeated in the request), "invalid" (could not be
+             decrypted) or "failed" (the insert failed for another reason).
+    """
+    payload = authenticate(authorization)
+
+    if not batch.device_ids:
+        raise HTTPException(status_code=400, detail="device_ids must not be empty")
+    if len(batch.device_ids) > BULK_MAX_DEVICES:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_DEVICES} devices per request")
+
+    # Repeats within the request are reported as duplicates of the first occurrence
+    device_ids = list(dict.fromkeys(batch.device_ids))
+    decoded = await decoder.decode_many(device_ids)
+
+    statuses = dict.fromkeys(device_ids, "invalid")
+    current_time = datetime.now(timezone.utc)
+    valid_ids = [device_id for device_id, info in zip(device_ids, decoded) if info is not None]
+    devices = [
+        build_device(payload["user_id"], device_id, info, current_time)
+        for device_id, info in zip(device_ids, decoded) if info is not None
+    ]
+    duplicates, failed = await run_db(insert_devices, devices)
+    if failed:
+        logger.error(f"Bulk provisioning failed to insert {len(failed)} of {len(devices)} devices")
+    for index, device_id in enumerate(valid_ids):
+        statuses[device_id] = "duplicate" if index in duplicates else "created"
+    for index in failed:
+        statuses[valid_ids[index]] = "failed"
+
+    results = []
+    seen = set()
+    for device_id in batch.device_ids:
+        results.append({"device_id": device_id, "status": "duplicate" if device_id in seen else statuses[device_id]})
+        seen.add(device_id)
+    counts = {"created": 0, "duplicate": 0, "invalid": 0, "failed": 0}
+    for result in results:
+        counts[result["status"]] += 1
+    return {**counts, "results": results}
+
+@app.get("/devices")
+async def get_devices(
+    response: Response,
+    limit: int = DEVICE_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    device_type: Optional[str] = None,
+    fields: Optional[str] = None,
+    stream: bool = False,
+    authorization: str = Header(...),
+):
+    """
+    Endpoint to list the user's devices, one page at a time.
+    :param limit: Devices per page, at most MAX_DEVICE_PAGE_SIZE.
+    :param cursor: The X-Next-Cursor value of the previous page.
+    :param status: Only list devices with this status.
+    :param device_type: Only list devices of this type.
+    :param fields: Comma separated fields to return, defaults to the DeviceResponse fields.
+    :param stream: Return every remaining device as NDJSON (one object per line)
+                   instead of a page; limit is ignored.
+    :param authorization: The Bearer token for authentication.
+    :return: A list of devices. When more devices follow, the X-Next-Cursor
+             header holds the cursor of the next page.
+    """
+    payload = authenticate(authorization)
+
+    if limit < 1 or limit > MAX_DEVICE_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_DEVICE_PAGE_SIZE}")
+    if cursor is not None and not ObjectId.is_valid(cursor):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    after = ObjectId(cursor) if cursor is not None else None
+    if fields:
+        selected = list(dict.fromkeys(field for field in fields.split(",") if field))
+        invalid = [field for field in selected if field not in LISTABLE_FIELDS]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f"Invalid fields requested: {invalid}")
+    else:
+        selected = DEFAULT_LIST_FIELDS
+
+    if stream:
+        return StreamingResponse(
+            stream_device_pages(payload["user_id"], selected, after, status, device_type),
+            media_type="application/x-ndjson",
+        )
 
-    # Retrieve all devices associated with the user
-    user_devices = get_devices_by_user(payload["user_id"])
-    if not user_devices:
+    # Retrieve one page of the devices associated with the user
+    page = await run_db(get_devices_page, payload["user_id"], selected, limit, after, status, device_type)
+    if not page and after is None and status is None and device_type is None:
         raise HTTPException(status_code=404, detail="No devices found for this user")
-    return user_devices
+    if len(page) == limit:
+        response.headers["X-Next-Cursor"] = str(page[-1]["_id"])
+    return [{field: device[field] for field in selected if field in device} for device in page]
 
 @app.get("/device/{device_id}", response_model=DeviceResponse)
 async def get_device_by_id(device_id: str, authorization: str = Header(...)):
-    # Extract the token from the Authorization header
-    token = authorization.split(" ")[1]  # "Bearer <token>"
-    payload = decode_jwt_token(token)
+    payload = authenticate(authorization)
     
     # Retrieve a specific device by ID
-    device = get_device(device_id)
+    device = await run_db(get_device, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     if device["user_id"] != payload["user_id"]:
@@ -150,19 +329,17 @@ async def get_device_by_id(device_id: str, authorization: str = Header(...)):
 
 @app.delete("/device/{device_id}", response_model=dict)
 async def delete_device(device_id: str, authorization: str = Header(...)):
-    # Extract the token from the Authorization header
-    token = authorization.split(" ")[1]  # "Bearer <token>"
-    payload = decode_jwt_token(token)
+    payload = authenticate(authorization)
 
     # Ensure the device belongs to the current user
-    device = get_device(device_id)
+    device = await run_db(get_device, device_id)
     if not device:
         raise HTTPException(status_code=404, detail="Device not found")
     if device["user_id"] != payload["user_id"]:
         raise HTTPException(status_code=403, detail="Access denied for this device")
     
     # Remove the device
-    success = remove_device(device_id)
+    success = await run_db(remove_device, device_id)
     if not success:
         raise HTTPException(status_code=404, detail="Device not found")
     
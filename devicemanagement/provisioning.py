@@ -0,0 +1,75 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.fernet import Fernet
+
+
+def decode_device_info(cipher: Fernet, encoded_data: str) -> dict:
+    """
+    Decode the encoded string to retrieve the original device information.
+
+    Parameters:
+    - cipher (Fernet): Cipher holding the device encryption key
+    - encoded_data (str): The encoded string to decode
+
+    Returns:
+    - dict: Contains the original manufacturer name, device type, secret key, and timestamp
+    """
+    try:
+        # Decrypt the data
+        decoded_data = cipher.decrypt(encoded_data.encode('utf-8')).decode('utf-8')
+        # Split the data into components
+        manufacturer_name, device_Name, device_type, timestamp = decoded_data.split(":")
+        return {
+            "manufacturer_name": manufacturer_name,
+            "device_name": device_Name,
+            "device_type": device_type,
+            "timestamp": timestamp
+        }
+    except Exception as e:
+        raise ValueError("Invalid encoded data or decryption failed.") from e
+
+
+# Runs inside the worker processes
+def _decode_chunk(key: bytes, encoded_ids: list) -> list:
+    cipher = Fernet(key)
+    decoded = []
+    for encoded_data in encoded_ids:
+        try:
+            decoded.append(decode_device_info(cipher, encoded_data))
+        except ValueError:
+            decoded.append(None)
+    return decoded
+
+
+class DeviceIdDecoder:
+    """
+    Decrypts large batches of device IDs on a pool of worker processes.
+
+    The batch is split into chunks of chunk_size IDs that are decrypted in
+    parallel, one chunk per task, so per-task overhead stays small next to the
+    decryption work.
+
+    Parameters:
+    - key (bytes): Fernet key the device IDs were encrypted with
+    - workers (int): Worker processes, normally one per core
+    - chunk_size (int): Device IDs per task
+    """
+
+    def __init__(self, key: bytes, workers: int, chunk_size: int = 2000):
+        self.key = key
+        self.chunk_size = chunk_size
+        # Spawned, not forked: a forked worker would inherit the server's socket and threads
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def decode_many(self, encoded_ids: list) -> list:
+        """
+        Returns:
+        - list: Decoded device information per ID, in order; None where decryption failed
+        """
+        chunks = [
+            asyncio.wrap_future(self._executor.submit(_decode_chunk, self.key, encoded_ids[i:i + self.chunk_size]))
+            for i in range(0, len(encoded_ids), self.chunk_size)
+        ]
+        return [decoded for chunk in await asyncio.gather(*chunks) for decoded in chunk]
@@ -1,10 +1,15 @@
 import pymongo
 import os
 import logging
+import time
 from celery import Celery
 from celery.schedules import crontab
 from datetime import datetime, timedelta, timezone
 
+from common.indexes import ensure_indexes
+from common.queries import stale_devices_filter
+from common.updates import UpdatePublisher, redis_from_env
+
 # Set up logger
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger()
@@ -26,34 +31,72 @@ client = pymongo.MongoClient("mongodb://mongodb:27017")
 db = client["mydatabase"]
 devices_collection = db["devices"]
 
+# Announces status changes to the latest-value caches (only when REDIS_URL is set)
+redis_client = redis_from_env()
+publisher = UpdatePublisher(redis_client) if redis_client is not None else None
+
+# Devices whose last heartbeat is older than this are marked as disconnected
+HEALTH_TIMEOUT = timedelta(seconds=int(os.getenv("HEALTH_TIMEOUT_SECONDS", "30")))
+
+# Stale devices are flipped in chunks so a huge fleet never builds one giant $in list
+SWEEP_CHUNK_SIZE = int(os.getenv("HEALTH_SWEEP_CHUNK_SIZE", "5000"))
+
+# Includes the (status, health_timestamp, device_id) index that covers the stale-device query below
+ensure_indexes(db)
+
 
 # Health check task (runs every minute)
 @app.task
 def check_device_health():
-    # Get the current time
-    logger.info("Checking device health...")
-    current_time = datetime.now(timezone.utc)
-
-    # Find devices that are connected
-    devices = list(devices_collection.find({'status': 'connected'}))
-    logger.info(devices)
-    
-
-    if not devices:
-        logger.warning("No connected devices found.")
-        return
-
-    for device in devices:
-        health_timestamp = device.get('health_timestamp')
-        if health_timestamp:
-            if health_timestamp.tzinfo is None:
-                health_timestamp = health_timestamp.replace(tzinfo=timezone.utc)
-            # Mark as disconnected if health timestamp is older than 30 seconds
-            if current_time - health_timestamp > timedelta(seconds=30):
-                devices_collection.update_one(
-                    {'device_id': device['device_id']},
-                    {'$set': {'status': 'disconnected'}}
+    """
+    Mark connected devices with a stale health_timestamp as disconnected.
+
+    Returns:
+    - list: device_ids that transitioned to disconnected in this run
+    """
+    started = time.perf_counter()
+    now = datetime.now(timezone.utc)
+    cutoff = now - HEALTH_TIMEOUT
+    stale = stale_devices_filter(cutoff)
+    # Tags this sweep's writes, so devices flipped by another writer are not counted as ours
+    sweep = {'status': 'disconnected', 'disconnected_at': now}
+
+    transitioned = []
+    chunks = 0
+    while True:
+        device_ids = [
+            device['device_id']
+            for device in devices_collection.find(stale, {'_id': 0, 'device_id': 1}).limit(SWEEP_CHUNK_SIZE)
+        ]
+        if not device_ids:
+            break
+        chunks += 1
+        found = len(device_ids)
+
+        # Repeat the time predicate so a heartbeat that lands after the find is not overwritten
+        result = devices_collection.update_many(
+            {**stale, 'device_id': {'$in': device_ids}},
+            {'$set': sweep}
+        )
+        if result.modified_count < len(device_ids):
+            # Some devices sent a heartbeat or were disconnected by someone else in between
+            device_ids = [
+                device['device_id']
+                for device in devices_collection.find(
+                    {**sweep, 'device_id': {'$in': device_ids}}, {'_id': 0, 'device_id': 1}
                 )
-                logger.info(f"Device {device['device_id']} marked as disconnected.")
-        else:
-            logger.warning(f"Device {device['device_id']} has no health timestamp.")
+            ]
+        transitioned.extend(device_ids)
+        if publisher is not None and device_ids:
+            publisher.publish({device_id: {'status': 'disconnected'} for device_id in device_ids})
+
+        if result.modified_count == 0 or found < SWEEP_CHUNK_SIZE:
+            break
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logger.info(
+        f"Health sweep marked {len(transitioned)} devices disconnected in {elapsed_ms:.1f} ms ({chunks} chunks)"
+    )
+    if transitioned:
+        logger.debug(f"Disconnected devices: {transitioned}")
+    return transitioned
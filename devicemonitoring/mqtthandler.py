@@ -1,9 +1,18 @@
 import paho.mqtt.client as mqtt
 import pymongo
-import json
 import logging
+import os
+import threading
+import time
 from datetime import datetime, timedelta, timezone
 
+from common.indexes import ensure_indexes
+from common.payload import decode_health
+from common.registry import DeviceRegistry
+from common.updates import UpdatePublisher, redis_from_env
+from timingwheel import TimingWheel
+from writefilter import HeartbeatWriteFilter
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO, 
@@ -15,12 +24,86 @@ logger = logging.getLogger()
 mongoclient = pymongo.MongoClient("mongodb://mongodb:27017")
 db = mongoclient["mydatabase"]
 devices_collection = db["devices"]
+ensure_indexes(db)
+
+# Known device_ids, so heartbeats from unknown devices skip the database entirely
+registry = DeviceRegistry(devices_collection, float(os.getenv("REGISTRY_REFRESH_SECONDS", "5")))
+registry.start()
+
+# Disconnect detection: a device is marked disconnected once this long passes without a heartbeat
+HEARTBEAT_GRACE_SECONDS = float(os.getenv("HEARTBEAT_GRACE_SECONDS", "30"))
+WHEEL_TICK_SECONDS = float(os.getenv("WHEEL_TICK_SECONDS", "0.5"))
+heartbeat_wheel = TimingWheel(HEARTBEAT_GRACE_SECONDS, WHEEL_TICK_SECONDS)
+
+# Unchanged heartbeats are only persisted once per refresh interval; keep it below
+# the health check timeout (HEALTH_TIMEOUT_SECONDS, 30 by default)
+HEALTH_REFRESH_SECONDS = float(os.getenv("HEALTH_REFRESH_SECONDS", "10"))
+write_filter = HeartbeatWriteFilter(HEALTH_REFRESH_SECONDS)
+STATS_INTERVAL_SECONDS = float(os.getenv("STATS_INTERVAL_SECONDS", "60"))
+
+# Announces health changes to the latest-value caches (only when REDIS_URL is set)
+redis_client = redis_from_env()
+publisher = UpdatePublisher(redis_client) if redis_client is not None else None
 
 # MQTT broker connection
 mqtt_broker = 'mosquitto'
 mqtt_port = 1884
 mqtt_topic = 'device/health'
 
+# Load the deadlines of connected devices so detection survives a restart
+def rebuild_heartbeat_wheel():
+    for device in devices_collection.find(
+        {'status': 'connected'}, {'_id': 0, 'device_id': 1, 'health_timestamp': 1}
+    ):
+        health_timestamp = device.get('health_timestamp')
+        if health_timestamp:
+            if health_timestamp.tzinfo is None:
+                health_timestamp = health_timestamp.replace(tzinfo=timezone.utc)
+            heartbeat_wheel.touch(device['device_id'], health_timestamp.timestamp())
+    logger.info(f"Tracking heartbeats of {len(heartbeat_wheel)} connected devices")
+
+# Mark devices whose heartbeat deadline has passed as disconnected
+def expire_heartbeats():
+    next_stats = time.monotonic() + STATS_INTERVAL_SECONDS
+    while True:
+        time.sleep(WHEEL_TICK_SECONDS)
+        if time.monotonic() >= next_stats:
+            next_stats += STATS_INTERVAL_SECONDS
+            total = write_filter.written + write_filter.suppressed
+            logger.info(
+                f"Heartbeats written: {write_filter.written}, suppressed: {write_filter.suppressed} "
+                f"({write_filter.suppressed / total * 100 if total else 0:.1f}%)"
+            )
+
+        now = time.time()
+        expired = heartbeat_wheel.advance(now)
+        if not expired:
+            continue
+        for device_id in expired:
+            write_filter.forget(device_id)
+        # An expired device's last heartbeat is at most now - grace; a heartbeat
+        # written after advance() is newer and must not be overwritten
+        cutoff = datetime.fromtimestamp(now - HEARTBEAT_GRACE_SECONDS, timezone.utc)
+        try:
+            result = devices_collection.update_many(
+                {'device_id': {'$in': expired}, 'status': 'connected', 'health_timestamp': {'$lte': cutoff}},
+                {'$set': {'status': 'disconnected'}}
+            )
+            logger.info(f"Marked {result.modified_count} devices disconnected after missed heartbeats.")
+            if publisher is not None and result.modified_count:
+                if result.modified_count < len(expired):
+                    reconnected = {
+                        device['device_id']
+                        for device in devices_collection.find(
+                            {'device_id': {'$in': expired}, 'status': 'connected'}, {'_id': 0, 'device_id': 1}
+                        )
+                    }
+                    expired = [device_id for device_id in expired if device_id not in reconnected]
+                publisher.publish({device_id: {'status': 'disconnected'} for device_id in expired})
+            logger.debug(f"Expired devices: {expired}")
+        except Exception as e:
+            logger.error(f"Error marking {len(expired)} devices disconnected: {e}")
+
 # Callback for connection
 def on_connect(client, userdata, flags, rc):
     logger.info(f"Connection Result Code: {rc}")
@@ -33,9 +116,10 @@ def on_connect(client, userdata, flags, rc):
 
 # Callback for messages
 def on_message(client, userdata, msg):
-    logger.info(f"Message received on topic {msg.topic}: {msg.payload.decode()}")
     try:
-        data = json.loads(msg.payload.decode())
+        # JSON or compact binary frame
+        data = decode_health(msg.payload)
+        logger.info(f"Message received on topic {msg.topic}: {data}")
         device_id = data.get('device_id')
         status = data.get('status')
         #health_timestamp = data.get('health_timestamp')
@@ -46,12 +130,21 @@ def on_message(client, userdata, msg):
             logger.warning("Message does not contain a device_id. Skipping.")
             return
 
-        # Check if the device_id exists in the collection
-        existing_device = devices_collection.find_one({'device_id': device_id})
-        if not existing_device:
+        # Check if the device_id is registered
+        if device_id not in registry:
             logger.warning(f"Device {device_id} does not exist in the database. Skipping update.")
             return
 
+        # Every heartbeat moves the in-memory deadline, written or not
+        if status == 'connected':
+            heartbeat_wheel.touch(device_id, health_timestamp.timestamp())
+        else:
+            heartbeat_wheel.cancel(device_id)
+
+        # Skip the write if nothing changed and the stored timestamp is recent enough
+        if not write_filter.should_write(device_id, status, battery_percentage, health_timestamp.timestamp()):
+            return
+
         # Update MongoDB for existing devices
         devices_collection.update_one(
             {'device_id': device_id},
@@ -63,6 +156,15 @@ def on_message(client, userdata, msg):
                 }
             }
         )
+        write_filter.record_write(device_id, status, battery_percentage, health_timestamp.timestamp())
+        if publisher is not None:
+            publisher.publish({
+                device_id: {
+                    'status': status,
+                    'health_timestamp': health_timestamp,
+                    'battery_percentage': battery_percentage,
+                }
+            })
         logger.info(f"Device {device_id} updated successfully.")
     except Exception as e:
         logger.error(f"Error processing message: {e}")
@@ -79,4 +181,7 @@ except Exception as e:
     logger.error(f"Error connecting to broker: {e}")
     exit(1)
 
+rebuild_heartbeat_wheel()
+threading.Thread(target=expire_heartbeats, name="heartbeat-wheel", daemon=True).start()
+
 client.loop_forever()
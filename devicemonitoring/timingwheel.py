@@ -0,0 +1,76 @@
+import math
+import threading
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel of per-device heartbeat deadlines.
+
+    Time is split into ticks of tick_seconds and the wheel has one slot (a set of
+    device_ids) per tick, wrapping around. touch() moves a device to the slot of
+    its new deadline and advance() only looks at the slots whose ticks have
+    passed, so both are O(1) per device regardless of fleet size. Deadlines
+    further away than one revolution simply stay in their slot for another turn.
+    """
+
+    def __init__(self, timeout_seconds: float, tick_seconds: float = 0.5):
+        self.timeout = timeout_seconds
+        self.tick = tick_seconds
+        self._slots = [set() for _ in range(int(math.ceil(timeout_seconds / tick_seconds)) + 1)]
+        self._deadlines = {}
+        self._current_tick = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def _tick_of(self, timestamp: float) -> int:
+        return int(timestamp // self.tick)
+
+    def touch(self, device_id: str, heartbeat_at: float):
+        """
+        Record a heartbeat; the device expires timeout_seconds after it.
+
+        Parameters:
+        - device_id (str): The device that sent the heartbeat
+        - heartbeat_at (float): Epoch seconds of the heartbeat
+        """
+        deadline = heartbeat_at + self.timeout
+        with self._lock:
+            previous = self._deadlines.get(device_id)
+            if previous is not None:
+                if deadline <= previous:
+                    return
+                self._slots[self._tick_of(previous) % len(self._slots)].discard(device_id)
+            self._deadlines[device_id] = deadline
+            self._slots[self._tick_of(deadline) % len(self._slots)].add(device_id)
+
+    def cancel(self, device_id: str):
+        """
+        Stop tracking a device (e.g. it reported itself as disconnected).
+        """
+        with self._lock:
+            deadline = self._deadlines.pop(device_id, None)
+            if deadline is not None:
+                self._slots[self._tick_of(deadline) % len(self._slots)].discard(device_id)
+
+    def advance(self, now: float) -> list:
+        """
+        Move the wheel to now and return the devices whose deadline has passed.
+        """
+        expired = []
+        now_tick = self._tick_of(now)
+        with self._lock:
+            if self._current_tick is None:
+                # First run (e.g. after rebuilding from MongoDB): sweep the whole wheel once
+                first_tick = now_tick - len(self._slots) + 1
+            else:
+                first_tick = max(self._current_tick + 1, now_tick - len(self._slots) + 1)
+            for tick in range(first_tick, now_tick + 1):
+                slot = self._slots[tick % len(self._slots)]
+                for device_id in [device_id for device_id in slot if self._deadlines[device_id] <= now]:
+                    slot.discard(device_id)
+                    del self._deadlines[device_id]
+                    expired.append(device_id)
+            self._current_tick = now_tick
+        return expired
@@ -0,0 +1,46 @@
+import threading
+
+
+class HeartbeatWriteFilter:
+    """
+    Remembers the last heartbeat state written to MongoDB for each device.
+
+    A heartbeat only needs to be written when status or battery_percentage
+    changed, or when the persisted health_timestamp is older than
+    refresh_seconds. refresh_seconds must stay well below the health check
+    timeout, otherwise the sweep would see live devices as stale.
+    """
+
+    def __init__(self, refresh_seconds: float):
+        self.refresh_seconds = refresh_seconds
+        self._persisted = {}
+        self._lock = threading.Lock()
+
+        # Counters, to see how much write load is being saved
+        self.written = 0
+        self.suppressed = 0
+
+    def should_write(self, device_id: str, status, battery_percentage, now: float) -> bool:
+        with self._lock:
+            persisted = self._persisted.get(device_id)
+            if (
+                persisted is None
+                or persisted[0] != status
+                or persisted[1] != battery_percentage
+                or now - persisted[2] >= self.refresh_seconds
+            ):
+                return True
+            self.suppressed += 1
+            return False
+
+    def record_write(self, device_id: str, status, battery_percentage, now: float):
+        with self._lock:
+            self._persisted[device_id] = (status, battery_percentage, now)
+            self.written += 1
+
+    def forget(self, device_id: str):
+        """
+        Drop the cached state, e.g. after the device's status was changed elsewhere.
+        """
+        with self._lock:
+            self._persisted.pop(device_id, None)
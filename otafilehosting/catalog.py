@@ -0,0 +1,187 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+# A firmware image as served to devices
+FirmwareFile = namedtuple("FirmwareFile", ["name", "path", "size", "mtime_ns", "sha256", "version"])
+
+# Optional per-device file with version metadata: {"<filename>": {"version": "1.2.0"}}
+MANIFEST_NAME = "manifest.json"
+# Optional per-device staged rollout settings, see rollout.py
+ROLLOUT_NAME = "rollout.json"
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _version_key(version) -> tuple:
+    return tuple(int(part) for part in re.findall(r"\d+", str(version))) if version is not None else ()
+
+
+def latest_firmware(files):
+    """
+    The newest image: highest manifest version, then most recently modified.
+    """
+    return max(files, key=lambda firmware: (_version_key(firmware.version), firmware.mtime_ns))
+
+
+def load_json(folder: str, name: str) -> dict:
+    """
+    Read an optional JSON object from a device folder; missing or broken files read as {}.
+    """
+    try:
+        with open(os.path.join(folder, name)) as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable {name} in {folder}: {e}")
+        return {}
+
+
+class FirmwareCatalog:
+    """
+    In-memory index of the firmware images under <root>/<device_name>/.
+
+    A device folder is rescanned (one scandir) at most once every
+    refresh_seconds, and content hashes are only recomputed for files whose
+    size or mtime changed since the previous scan. Update checks are therefore
+    served from memory instead of listing the directory on every request.
+
+    Scanning and hashing happen outside the catalog lock, one scan per folder
+    at a time, so hashing a new image never holds up other device types.
+
+    Parameters:
+    - root (str): Directory holding one folder per device name
+    - refresh_seconds (float): How long a scan is trusted before the folder is checked again
+    """
+
+    def __init__(self, root: str, refresh_seconds: float = 5):
+        self.root = root
+        self.refresh_seconds = refresh_seconds
+        self._folders = {}  # device_name -> (checked_at, files)
+        self._lock = threading.Lock()
+        self._scan_locks = {}  # device_name -> lock held while that folder is scanned
+        self.scans = 0
+        self.hashes = 0
+
+    def get(self, device_name: str):
+        """
+        Returns:
+        - tuple: FirmwareFile entries sorted by name, or None if the device has no folder
+        """
+        with self._lock:
+            entry = self._folders.get(device_name)
+            if entry is not None and time.monotonic() - entry[0] < self.refresh_seconds:
+                return entry[1]
+            # A device name is a single path component
+            if os.path.dirname(device_name) or device_name in ("", ".", ".."):
+                return None
+            scan_lock = self._scan_locks.setdefault(device_name, threading.Lock())
+
+        with scan_lock:
+            # Another request may have rescanned the folder while this one waited
+            with self._lock:
+                entry = self._folders.get(device_name)
+            now = time.monotonic()
+            if entry is not None and now - entry[0] < self.refresh_seconds:
+                return entry[1]
+            try:
+                files = self._scan(os.path.join(self.root, device_name), entry[1] if entry is not None else None)
+            except (FileNotFoundError, NotADirectoryError):
+                files = None
+            with self._lock:
+                self._folders[device_name] = (now, files)
+            return files
+
+    def find(self, device_name: str, filename: str):
+        for firmware in self.get(device_name) or ():
+            if firmware.name == filename:
+                return firmware
+        return None
+
+    def invalidate(self, device_name: str = None):
+        with self._lock:
+            if device_name is None:
+                self._folders.clear()
+            else:
+                self._folders.pop(device_name, None)
+
+    def _scan(self, folder: str, previous) -> tuple:
+        with self._lock:
+            self.scans += 1
+        known = {firmware.name: firmware for firmware in previous or ()}
+        manifest = load_json(folder, MANIFEST_NAME)
+        files = []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.startswith(".") or entry.name in (MANIFEST_NAME, ROLLOUT_NAME) or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                metadata = manifest.get(entry.name)
+                version = metadata.get("version") if isinstance(metadata, dict) else None
+                firmware = known.get(entry.name)
+                if firmware is None or firmware.size != stat.st_size or firmware.mtime_ns != stat.st_mtime_ns:
+                    with self._lock:
+                        self.hashes += 1
+                    sha256 = file_sha256(entry.path)
+                else:
+                    sha256 = firmware.sha256
+                files.append(FirmwareFile(entry.name, entry.path, stat.st_size, stat.st_mtime_ns, sha256, version))
+        files.sort(key=lambda firmware: firmware.name)
+        return tuple(files)
+
+
+class SignedUrlCache:
+    """
+    Reuses signed download URLs until they are close to expiring, so a fleet
+    checking for the same image does not sign a fresh token per request.
+
+    Parameters:
+    - sign (callable): (device_name, filename, expiry_minutes) -> signed URL
+    - expiry_minutes (int): Lifetime of a signed URL
+    - reuse_margin_seconds (float): A URL is replaced once it has less than this left
+    - max_entries (int): Bound on the cached URLs; expired entries are dropped first
+    """
+
+    def __init__(self, sign, expiry_minutes: int = 10, reuse_margin_seconds: float = 120, max_entries: int = 10000):
+        self.sign = sign
+        self.expiry_minutes = expiry_minutes
+        self.reuse_margin = reuse_margin_seconds
+        self.max_entries = max_entries
+        self._urls = {}  # (device_name, filename, sha256) -> (expires_at, url)
+        self._lock = threading.Lock()
+        self.signed = 0
+        self.reused = 0
+
+    def get(self, device_name: str, firmware: FirmwareFile) -> str:
+        key = (device_name, firmware.name, firmware.sha256)
+        now = time.time()
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is not None and entry[0] - now > self.reuse_margin:
+                self.reused += 1
+                return entry[1]
+
+        url = self.sign(device_name, firmware.name, self.expiry_minutes)
+        with self._lock:
+            self.signed += 1
+            if len(self._urls) >= self.max_entries:
+                self._urls = {k: v for k, v in self._urls.items() if v[0] - now > self.reuse_margin}
+                if len(self._urls) >= self.max_entries:
+                    self._urls.clear()
+            self._urls[key] = (now + self.expiry_minutes * 60, url)
+        return url
@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bsdiff4
+
+from catalog import FirmwareFile, file_sha256
+
+# Patches are stored and served as "<from sha256>-<to sha256>.bsdiff"
+PATCH_NAME = re.compile(r"^([0-9a-f]{64})-([0-9a-f]{64})\.bsdiff$")
+# Marks a version pair whose patch was not worth keeping
+SKIP_SUFFIX = ".skip"
+
+# Outcomes of _make_patch
+KEPT, SKIPPED, STALE = "kept", "skipped", "stale"
+
+
+def patch_name(source: FirmwareFile, target: FirmwareFile) -> str:
+    return f"{source.sha256}-{target.sha256}.bsdiff"
+
+
+def _read(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+# Runs inside the worker process
+def _make_patch(source: FirmwareFile, target: FirmwareFile, patch_path: str, max_ratio: float) -> str:
+    # The patch is named after the cataloged hashes: diff only the bytes that have them
+    try:
+        old, new = _read(source.path), _read(target.path)
+    except FileNotFoundError:
+        return STALE
+    if hashlib.sha256(old).hexdigest() != source.sha256 or hashlib.sha256(new).hexdigest() != target.sha256:
+        return STALE
+    patch = bsdiff4.diff(old, new)
+    os.makedirs(os.path.dirname(patch_path), exist_ok=True)
+    if len(patch) > len(new) * max_ratio:
+        open(patch_path + SKIP_SUFFIX, "w").close()
+        return SKIPPED
+    temporary = f"{patch_path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(patch)
+    os.replace(temporary, patch_path)
+    return KEPT
+
+
+class PatchStore:
+    """
+    Binary patches (bsdiff) between firmware images, generated once per version
+    pair and cached on disk.
+
+    A patch that is not available yet is generated in the background and the
+    device gets the full image meanwhile. Patches larger than max_ratio of the
+    full image are discarded and the pair is remembered, so it is not diffed
+    again. If either image no longer matches its cataloged sha256 when it is
+    diffed, no patch is stored and on_stale is called so the catalog rescans.
+
+    Parameters:
+    - directory (str): Patch cache directory, outside the catalog root
+    - max_ratio (float): Largest patch size, as a fraction of the full image, worth serving
+    - on_stale (callable): Called with the target FirmwareFile when the images changed on disk
+    """
+
+    def __init__(self, directory: str, max_ratio: float = 0.5, on_stale=None):
+        self.directory = directory
+        self.max_ratio = max_ratio
+        self.on_stale = on_stale
+        # Diffing is CPU and memory heavy: one pair at a time, off the serving process
+        self._executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+        self._pending = set()
+        self._patches = {}  # name -> FirmwareFile of the patch
+        self._lock = threading.Lock()
+        self.generated = 0
+        self.skipped = 0
+        self._served = {}  # target sha256 -> [patches served, bytes saved]
+
+    def get(self, source: FirmwareFile, target: FirmwareFile):
+        """
+        Returns:
+        - FirmwareFile: The patch from source to target, or None if there is none (yet)
+        """
+        if source.sha256 == target.sha256:
+            return None
+        name = patch_name(source, target)
+        patch = self.find(name)
+        if patch is not None:
+            return patch
+        if os.path.exists(os.path.join(self.directory, name + SKIP_SUFFIX)):
+            return None
+        with self._lock:
+            if name in self._pending:
+                return None
+            self._pending.add(name)
+        future = self._executor.submit(
+            _make_patch, source, target, os.path.join(self.directory, name), self.max_ratio
+        )
+        future.add_done_callback(lambda done: self._generated(name, target, done))
+        return None
+
+    def find(self, name: str):
+        """
+        Look up a cached patch by its file name.
+        """
+        if not PATCH_NAME.match(name):
+            return None
+        with self._lock:
+            patch = self._patches.get(name)
+        if patch is not None:
+            return patch
+        path = os.path.join(self.directory, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        patch = FirmwareFile(name, path, stat.st_size, stat.st_mtime_ns, file_sha256(path), None)
+        with self._lock:
+            self._patches[name] = patch
+        return patch
+
+    def record_served(self, patch: FirmwareFile, target_size: int):
+        """
+        Count a patch sent in place of the full image of size target_size.
+        """
+        target_sha256 = PATCH_NAME.match(patch.name).group(2)
+        with self._lock:
+            served = self._served.setdefault(target_sha256, [0, 0])
+            served[0] += 1
+            served[1] += target_size - patch.size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "generated": self.generated,
+                "skipped": self.skipped,
+                "pending": len(self._pending),
+                "served": {
+                    target: {"patches": patches, "bytes_saved": saved}
+                    for target, (patches, saved) in self._served.items()
+                },
+            }
+
+    def _generated(self, name: str, target: FirmwareFile, future):
+        with self._lock:
+            self._pending.discard(name)
+        try:
+            outcome = future.result()
+        except Exception as e:
+            logging.error(f"Generating patch {name} failed: {e}")
+            return
+        if outcome == STALE:
+            logging.warning(f"Firmware changed on disk before patch {name} for {target.name} was made, rescanning")
+            if self.on_stale is not None:
+                self.on_stale(target)
+            return
+        with self._lock:
+            if outcome == KEPT:
+                self.generated += 1
+            else:
+                self.skipped += 1
+        if outcome == KEPT:
+            logging.info(f"Generated patch {name} for {target.name}")
+        else:
+            logging.info(f"Patch {name} for {target.name} is not worth serving, sending full images")
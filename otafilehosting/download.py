@@ -0,0 +1,128 @@
+import os
+
+from flask import Response
+
+# Read size when the server has no wsgi.file_wrapper and the body is copied in Python
+READ_CHUNK_SIZE = 256 * 1024
+
+
+class _TrackedFile:
+    """
+    File proxy that reports when the server closes the body. It keeps fileno(),
+    so gunicorn still sends it with sendfile().
+    """
+
+    def __init__(self, f, on_close):
+        self._f = f
+        self._on_close = on_close
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+    def close(self):
+        self._f.close()
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
+
+def _read_range(f, length: int):
+    try:
+        while length > 0:
+            chunk = f.read(min(READ_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def _file_body(environ, f, length: int):
+    file_wrapper = environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None:
+        # The server sends Content-Length bytes from the current offset itself;
+        # gunicorn does it with sendfile(), so the body never enters Python
+        return file_wrapper(f, READ_CHUNK_SIZE)
+    return _read_range(f, length)
+
+
+def send_firmware(request, firmware, on_start=None, on_close=None):
+    """
+    Build the download response for a firmware image.
+
+    Supports conditional requests (If-None-Match against the sha256 ETag, 304)
+    and resumption (a single Range, honoured only if If-Range is absent or
+    matches the current ETag, 206/416).
+
+    Parameters:
+    - request (Request): The Flask request
+    - firmware (FirmwareFile): The catalog entry of the image
+    - on_start (callable): Called when a body (200 or 206) is about to be sent; not for HEAD
+    - on_close (callable): Called with the body length once the server closes the body
+
+    Returns:
+    - Response: The response, or None if the file is gone or changed since it was cataloged
+    """
+    # The ETag and length come from the catalog: only use them while the file still matches it
+    try:
+        f = open(firmware.path, "rb")
+    except OSError:
+        return None
+    stat = os.fstat(f.fileno())
+    if stat.st_size != firmware.size or stat.st_mtime_ns != firmware.mtime_ns:
+        f.close()
+        return None
+
+    etag = firmware.sha256
+    headers = {
+        "ETag": f'"{etag}"',
+        "Accept-Ranges": "bytes",
+        "Content-Disposition": f'attachment; filename="{firmware.name}"',
+    }
+
+    # The device already has this image
+    if request.if_none_match.contains_weak(etag):
+        f.close()
+        return Response(status=304, headers=headers)
+
+    size = firmware.size
+    start, stop, status = 0, size, 200
+    # A Range is ignored (full response) when If-Range names another version; werkzeug
+    # drops the weak marker, and a weak validator never matches for If-Range
+    if_range = request.headers.get("If-Range")
+    range_allowed = not if_range or (request.if_range.etag == etag and not if_range.startswith("W/"))
+    if request.range is not None and range_allowed:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is not None:
+            start, stop = byte_range
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        elif len(request.range.ranges) == 1:
+            headers["Content-Range"] = f"bytes */{size}"
+            f.close()
+            return Response(status=416, headers=headers)
+        # Several ranges: send the whole image instead of a multipart body
+
+    # HEAD: same headers, but the server discards the body without closing it
+    if request.method == "HEAD":
+        f.close()
+        response = Response(status=status, headers=headers, mimetype="application/octet-stream")
+        response.content_length = stop - start
+        return response
+
+    f.seek(start)
+    if on_start is not None:
+        on_start()
+    if on_close is not None:
+        f = _TrackedFile(f, lambda: on_close(stop - start))
+
+    response = Response(
+        _file_body(request.environ, f, stop - start),
+        status=status,
+        headers=headers,
+        mimetype="application/octet-stream",
+        direct_passthrough=True,
+    )
+    response.content_length = stop - start
+    return response
@@ -1,12 +1,19 @@
 from flask import Flask, request, jsonify
-from flask import send_from_directory
-from jose import jwt, JWTError
 from cryptography.fernet import Fernet
 from pymongo import MongoClient
 import os
 import datetime
+import functools
 import logging
 
+from catalog import FirmwareCatalog, SignedUrlCache, latest_firmware
+from delta import PATCH_NAME, PatchStore
+from download import send_firmware
+from rollout import DownloadAdmission, RolloutPlans
+from common.auth import JWTAuth
+from common.cache import LatestValueCache
+from common.indexes import ensure_indexes
+
 # Flask app setup
 app = Flask(__name__)
 
@@ -15,42 +22,57 @@ SECRET_KEY = "your_secret_key_here"  # Replace with your secure JWT secret
 ALGORITHM = "HS256"  # Algorithm for JWT decoding
 FERNET_KEY = b'_T3L0eU8ovtJSZCMf7GxkXh1GP1ebNuLlHLcfM8vu4Q='  # Replace with your Fernet encryption key
 cipher = Fernet(FERNET_KEY)
+auth = JWTAuth(SECRET_KEY, ALGORITHM)
 
 OTA_DIR = "/app/OTA"  # Path to the OTA directory
 BASE_URL = "https://ota.eknow.in"  # Base URL for OTA file hosting
 
+# Update checks are answered from memory: the firmware catalog is rescanned at most
+# every OTA_REFRESH_SECONDS, signed URLs are reused until SIGNED_URL_REUSE_MARGIN_SECONDS
+# before they expire, and decrypted device IDs and users are cached
+OTA_REFRESH_SECONDS = float(os.getenv("OTA_REFRESH_SECONDS", "5"))
+SIGNED_URL_EXPIRY_MINUTES = int(os.getenv("SIGNED_URL_EXPIRY_MINUTES", "10"))
+SIGNED_URL_REUSE_MARGIN_SECONDS = float(os.getenv("SIGNED_URL_REUSE_MARGIN_SECONDS", "120"))
+DEVICE_ID_CACHE_SIZE = int(os.getenv("DEVICE_ID_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+
+# Delta updates: bsdiff patches are cached in OTA_DELTA_DIR and only served when they
+# are at most OTA_DELTA_MAX_RATIO of the full image
+OTA_DELTA_DIR = os.getenv("OTA_DELTA_DIR", "/app/OTA_delta")
+OTA_DELTA_MAX_RATIO = float(os.getenv("OTA_DELTA_MAX_RATIO", "0.5"))
+
+# Download admission: new downloads per second, burst after an idle period, concurrent
+# downloads (keep below the server threads) and the longest retry hint handed out
+OTA_DOWNLOAD_RATE = float(os.getenv("OTA_DOWNLOAD_RATE", "5"))
+OTA_DOWNLOAD_BURST = float(os.getenv("OTA_DOWNLOAD_BURST", "20"))
+OTA_MAX_IN_FLIGHT = int(os.getenv("OTA_MAX_IN_FLIGHT", "24"))
+OTA_MAX_RETRY_AFTER = int(os.getenv("OTA_MAX_RETRY_AFTER", "300"))
+# A download holding its slot longer than this is assumed lost and releases it
+OTA_IN_FLIGHT_TIMEOUT_SECONDS = float(os.getenv("OTA_IN_FLIGHT_TIMEOUT_SECONDS", "3600"))
+
 
 # MongoDB setup
 client = MongoClient("mongodb://mongodb:27017")
 db = client["mydatabase"]
 users_collection = db["users"]
+ensure_indexes(db)
+
+user_cache = LatestValueCache(
+    lambda user_id: users_collection.find_one({"user_id": user_id}),
+    ttl_seconds=USER_CACHE_TTL_SECONDS,
+    stats_interval=0,
+)
 
 
 def get_user(user_id: str):
     """
-    Retrieve user data from the database.
-    Replace with your actual database query logic.
+    Retrieve user data, from the cache when the user was looked up recently.
     """
-    return users_collection.find_one({"user_id": user_id})
-
-
-def decode_jwt_token(token: str):
-    """
-    Decode and validate a JWT token.
-
-    Parameters:
-    - token (str): JWT token to decode
-
-    Returns:
-    - dict: Decoded payload from the token
-    """
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
-    except JWTError:
-        raise ValueError("Invalid token")
+    return user_cache.get(user_id)
 
 
+# Device IDs are not time limited, so a decrypted ID stays valid; callers must not modify the result
+@functools.lru_cache(maxsize=DEVICE_ID_CACHE_SIZE)
 def decode_device_info(encoded_data: str) -> dict:
     """
     Decode the encrypted device information.
@@ -92,10 +114,104 @@ def generate_signed_url(device_name: str, filename: str, expiry_minutes: int = 1
         "device": device_name,
         "exp": expiry_time
     }
-    signed_token = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+    signed_token = auth.encode(payload)
     return f"{BASE_URL}/{signed_token}/{filename}"
 
 
+catalog = FirmwareCatalog(OTA_DIR, OTA_REFRESH_SECONDS)
+signed_urls = SignedUrlCache(generate_signed_url, SIGNED_URL_EXPIRY_MINUTES, SIGNED_URL_REUSE_MARGIN_SECONDS)
+# Images live in <OTA_DIR>/<device_name>/, so a stale image names the folder to rescan
+patches = PatchStore(
+    OTA_DELTA_DIR, OTA_DELTA_MAX_RATIO,
+    on_stale=lambda firmware: catalog.invalidate(os.path.basename(os.path.dirname(firmware.path))),
+)
+rollouts = RolloutPlans(OTA_DIR, OTA_REFRESH_SECONDS)
+admission = DownloadAdmission(
+    OTA_DOWNLOAD_RATE, OTA_DOWNLOAD_BURST, OTA_MAX_IN_FLIGHT,
+    grant_seconds=SIGNED_URL_EXPIRY_MINUTES * 60, max_retry_after=OTA_MAX_RETRY_AFTER,
+    in_flight_timeout=OTA_IN_FLIGHT_TIMEOUT_SECONDS,
+)
+
+
+def device_key(device_info: dict) -> str:
+    # Stable identity of a device, independent of how its ID was encrypted
+    return ":".join(device_info[field] for field in ("manufacturer_name", "device_name", "device_type", "timestamp"))
+
+
+def tracked_download(request, firmware, rollout_key: tuple):
+    """
+    send_firmware that counts the download in the in-flight and per-rollout stats.
+    """
+    download_ids = []
+
+    def on_start():
+        download_ids.append(admission.started(rollout_key))
+
+    def on_close(nbytes: int):
+        admission.finished(download_ids[0], nbytes)
+
+    return send_firmware(request, firmware, on_start=on_start, on_close=on_close)
+
+
+def serve_patch(device_name: str, filename: str):
+    """
+    Serve a cached patch and count the bytes it saved over the full image.
+    """
+    patch = patches.find(filename)
+    if patch is None:
+        return jsonify({"error": "File not found"}), 404
+    target_sha256 = PATCH_NAME.match(filename).group(2)
+    response = tracked_download(request, patch, (device_name, target_sha256))
+    if response is None:
+        return jsonify({"error": "File not found"}), 404
+    if response.status_code == 200:
+        target = next((f for f in catalog.get(device_name) or () if f.sha256 == target_sha256), None)
+        if target is not None:
+            patches.record_served(patch, target.size)
+    return response
+
+
+def update_for(device_name: str, files, current_sha256: str = None, current_version: str = None) -> dict:
+    """
+    Describe the update from the device's current image to the latest one.
+
+    Parameters:
+    - device_name (str): The name of the device
+    - files (tuple): Catalog entries of the device
+    - current_sha256 (str): sha256 of the image the device runs, if it sent one
+    - current_version (str): Version the device runs, if it sent one
+
+    Returns:
+    - dict: The latest image, whether the device already runs it, and a patch
+      ({"url", "size", "sha256", "from_sha256"}) to apply instead of downloading
+      it, or None when there is no patch (yet) for the current image
+    """
+    target = latest_firmware(files)
+    source = next(
+        (f for f in files if f.sha256 == current_sha256 or current_version is not None and f.version == current_version),
+        None,
+    )
+    update = {
+        "name": target.name,
+        "version": target.version,
+        "size": target.size,
+        "sha256": target.sha256,
+        "url": signed_urls.get(device_name, target),
+        "up_to_date": source is not None and source.sha256 == target.sha256,
+        "patch": None,
+    }
+    if source is not None and not update["up_to_date"]:
+        patch = patches.get(source, target)
+        if patch is not None:
+            update["patch"] = {
+                "url": signed_urls.get(device_name, patch),
+                "size": patch.size,
+                "sha256": patch.sha256,
+                "from_sha256": source.sha256,
+            }
+    return update
+
+
 @app.route("/<token>/<filename>", methods=["GET"])
 def serve_file(token, filename):
     """
@@ -106,17 +222,13 @@ def serve_file(token, filename):
     - filename (str): The name of the requested file
 
     Returns:
-    - File: The requested file if the token is valid
+    - File: The requested file if the token is valid; supports Range (206) for
+      resuming and If-None-Match (304) against the sha256 ETag
     """
     try:
-        # Validate and decode JWT token
-        token1 = request.headers.get("Authorization")
-        if not token1 or not token1.startswith("Bearer "):
-            return jsonify({"error": "Authorization token is required"}), 401
-        token1 = token1.split(" ")[1]
-
+        # Validate and decode JWT token (verified tokens are cached)
         try:
-            payload = decode_jwt_token(token1)
+            payload = auth.verify_bearer(request.headers.get("Authorization"))
         except ValueError as e:
             return jsonify({"error": str(e)}), 401
 
@@ -126,7 +238,10 @@ def serve_file(token, filename):
         if not user:
             return jsonify({"error": "User not found"}), 404
         # Decode and validate the token
-        payload1 = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        try:
+            payload1 = auth.verify(token)
+        except ValueError:
+            return jsonify({"error": "Invalid or expired token"}), 401
 
         # Check if the filename in the token matches the requested file
         if payload1.get("file") != filename:
@@ -137,17 +252,27 @@ def serve_file(token, filename):
         if not device_name:
             return jsonify({"error": "Device name missing in the token"}), 400
 
-        # Build the file path using device name
-        file_path = os.path.join(OTA_DIR, device_name, filename)
-        if not os.path.exists(file_path):
-            logging.error(f"File not found at {file_path}")
+        # Patches are content addressed and live outside the catalog
+        if PATCH_NAME.match(filename):
+            return serve_patch(device_name, filename)
+
+        # Look the file up in the catalog of the device
+        firmware = catalog.find(device_name, filename)
+        if firmware is None:
+            logging.error(f"File not found: {device_name}/{filename}")
             return jsonify({"error": "File not found"}), 404
 
-        # Serve the file
-        return send_from_directory(os.path.join(OTA_DIR, device_name), filename, as_attachment=True)
+        # Serve the file; rescan once if it was replaced since the last scan
+        response = tracked_download(request, firmware, (device_name, firmware.sha256))
+        if response is None:
+            catalog.invalidate(device_name)
+            firmware = catalog.find(device_name, filename)
+            if firmware is not None:
+                response = tracked_download(request, firmware, (device_name, firmware.sha256))
+        if response is None:
+            return jsonify({"error": "File not found"}), 404
+        return response
 
-    except JWTError as e:
-        return jsonify({"error": "Invalid or expired token"}), 401
     except Exception as e:
         return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
 
@@ -155,14 +280,9 @@ def serve_file(token, filename):
 @app.route("/get-ota-files", methods=["POST"])
 def get_ota_files():
     try:
-        # Validate and decode JWT token
-        token = request.headers.get("Authorization")
-        if not token or not token.startswith("Bearer "):
-            return jsonify({"error": "Authorization token is required"}), 401
-        token = token.split(" ")[1]
-
+        # Validate and decode JWT token (verified tokens are cached)
         try:
-            payload = decode_jwt_token(token)
+            payload = auth.verify_bearer(request.headers.get("Authorization"))
         except ValueError as e:
             return jsonify({"error": str(e)}), 401
 
@@ -184,21 +304,94 @@ def get_ota_files():
         except ValueError as e:
             return jsonify({"error": str(e)}), 400
 
-        # Build folder path
-        folder_path = os.path.join(OTA_DIR, device_name)
-        if not os.path.exists(folder_path):
+        # Firmware images of the device, from the in-memory catalog
+        files = catalog.get(device_name)
+        if files is None:
             return jsonify({"error": f"No OTA files available for device {device_name}"}), 404
 
-        # Get files in the folder
-        files = os.listdir(folder_path)
-        file_links = [generate_signed_url(device_name, file) for file in files]
-
-        return jsonify({"device": device_name, "ota_files": file_links})
+        # Staged rollout: the image being rolled out is hidden from devices outside the current wave
+        key = device_key(device_info)
+        files = rollouts.visible(device_name, key, files)
+
+        # Devices that report what they run get the latest image, as a patch when possible
+        current_sha256 = data.get("currentSha256")
+        current_version = data.get("currentVersion")
+        update = None
+        if files and (current_sha256 or current_version):
+            update = update_for(device_name, files, current_sha256, current_version)
+
+        # Admission control: a device that would download waits for its turn instead of getting URLs
+        if files and not (update and update["up_to_date"]):
+            retry_after = admission.admit(key, latest_firmware(files).sha256)
+            if retry_after:
+                response = jsonify({"error": "Too many downloads in progress", "retry_after": retry_after})
+                response.headers["Retry-After"] = str(retry_after)
+                return response, 503
+
+        file_links = [signed_urls.get(device_name, firmware) for firmware in files]
+        result = {
+            "device": device_name,
+            "ota_files": file_links,
+            "files": [
+                {"name": firmware.name, "size": firmware.size, "sha256": firmware.sha256,
+                 "version": firmware.version, "url": link}
+                for firmware, link in zip(files, file_links)
+            ],
+        }
+        if update is not None:
+            result["update"] = update
+        return jsonify(result)
 
     except Exception as e:
         return jsonify({"error": "An unexpected error occurred", "details": str(e)}), 500
 
 
+@app.route("/ota-stats", methods=["GET"])
+def ota_stats():
+    """
+    Patch generation counters and, per target image sha256, the patches served
+    and the bytes they saved compared to full downloads.
+    """
+    try:
+        auth.verify_bearer(request.headers.get("Authorization"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 401
+    return jsonify({"patches": patches.stats()})
+
+
+@app.route("/rollouts", methods=["GET"])
+def rollout_status():
+    """
+    Download admission state (in-flight downloads, waiting devices, tokens) and,
+    per device type, the rollout in progress and the downloads, bytes served and
+    throughput per image.
+    """
+    try:
+        auth.verify_bearer(request.headers.get("Authorization"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 401
+
+    stats = admission.stats()
+    per_image = stats.pop("rollouts")
+    device_names = sorted(
+        {device_name for device_name, _ in per_image}
+        | {name for name in os.listdir(OTA_DIR) if os.path.isdir(os.path.join(OTA_DIR, name))}
+    ) if os.path.isdir(OTA_DIR) else sorted({device_name for device_name, _ in per_image})
+
+    devices = []
+    for device_name in device_names:
+        files = catalog.get(device_name) or ()
+        names = {firmware.sha256: firmware.name for firmware in files}
+        images = [
+            {"sha256": sha256, "name": names.get(sha256), **counters}
+            for (name, sha256), counters in per_image.items() if name == device_name
+        ]
+        rollout = rollouts.status(device_name, files)
+        if rollout is not None or images:
+            devices.append({"device": device_name, "rollout": rollout, "images": images})
+    return jsonify({"admission": stats, "devices": devices})
+
+
 if __name__ == "__main__":
     # Ensure OTA directory exists
     if not os.path.exists(OTA_DIR):
@@ -0,0 +1,294 @@
+import collections
+import datetime
+import hashlib
+import itertools
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+from catalog import ROLLOUT_NAME, latest_firmware, load_json
+
+
+def rollout_bucket(device_key: str, image_sha256: str) -> float:
+    """
+    Stable position of a device in [0, 100) for one image. Every image picks its
+    own early cohort, and a device never leaves a wave once it is in it.
+    """
+    digest = hashlib.blake2b(f"{image_sha256}:{device_key}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % 10000 / 100
+
+
+class RolloutPlans:
+    """
+    Staged release of a device type's newest firmware, configured per device
+    folder in rollout.json:
+
+        {"percentage": 25}
+        {"waves": [1, 10, 50, 100], "wave_minutes": 60, "start": "2024-05-01T08:00:00+00:00"}
+
+    "image" names the image being rolled out (default: the latest one) and
+    "start" defaults to its modification time; a "start" without an offset is
+    read as UTC. Devices outside the current percentage do not see that image
+    and keep getting the previous ones. A folder without rollout.json releases
+    everything to everyone.
+
+    Parameters:
+    - root (str): Directory holding one folder per device name
+    - refresh_seconds (float): How long a loaded rollout.json is trusted before it is checked again
+    """
+
+    def __init__(self, root: str, refresh_seconds: float = 5):
+        self.root = root
+        self.refresh_seconds = refresh_seconds
+        self._plans = {}  # device_name -> (checked_at, mtime_ns, plan)
+        self._lock = threading.Lock()
+
+    def plan(self, device_name: str) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._plans.get(device_name)
+            if entry is not None and now - entry[0] < self.refresh_seconds:
+                return entry[2]
+        folder = os.path.join(self.root, device_name)
+        try:
+            mtime_ns = os.stat(os.path.join(folder, ROLLOUT_NAME)).st_mtime_ns
+        except (FileNotFoundError, NotADirectoryError):
+            mtime_ns = None
+        if entry is not None and entry[1] == mtime_ns:
+            plan = entry[2]
+        else:
+            plan = load_json(folder, ROLLOUT_NAME) if mtime_ns is not None else {}
+        with self._lock:
+            self._plans[device_name] = (now, mtime_ns, plan)
+        return plan
+
+    def status(self, device_name: str, files) -> dict:
+        """
+        Returns:
+        - dict: The image under rollout, the released percentage and the wave,
+          or None if the device type has no rollout
+        """
+        plan = self.plan(device_name)
+        if not plan or not files:
+            return None
+        target = next((f for f in files if f.name == plan.get("image")), None) or latest_firmware(files)
+        percentage, wave = self._percentage(plan, target)
+        return {"image": target.name, "version": target.version, "sha256": target.sha256,
+                "percentage": percentage, "wave": wave}
+
+    def visible(self, device_name: str, device_key: str, files):
+        """
+        The images a device may download: all of them, minus the image under
+        rollout while the device is outside the released percentage.
+        """
+        status = self.status(device_name, files)
+        if status is None or rollout_bucket(device_key, status["sha256"]) < status["percentage"]:
+            return files
+        return tuple(f for f in files if f.sha256 != status["sha256"])
+
+    def _percentage(self, plan: dict, target) -> tuple:
+        waves = plan.get("waves")
+        if not waves:
+            return float(plan.get("percentage", 100)), None
+        try:
+            start = datetime.datetime.fromisoformat(plan["start"]) if plan.get("start") else None
+        except (TypeError, ValueError):
+            start = None
+        if start is not None:
+            # Not the server's local time, which would move the waves with the host's timezone
+            if start.tzinfo is None:
+                start = start.replace(tzinfo=datetime.timezone.utc)
+            start = start.timestamp()
+        if start is None:
+            start = target.mtime_ns / 1e9
+        elapsed = time.time() - start
+        if elapsed < 0:
+            return 0.0, None
+        wave = min(int(elapsed // (float(plan.get("wave_minutes", 60)) * 60)), len(waves) - 1)
+        return float(waves[wave]), wave
+
+
+class TokenBucket:
+    """
+    Allows rate starts per second on average, with bursts of up to burst.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, now: float) -> bool:
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class DownloadAdmission:
+    """
+    Admission control for firmware downloads.
+
+    A device that needs an image is granted a download URL only while the token
+    bucket has a token and fewer than max_in_flight downloads are running;
+    otherwise it is told when to come back, with the wait growing with the
+    number of devices already waiting. A grant is remembered for grant_seconds
+    (the signed URL lifetime), so checking again does not cost a second token.
+
+    Also keeps per-rollout counters (downloads, in flight, bytes, throughput)
+    keyed by (device_name, image sha256). Bytes are the full length of each
+    response body, so a download the device dropped counts in full. A download
+    that is still in flight after in_flight_timeout is assumed lost (the server
+    never closed its body) and gives its slot back.
+
+    Parameters:
+    - rate (float): Download starts per second
+    - burst (float): Downloads that may start at once after an idle period
+    - max_in_flight (int): Concurrent downloads
+    - grant_seconds (float): How long a granted device may start its download
+    - max_retry_after (int): Longest wait handed to a device
+    - throughput_window (float): Seconds of completed downloads the throughput is averaged over
+    - in_flight_timeout (float): Longest a download may hold an in-flight slot
+    """
+
+    def __init__(self, rate: float, burst: float, max_in_flight: int, grant_seconds: float = 600,
+                 max_retry_after: int = 300, throughput_window: float = 60, in_flight_timeout: float = 3600):
+        self.bucket = TokenBucket(rate, burst)
+        self.max_in_flight = max_in_flight
+        self.grant_seconds = grant_seconds
+        self.max_retry_after = max_retry_after
+        self.throughput_window = throughput_window
+        self.in_flight_timeout = in_flight_timeout
+        self._grants = {}  # (device_key, image sha256) -> expires_at
+        self._waiting = {}  # device_key -> expires_at
+        self._lock = threading.Lock()
+        self._admits = 0
+        self._downloads = {}  # download id -> (started_at, rollout_key)
+        self._ids = itertools.count(1)
+        self.granted = 0
+        self.rejected = 0
+        self.expired = 0
+        self._rollouts = {}  # (device_name, image sha256) -> counters
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._downloads)
+
+    def admit(self, device_key: str, image_sha256: str) -> int:
+        """
+        Returns:
+        - int: 0 if the device may download now, otherwise seconds to wait before asking again
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._admits += 1
+            if self._admits % 1000 == 0:
+                self._prune(now)
+            if self._grants.get((device_key, image_sha256), 0) > now:
+                return 0
+            if self.in_flight >= self.max_in_flight:
+                self._expire(now)
+            if self.in_flight < self.max_in_flight and self.bucket.take(now):
+                self._grants[(device_key, image_sha256)] = now + self.grant_seconds
+                self._waiting.pop(device_key, None)
+                self.granted += 1
+                return 0
+
+            self.rejected += 1
+            # Approximate: expired entries are only dropped by the periodic prune
+            ahead = len(self._waiting) - (device_key in self._waiting)
+            # Spread the waiting devices over the rate, with jitter so they do not return together
+            wait = max(1.0, (ahead + 1 - self.bucket.tokens) / self.bucket.rate)
+            retry_after = min(self.max_retry_after, math.ceil(wait * random.uniform(1.0, 1.2)))
+            self._waiting[device_key] = now + retry_after * 2
+            return retry_after
+
+    def started(self, rollout_key: tuple) -> int:
+        """
+        Returns:
+        - int: Download id to hand to finished()
+        """
+        now = time.monotonic()
+        with self._lock:
+            download_id = next(self._ids)
+            self._downloads[download_id] = (now, rollout_key)
+            counters = self._counters(rollout_key)
+            counters["started"] += 1
+            counters["in_flight"] += 1
+            return download_id
+
+    def finished(self, download_id: int, nbytes: int):
+        now = time.monotonic()
+        with self._lock:
+            download = self._downloads.pop(download_id, None)
+            if download is None:
+                # Expired meanwhile; its slot was already given back
+                return
+            counters = self._counters(download[1])
+            counters["in_flight"] -= 1
+            counters["completed"] += 1
+            counters["bytes"] += nbytes
+            recent = counters["recent"]
+            recent.append((now, nbytes))
+            while recent and recent[0][0] < now - self.throughput_window:
+                recent.popleft()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            self.bucket.refill(now)
+            self._expire(now)
+            rollouts = {}
+            for key, counters in self._rollouts.items():
+                recent_bytes = sum(n for t, n in counters["recent"] if t >= now - self.throughput_window)
+                rollouts[key] = {
+                    "downloads_started": counters["started"],
+                    "downloads_completed": counters["completed"],
+                    "in_flight": counters["in_flight"],
+                    "bytes_served": counters["bytes"],
+                    "bytes_per_second": recent_bytes / self.throughput_window,
+                }
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "waiting": sum(1 for expires in self._waiting.values() if expires > now),
+                "tokens": self.bucket.tokens,
+                "rate": self.bucket.rate,
+                "burst": self.bucket.burst,
+                "granted": self.granted,
+                "rejected": self.rejected,
+                "expired": self.expired,
+                "rollouts": rollouts,
+            }
+
+    def _counters(self, rollout_key: tuple) -> dict:
+        counters = self._rollouts.get(rollout_key)
+        if counters is None:
+            counters = {"started": 0, "completed": 0, "in_flight": 0, "bytes": 0, "recent": collections.deque()}
+            self._rollouts[rollout_key] = counters
+        return counters
+
+    def _expire(self, now: float):
+        expired = [
+            download_id for download_id, (started_at, _) in self._downloads.items()
+            if now - started_at > self.in_flight_timeout
+        ]
+        for download_id in expired:
+            _, rollout_key = self._downloads.pop(download_id)
+            self._counters(rollout_key)["in_flight"] -= 1
+        if expired:
+            self.expired += len(expired)
+            logging.warning(f"Released {len(expired)} download slots held longer than {self.in_flight_timeout:.0f} s")
+
+    def _prune(self, now: float):
+        self._grants = {key: expires for key, expires in self._grants.items() if expires > now}
+        self._waiting = {key: expires for key, expires in self._waiting.items() if expires > now}
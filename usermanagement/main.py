@@ -1,23 +1,31 @@
 from fastapi import FastAPI, HTTPException, Depends
 from pydantic import BaseModel, EmailStr
-from passlib.context import CryptContext
-from jose import JWTError, jwt
 from datetime import datetime, timedelta
+import os
 import uuid
-from pymongo import MongoClient
 from fastapi.security import OAuth2PasswordBearer
+from pymongo.errors import DuplicateKeyError
 
-# MongoDB setup
-client = MongoClient("mongodb://mongodb:27017")
-db = client["mydatabase"]
+from common.auth import InvalidToken, JWTAuth
+from common.db import db, run_db
+from common.indexes import ensure_indexes
+from passwords import PasswordHasher, PasswordHasherBusy
+
+# MongoDB setup (MONGO_URL and pool sizes come from the environment, see common/db.py)
 users_collection = db["users"]
+ensure_indexes(db)
 
 # Security configurations
 SECRET_KEY = "your_secret_key_here"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+auth = JWTAuth(SECRET_KEY, ALGORITHM)
+
+# bcrypt runs on a process pool; see passwords.py for BCRYPT_ROUNDS
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", str(PASSWORD_WORKERS * 8)))
+hasher = PasswordHasher(PASSWORD_WORKERS, PASSWORD_QUEUE_LIMIT)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 app = FastAPI()
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="signin")
@@ -36,11 +44,21 @@ class TokenData(BaseModel):
     user_id: str | None = None
 
 # Helper functions
-def get_password_hash(password: str):
-    return pwd_context.hash(password)
+def hashing_busy():
+    return HTTPException(status_code=503, detail="Too many sign-ins, try again shortly", headers={"Retry-After": "1"})
 
-def verify_password(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
+async def get_password_hash(password: str):
+    try:
+        return await hasher.hash(password)
+    except PasswordHasherBusy:
+        raise hashing_busy()
+
+async def verify_password(plain_password: str, hashed_password: str):
+    # Returns (verified, new_hash); new_hash is set when the stored hash needs a cost upgrade
+    try:
+        return await hasher.verify_and_update(plain_password, hashed_password)
+    except PasswordHasherBusy:
+        raise hashing_busy()
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -48,47 +66,62 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
         expires_delta = timedelta(days=1)
     expire = datetime.utcnow() + expires_delta
     to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    return auth.encode(to_encode)
 
 def get_user(email: str):
     return users_collection.find_one({"email": email})
 
 def create_user(username: str, email: str, hashed_password: str):
     user_id = str(uuid.uuid4())  # Generate unique ID
-    users_collection.insert_one({
-        "user_id": user_id,
-        "username": username,
-        "email": email,
-        "hashed_password": hashed_password,
-        "created_at": datetime.utcnow()
-    })
+    try:
+        users_collection.insert_one({
+            "user_id": user_id,
+            "username": username,
+            "email": email,
+            "hashed_password": hashed_password,
+            "created_at": datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        # Lost a race with a concurrent signup for the same email
+        raise HTTPException(status_code=400, detail="Email already registered")
     return user_id
 
+def update_password_hash(user_id: str, hashed_password: str):
+    users_collection.update_one({"user_id": user_id}, {"$set": {"hashed_password": hashed_password}})
+
 # API Endpoints
 @app.post("/signup", response_model=dict)
 async def signup(user: User):
-    if get_user(user.email):
+    if await run_db(get_user, user.email):
         raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = get_password_hash(user.password)
-    user_id = create_user(user.username, user.email, hashed_password)
+    hashed_password = await get_password_hash(user.password)
+    user_id = await run_db(create_user, user.username, user.email, hashed_password)
     return {"user_id": user_id, "message": "User created successfully"}
 
 @app.post("/signin", response_model=Token)
 async def signin(user: User):
-    db_user = get_user(user.email)
-    if not db_user or not verify_password(user.password, db_user["hashed_password"]):
+    db_user = await run_db(get_user, user.email)
+    if not db_user:
         raise HTTPException(status_code=400, detail="Invalid email or password")
+    verified, new_hash = await verify_password(user.password, db_user["hashed_password"])
+    if not verified:
+        raise HTTPException(status_code=400, detail="Invalid email or password")
+    if new_hash:
+        # The configured bcrypt cost changed since this hash was made
+        await run_db(update_password_hash, db_user["user_id"], new_hash)
     access_token = create_access_token(data={"user_id": db_user["user_id"]})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/me", response_model=dict)
 async def get_me(token: str = Depends(oauth2_scheme)):
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id = payload.get("user_id")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        user = users_collection.find_one({"user_id": user_id})
-        return {"user_id": user["user_id"], "username": user["username"], "email": user["email"]}
-    except JWTError:
+        payload = auth.verify(token)
+    except InvalidToken:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    user_id = payload.get("user_id")
+    if user_id is None:
         raise HTTPException(status_code=401, detail="Invalid token")
+    user = await run_db(users_collection.find_one, {"user_id": user_id})
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"user_id": user["user_id"], "username": user["username"], "email": user["email"]}
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+# bcrypt cost for new hashes; stored hashes with another cost are upgraded at the next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+
+# Run inside the worker processes
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str):
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """
+    bcrypt hashing and verification on a pool of worker processes.
+
+    bcrypt is deliberately slow CPU work; run on the event loop it stalls every
+    other request of the worker. Here at most workers hashes run at a time and
+    at most queue_limit more wait for a process. Anything beyond that is
+    rejected right away with PasswordHasherBusy, so a login storm gets fast
+    errors instead of an ever-growing queue.
+
+    Parameters:
+    - workers (int): Worker processes, normally one per core
+    - queue_limit (int): Requests allowed to wait for a free worker
+    """
+
+    def __init__(self, workers: int, queue_limit: int):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        # Spawned, not forked: a forked worker would inherit the server's
+        # listening socket and background threads
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        # Only touched from the event loop, so no lock is needed
+        self._in_flight = 0
+        self.rejected = 0
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(_hash, password)
+
+    async def verify_and_update(self, password: str, hashed_password: str):
+        """
+        Check a password against its stored hash.
+
+        Returns:
+        - tuple: (verified, new_hash); new_hash is set when the stored hash uses
+          an outdated cost and should replace it
+        """
+        return await self._submit(_verify_and_update, password, hashed_password)
+
+    async def _submit(self, function, *args):
+        if self._in_flight >= self.workers + self.queue_limit:
+            self.rejected += 1
+            if self.rejected % 100 == 1:
+                logging.warning(f"Password hashing is saturated, {self.rejected} requests rejected so far")
+            raise PasswordHasherBusy()
+        self._in_flight += 1
+        try:
+            return await asyncio.wrap_future(self._executor.submit(function, *args))
+        finally:
+            self._in_flight -= 1